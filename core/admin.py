@@ -25,12 +25,24 @@ class HarvestProfileAdmin(admin.ModelAdmin):
     pass
 admin.site.register(HarvestProfile, HarvestProfileAdmin)
 
+class HarvestJobAdmin(admin.ModelAdmin):
+    list_display = ['profile', 'status', 'queued', 'started', 'finished', 'worker']
+    list_filter = ['status']
+    raw_id_fields = ['profile', 'user']
+admin.site.register(HarvestJob, HarvestJobAdmin)
+
 class FindingAidAdmin(admin.ModelAdmin):
     pass
 admin.site.register(FindingAid, FindingAidAdmin)
 
+class ControlTermAdmin(admin.ModelAdmin):
+    list_display = ['term', 'control_type', 'link']
+    list_filter = ['control_type']
+    search_fields = ['term']
+admin.site.register(ControlTerm, ControlTermAdmin)
+
 class ControlAccessAdmin(admin.ModelAdmin):
-    pass
+    raw_id_fields = ['finding_aid', 'control_term']
 admin.site.register(ControlAccess, ControlAccessAdmin)
 
 class FindingAidAuditAdmin(admin.ModelAdmin):
@@ -39,4 +51,12 @@ admin.site.register(FindingAidAudit, FindingAidAuditAdmin)
 
 class SubjectHeaderAdmin(admin.ModelAdmin):
     pass
-admin.site.register(SubjectHeader, SubjectHeaderAdmin)
\ No newline at end of file
+admin.site.register(SubjectHeader, SubjectHeaderAdmin)
+
+class SearchOutboxAdmin(admin.ModelAdmin):
+    list_display = ['findingAidID', 'operation', 'components', 'attempts', 'available_at']
+admin.site.register(SearchOutbox, SearchOutboxAdmin)
+
+class SearchCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['name', 'position', 'last_run']
+admin.site.register(SearchCheckpoint, SearchCheckpointAdmin)
@@ -0,0 +1,164 @@
+from html.entities import name2codepoint
+from xml.etree import ElementTree
+
+# Streaming EAD support
+#
+# EAD files can run to hundreds of megabytes, so rather than building a full tree of the
+# document the reader walks it with iterparse and hands each piece of the finding aid over
+# as soon as it is complete.  Once a <cXX> component has been handed over it is removed
+# from the tree, so memory is bounded by the front matter plus the open component chain
+# instead of by the size of the file.
+
+# <c> and <c01> through <c12>
+COMPONENT_TAGS = frozenset(['c'] + ['c%02d' % level for level in range(1, 13)])
+
+# Elements handed over as 'field' events so the first occurrence can be used to fill in
+# anything missing from the high level <did>
+FIELD_TAGS = frozenset(['accessrestrict', 'userestrict', 'prefercite', 'bioghist', 'scopecontent',
+                        'custodhist', 'acqinfo', 'processinfo', 'originalsloc'])
+
+class EADReader:
+    '''
+    Iterates an EAD file as (event, element, depth) tuples:
+
+      archdesc      - the high level <did> of the <archdesc>
+      component     - a <cXX> holding its own <did> and notes, before any child component
+      chronitem     - each <chronitem>
+      controlaccess - each outermost <controlaccess>
+      dao           - each <dao>
+      field         - each element named in FIELD_TAGS
+
+    depth is the component nesting level (1 for <c01>) and 0 outside the <dsc>.  Elements
+    are only valid until the next item is requested.
+    '''
+
+    def __init__(self, source, field_tags=FIELD_TAGS):
+        self.source = source
+        self.field_tags = field_tags
+
+    def __iter__(self):
+        stack = []
+        # One entry per open component, True once it has been handed over
+        emitted = []
+
+        for event, elem in ElementTree.iterparse(self.source, events=('start', 'end'), parser=make_parser()):
+            if event == 'start':
+                strip_namespace(elem)
+
+                if elem.tag in COMPONENT_TAGS:
+                    # A child component is starting so the parent's own content is complete
+                    if emitted and not emitted[-1]:
+                        emitted[-1] = True
+                        yield 'component', component_parent(stack), len(emitted)
+                    emitted.append(False)
+
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            parent = stack[-1] if stack else None
+            tag = elem.tag
+
+            if tag == 'did' and parent is not None and parent.tag == 'archdesc':
+                yield 'archdesc', elem, 0
+            elif tag == 'chronitem':
+                yield 'chronitem', elem, len(emitted)
+            elif tag == 'controlaccess':
+                if parent is None or parent.tag != 'controlaccess':
+                    yield 'controlaccess', elem, len(emitted)
+            elif tag == 'dao':
+                yield 'dao', elem, len(emitted)
+            elif tag in self.field_tags:
+                yield 'field', elem, len(emitted)
+
+            if tag in COMPONENT_TAGS:
+                if not emitted[-1]:
+                    yield 'component', elem, len(emitted)
+                emitted.pop()
+
+                # The component and everything below it has been handed over, let it go
+                elem.clear()
+                if parent is not None:
+                    parent.remove(elem)
+
+def component_parent(stack):
+    for elem in reversed(stack):
+        if elem.tag in COMPONENT_TAGS:
+            return elem
+    return None
+
+def make_parser():
+    parser = ElementTree.XMLParser()
+
+    # Most EAD files declare the EAD DTD, which expat does not load, so the HTML named
+    # entities they tend to use (&nbsp; and friends) are supplied here
+    try:
+        parser.entity.update((name, chr(code)) for name, code in name2codepoint.items())
+    except AttributeError:
+        pass
+
+    return parser
+
+def local_name(name):
+    if name[:1] == '{':
+        return name.split('}', 1)[1]
+    return name
+
+def strip_namespace(elem):
+    # EAD may or may not be namespaced (and links are often xlink:href), the parsing
+    # works on bare names
+    elem.tag = local_name(elem.tag)
+    if elem.attrib:
+        for key in [key for key in elem.attrib if key[:1] == '{']:
+            elem.attrib[local_name(key)] = elem.attrib.pop(key)
+
+# Element helpers used by the parsing in models.py.  find/find_all search the element
+# and its descendants in document order.
+
+def find(elem, tag):
+    if elem is None:
+        return None
+    return next(elem.iter(tag), None)
+
+def find_all(elem, tag):
+    if elem is None:
+        return []
+    return list(elem.iter(tag))
+
+def index_elements(elem):
+    # A single pass over the element and its descendants, {tag: [elements in document order]}
+    index = {}
+    for child in elem.iter():
+        index.setdefault(child.tag, []).append(child)
+    return index
+
+def first(index, tag):
+    elements = index.get(tag)
+    return elements[0] if elements else None
+
+def get_text(elem):
+    return ''.join(elem.itertext())
+
+def get_string(elem):
+    # Like BeautifulSoup's .string, the text of an element only if it holds a single string
+    if elem is None:
+        return None
+    if len(elem) == 0:
+        return elem.text or None
+    if len(elem) == 1 and not elem.text and not elem[0].tail:
+        return get_string(elem[0])
+    return None
+
+def to_markup(elem):
+    tail = elem.tail
+    elem.tail = None
+    try:
+        return ElementTree.tostring(elem, encoding='unicode', method='html')
+    finally:
+        elem.tail = tail
+
+def empty(elem):
+    # Drop the contents of an element but keep the text that follows it
+    tail = elem.tail
+    elem.clear()
+    elem.tail = tail
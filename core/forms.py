@@ -39,8 +39,10 @@ class MARCForm(ModelForm):
         fields = ('associated_file',)
         widgets = {'repository': forms.HiddenInput()}
 
-class PDFForm(forms.Form):
+class PDFForm(ModelForm):
+    # The text is read into scope_and_content by extract_pdfs (core/pdf.py)
     class Meta:
+        model = FindingAid
         fields = ('repository',
                   'record_type',
                   'title',
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+
+import threading, time
+
+# Finding aid page fragments
+#
+# The overview, chronology, control access and component parts of a finding aid's page are
+# cached in the 'fragments' cache by the {% cache %} tag, keyed on the finding aid's id and
+# its modified time.  modified changes whenever the finding aid is saved, and FindingAid.touch
+# changes it whenever one of its components, chronology, control access or subject header
+# rows is saved or deleted, so an edit is seen on the next view.  The fragments of the old
+# version are never asked for again and expire or are culled.
+#
+# Page views are counted in memory and added to FindingAid.view_count at most once every
+# FRAGMENT_VIEW_FLUSH seconds per process, so counting costs no write per view.  Counts not
+# yet flushed when a process stops are lost, view_count is only a guide to which pages
+# warm_fragments renders first.
+
+pending_views = {}
+pending_lock = threading.Lock()
+last_flush = time.monotonic()
+
+def fragment_timeout():
+    return caches['fragments'].default_timeout
+
+def record_view(pk):
+    global last_flush
+
+    with pending_lock:
+        pending_views[pk] = pending_views.get(pk, 0) + 1
+        if time.monotonic() - last_flush < getattr(settings, 'FRAGMENT_VIEW_FLUSH', 60):
+            return
+        views = dict(pending_views)
+        pending_views.clear()
+        last_flush = time.monotonic()
+
+    flush_views(views)
+
+def flush_views(views):
+    # One UPDATE for each distinct count rather than one per finding aid
+    from .models import FindingAid
+
+    by_count = {}
+    for pk, count in views.items():
+        by_count.setdefault(count, []).append(pk)
+    for count, pks in by_count.items():
+        FindingAid.objects.filter(pk__in=pks).update(view_count=F('view_count') + count)
@@ -0,0 +1,767 @@
+from django.conf import settings
+from django.core.files import File
+from django.db import OperationalError, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from lxml import etree
+from sickle import Sickle
+from sickle.oaiexceptions import BadResumptionToken, NoRecordsMatch
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from html.parser import HTMLParser
+from io import BytesIO
+from urllib.parse import unquote, urldefrag, urljoin, urlparse
+import asyncio, gzip, hashlib, os, queue, tempfile, threading, time, urllib.error, urllib.request
+
+from .ead import EADReader
+from .marc import control_number, read_marc
+
+# Harvesting
+#
+# A harvester fetches records on a fetching thread and hands them through a bounded queue to
+# the thread that called run(), which parses and writes them, so the next record or page is
+# downloaded while the current one is being loaded and a slow ingest holds back the fetching
+# rather than filling memory.
+#
+# Harvests are incremental.  Each record remembers the SHA-256 of what was loaded from it,
+# and a file its ETag and Last-Modified, so unchanged records are dropped before they are
+# parsed.  OAI-PMH harvests ask for records changed since the last harvest and record the
+# resumption token of every page fully loaded, so an interrupted harvest carries on from
+# there the next time.
+
+OAI_NAMESPACE = '{http://www.openarchives.org/OAI/2.0/}'
+
+# What the fetching thread hands over.  metadata is None for deleted records and for files
+# that haven't changed since the last fetch.  Large files are written to disk rather than held
+# in memory, those have path set instead of metadata and are removed once loaded.  error is
+# set for a file that couldn't be fetched.
+Record = namedtuple('Record', 'identifier datestamp deleted metadata content_hash etag last_modified path error',
+                    defaults=[None, None])
+
+# Everything before it on the queue has been handed over.  token resumes the harvest from
+# here, date is the from date to use once the whole harvest is done.
+Checkpoint = namedtuple('Checkpoint', 'token date')
+
+# Marks the end of the records on the queue
+DONE = object()
+
+class HarvestError(Exception):
+    pass
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+class Harvester:
+    '''
+    Fetches records for a HarvestProfile and loads them into its repository.  Subclasses
+    provide records(), run on the fetching thread.
+    '''
+
+    def __init__(self, profile, user=None, queue_size=None, batch_size=None):
+        self.profile = profile
+        self.user = user
+        self.queue_size = queue_size or getattr(settings, 'HARVEST_QUEUE_SIZE', 50)
+        self.batch_size = batch_size
+        self.stopping = threading.Event()
+        self.counts = {'ingested': 0, 'deleted': 0, 'failed': 0, 'skipped': 0, 'unchanged': 0}
+
+    def records(self):
+        raise NotImplementedError
+
+    def fetch(self, items):
+        # Runs on the fetching thread
+        try:
+            for item in self.records():
+                if not self.put(items, item):
+                    return
+            self.put(items, DONE)
+        except Exception as e:
+            self.put(items, HarvestError(f'Harvest of {self.profile.location} stopped: {e}'))
+
+    def put(self, items, item):
+        # Waits for room on the queue unless the harvest is being stopped
+        while not self.stopping.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self, report=None):
+        '''
+        Harvests the profile, calling report(identifier, response) for each record if given.
+        Returns counts of the records ingested, deleted, failed, skipped and unchanged.
+        Raises HarvestError if fetching fails part way, after loading what came before.
+        '''
+        items = queue.Queue(maxsize=self.queue_size)
+        fetcher = threading.Thread(target=self.fetch, args=(items,), daemon=True)
+        fetcher.start()
+
+        try:
+            while True:
+                item = items.get()
+                if item is DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                if isinstance(item, Checkpoint):
+                    self.checkpoint(item)
+                    continue
+
+                try:
+                    response = self.load(item)
+                finally:
+                    if item.path:
+                        remove(item.path)
+                if report:
+                    report(item.identifier, response)
+        finally:
+            self.stopping.set()
+            fetcher.join()
+
+            # Files downloaded for records that were never loaded
+            while not items.empty():
+                item = items.get()
+                if isinstance(item, Record) and item.path:
+                    remove(item.path)
+
+        self.finish()
+        return self.counts
+
+    def checkpoint(self, checkpoint):
+        pass
+
+    def finish(self):
+        self.profile.last_harvest = timezone.now()
+        self.profile.save(update_fields=['last_harvest'])
+
+    def load(self, record):
+        from .models import FindingAid, HarvestRecord
+
+        harvested = HarvestRecord.objects.filter(profile=self.profile, identifier=record.identifier).select_related('finding_aid').first()
+        aid = harvested.finding_aid if harvested else None
+
+        if record.error:
+            self.counts['failed'] += 1
+            return record.error
+
+        if record.deleted:
+            if aid:
+                with transaction.atomic():
+                    aid.clear_contents()
+                    aid.delete()
+                    harvested.delete()
+                self.counts['deleted'] += 1
+                return "Deleted"
+            self.counts['skipped'] += 1
+            return "Skipped"
+
+        file_format = record_format(record.identifier, self.profile.default_format)
+
+        # The finding aids in a MARC file are recorded separately, see load_marc
+        marc_file = file_format == FindingAid.MARC and record.metadata is None
+        loaded = aid is not None or (marc_file and harvested is not None)
+
+        # Nothing new since the last harvest, it never reaches the parser
+        fetched = record.metadata is not None or record.path is not None
+        if loaded and (not fetched or record.content_hash == harvested.content_hash):
+            if record.etag is not None and (record.etag, record.last_modified) != (harvested.etag, harvested.last_modified):
+                # Touched but the same, so the next fetch can be answered with a 304
+                harvested.etag = record.etag
+                harvested.last_modified = record.last_modified
+                harvested.save(update_fields=['etag', 'last_modified'])
+            self.counts['unchanged'] += 1
+            return "Unchanged"
+
+        if not fetched:
+            self.counts['failed'] += 1
+            return "No metadata in the record"
+
+        if file_format == FindingAid.MARC:
+            try:
+                return self.load_marc(record, aid)
+            except Exception as e:
+                self.counts['failed'] += 1
+                return f'Unable to process the {record.identifier} file {e}'
+
+        if file_format == FindingAid.PDF and record.path is not None:
+            return self.load_pdf(record, aid)
+
+        if file_format != FindingAid.EAD:
+            self.counts['skipped'] += 1
+            return f'{dict(FindingAid.RECORD_TYPES)[file_format]} records can not be ingested yet'
+
+        if aid is None:
+            aid = FindingAid(record_type=FindingAid.EAD, repository=self.profile.repository)
+
+        with open_record(record) as source:
+            records = FindingAid.read_ead(EADReader(source))
+            response = FindingAid.make_ead(aid.pk or "new", records, aid, self.user, record.identifier, self.batch_size)
+
+        if response == "OK":
+            HarvestRecord.objects.update_or_create(profile=self.profile, identifier=record.identifier,
+                                                   defaults={'datestamp': record.datestamp or "",
+                                                             'finding_aid': aid,
+                                                             'etag': record.etag or "",
+                                                             'last_modified': record.last_modified or "",
+                                                             'content_hash': record.content_hash})
+            self.counts['ingested'] += 1
+        else:
+            self.counts['failed'] += 1
+
+        return response
+
+    def load_pdf(self, record, aid):
+        # Stores the file, its text is read by extract_pdfs (core/pdf.py)
+        from .models import FindingAid, HarvestRecord
+
+        name = unquote(os.path.basename(urlparse(record.identifier).path)) or 'finding_aid.pdf'
+        if aid is None:
+            aid = FindingAid(record_type=FindingAid.PDF, repository=self.profile.repository,
+                             title=os.path.splitext(name)[0][:255] or "No title")
+        aid.updated_by = self.user
+        aid.last_update = timezone.now()
+        # FieldFile.save commits the file before saving the row, so FindingAid.save can't tell
+        aid.file_changed()
+
+        with transaction.atomic():
+            with open(record.path, 'rb') as source:
+                aid.associated_file.save(name, File(source))
+            HarvestRecord.objects.update_or_create(profile=self.profile, identifier=record.identifier,
+                                                   defaults={'datestamp': record.datestamp or "",
+                                                             'finding_aid': aid,
+                                                             'etag': record.etag or "",
+                                                             'last_modified': record.last_modified or "",
+                                                             'content_hash': record.content_hash})
+        self.counts['ingested'] += 1
+        return "OK"
+
+    def load_marc(self, record, aid):
+        '''
+        Loads a MARC record, or every record of a MARC file.  The finding aid made from each
+        record of a file is recorded under identifier#control number and the file under its
+        identifier alone, so on the next harvest unchanged records are skipped and those no
+        longer in the file are deleted.
+        '''
+        from .models import FindingAid, HarvestRecord, MARCWriter
+
+        many = record.path is not None
+        if many:
+            prefix = record.identifier + '#'
+            known = {identifier: (finding_aid_id, digest) for identifier, finding_aid_id, digest in
+                     HarvestRecord.objects.filter(profile=self.profile, identifier__startswith=prefix)
+                                          .values_list('identifier', 'finding_aid_id', 'content_hash').iterator()}
+        else:
+            known = {record.identifier: (aid.pk if aid else None, None)}
+
+        writer = MARCWriter(self.profile.repository, self.user, self.batch_size)
+        seen = set()
+        counts = dict.fromkeys(('ingested', 'unchanged', 'failed', 'deleted'), 0)
+
+        def save(written):
+            identifiers = [identifier for (identifier, digest), written_aid in written]
+            HarvestRecord.objects.filter(profile=self.profile, identifier__in=identifiers).delete()
+            HarvestRecord.objects.bulk_create([HarvestRecord(profile=self.profile, identifier=identifier, finding_aid=written_aid,
+                                                             datestamp=record.datestamp or "", content_hash=digest)
+                                               for (identifier, digest), written_aid in written])
+            counts['ingested'] += len(written)
+
+        with open_record(record) as source:
+            for position, (marc, error) in enumerate(read_marc(source), 1):
+                if marc is None:
+                    counts['failed'] += 1
+                    continue
+
+                if many:
+                    identifier = prefix + (control_number(marc) or str(position))
+                    if identifier in seen:
+                        identifier = f'{prefix}{position}'
+                    digest = content_hash(marc.as_marc())
+                else:
+                    identifier, digest = record.identifier, record.content_hash
+                seen.add(identifier)
+
+                finding_aid_id, previous = known.get(identifier, (None, None))
+                if finding_aid_id and digest == previous:
+                    counts['unchanged'] += 1
+                    continue
+
+                save(writer.add(*FindingAid.from_marc(marc), replaces=finding_aid_id, tag=(identifier, digest)))
+            save(writer.flush())
+
+        if many:
+            # Left out of this version of the file, unless it couldn't all be read
+            gone = [identifier for identifier in known if identifier not in seen] if not counts['failed'] else []
+            for start in range(0, len(gone), 500):
+                with transaction.atomic():
+                    rows = HarvestRecord.objects.filter(profile=self.profile, identifier__in=gone[start:start + 500])
+                    for harvested in rows.select_related('finding_aid'):
+                        if harvested.finding_aid:
+                            harvested.finding_aid.delete()
+                            counts['deleted'] += 1
+                    rows.delete()
+
+            HarvestRecord.objects.update_or_create(profile=self.profile, identifier=record.identifier,
+                                                   defaults={'datestamp': record.datestamp or "",
+                                                             'finding_aid': None,
+                                                             'etag': record.etag or "",
+                                                             'last_modified': record.last_modified or "",
+                                                             'content_hash': record.content_hash})
+
+        for name, count in counts.items():
+            self.counts[name] += count
+
+        if not many:
+            return "OK" if counts['ingested'] else "No MARC record in the metadata"
+        return (f'{counts["ingested"]} records ingested, {counts["unchanged"]} unchanged, '
+                f'{counts["deleted"]} deleted, {counts["failed"]} could not be read')
+
+class OAIHarvester(Harvester):
+    '''
+    Harvests an OAI-PMH HarvestProfile.  from_date and until limit the harvest to records with
+    datestamps in that range.  Without from_date, records changed since the last complete
+    harvest are asked for, or an interrupted harvest is carried on.  full ignores both.
+    '''
+
+    def __init__(self, profile, user=None, from_date=None, until=None, full=False, **kwargs):
+        super().__init__(profile, user, **kwargs)
+        self.from_date = from_date
+        self.until = until
+        self.full = full
+
+        # Only a harvest of everything changed since the last one moves the checkpoint on
+        self.incremental = not from_date and not until
+
+    def metadata_prefix(self):
+        prefixes = getattr(settings, 'OAI_METADATA_PREFIXES', {'E': 'ead', 'M': 'marc21'})
+        return prefixes.get(self.profile.default_format, 'ead')
+
+    def list_records(self, sickle):
+        params = {'metadataPrefix': self.metadata_prefix(), 'ignore_deleted': False}
+
+        if self.incremental and not self.full:
+            if self.profile.resumption_token:
+                try:
+                    return sickle.ListRecords(resumptionToken=self.profile.resumption_token, ignore_deleted=False), self.profile.resumption_date
+                except BadResumptionToken:
+                    # Expired, start again from the last complete harvest
+                    pass
+            if self.profile.last_datestamp:
+                params['from'] = self.profile.last_datestamp
+        else:
+            if self.from_date:
+                params['from'] = self.from_date
+            if self.until:
+                params['until'] = self.until
+
+        records = sickle.ListRecords(**params)
+
+        # The next harvest picks up from the day this one started, at day granularity as every
+        # repository supports it.  Records seen again are dropped as unchanged.
+        response_date = records.oai_response.xml.findtext(OAI_NAMESPACE + 'responseDate') or ""
+        return records, response_date[:10]
+
+    def records(self):
+        sickle = Sickle(self.profile.location,
+                        max_retries=getattr(settings, 'OAI_MAX_RETRIES', 3),
+                        timeout=getattr(settings, 'OAI_TIMEOUT', 60))
+
+        try:
+            records, date = self.list_records(sickle)
+        except NoRecordsMatch:
+            return
+
+        token = records.resumption_token.token if records.resumption_token else None
+        for record in records:
+            # A new page has been fetched, so every record of the one before has been handed over
+            current = records.resumption_token.token if records.resumption_token else None
+            if current != token:
+                yield Checkpoint(token, date)
+                token = current
+
+            metadata = digest = None
+            if not record.deleted:
+                container = record.xml.find(OAI_NAMESPACE + 'metadata')
+                if container is not None and len(container):
+                    metadata = etree.tostring(container[0])
+                    digest = content_hash(metadata)
+
+            yield Record(record.header.identifier, record.header.datestamp, record.deleted, metadata, digest, None, None)
+
+        yield Checkpoint(None, date)
+
+    def checkpoint(self, checkpoint):
+        if not self.incremental:
+            return
+
+        if checkpoint.token:
+            self.profile.resumption_token = checkpoint.token
+            self.profile.resumption_date = checkpoint.date
+        else:
+            # Finished, the next harvest starts from when this one did
+            self.profile.resumption_token = ""
+            self.profile.resumption_date = ""
+            if checkpoint.date:
+                self.profile.last_datestamp = checkpoint.date
+        self.profile.save(update_fields=['resumption_token', 'resumption_date', 'last_datestamp'])
+
+class FileHarvester(Harvester):
+    '''
+    Harvests the single file a File HarvestProfile points at, only downloading it again if
+    the server says it has changed.
+    '''
+
+    def __init__(self, profile, user=None, **kwargs):
+        from .models import FindingAid, HarvestRecord
+
+        super().__init__(profile, user, **kwargs)
+
+        # Read here rather than on the fetching thread, which doesn't use the database.  MARC
+        # files are loaded once their own record exists, the finding aids are on their records.
+        rows = (HarvestRecord.objects.filter(profile=profile).exclude(identifier__contains='#')
+                                     .values_list('identifier', 'finding_aid_id', 'datestamp', 'etag', 'last_modified'))
+        self.known = {identifier: (datestamp, etag, last_modified)
+                      for identifier, finding_aid_id, datestamp, etag, last_modified in rows.iterator()
+                      if finding_aid_id or record_format(identifier, profile.default_format) == FindingAid.MARC}
+
+    def records(self):
+        yield self.fetch_file(self.profile.location)
+
+    def fetch_file(self, url, lastmod=None):
+        datestamp, etag, last_modified = self.known.get(url, ("", "", ""))
+
+        # The sitemap says it hasn't changed since it was loaded
+        if lastmod and lastmod == datestamp:
+            return Record(url, lastmod, False, None, None, None, None)
+
+        path, digest, etag, last_modified = download(url, etag, last_modified)
+        return Record(url, lastmod, False, None, digest, etag, last_modified, path)
+
+class CrawlHarvester(FileHarvester):
+    '''
+    Harvests the files listed in a Sitemap profile's sitemap, following sitemap indexes, or
+    linked from a Directory profile's listing and the listings below it.
+
+    Listings and files are fetched by HARVEST_CONNECTIONS asyncio workers, at most
+    HARVEST_HOST_CONNECTIONS at a time from one host and no more often than one request
+    every HARVEST_DELAY seconds per host.  Each transfer runs on a thread with urllib.
+    '''
+
+    def fetch(self, items):
+        # Runs on the fetching thread
+        try:
+            asyncio.run(self.crawl(items))
+            self.put(items, DONE)
+        except Exception as e:
+            self.put(items, HarvestError(f'Harvest of {self.profile.location} stopped: {e}'))
+
+    async def crawl(self, items):
+        from .models import HarvestProfile
+
+        workers = getattr(settings, 'HARVEST_CONNECTIONS', 8)
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+
+        self.connections = asyncio.Semaphore(workers)
+        self.hosts = {}
+
+        work = asyncio.Queue()
+        seen = set()
+
+        def add(kind, url, lastmod=None, depth=0):
+            url = urldefrag(url)[0]
+            if url not in seen:
+                seen.add(url)
+                work.put_nowait((kind, url, lastmod, depth))
+
+        add('sitemap' if self.profile.harvest_type == HarvestProfile.SITEMAP else 'listing', self.profile.location)
+
+        tasks = [asyncio.create_task(self.worker(work, items, add)) for _ in range(workers)]
+        await work.join()
+        for task in tasks:
+            task.cancel()
+
+    async def worker(self, work, items, add):
+        while True:
+            kind, url, lastmod, depth = await work.get()
+            try:
+                if self.stopping.is_set():
+                    continue
+                if kind == 'sitemap':
+                    for kind, url, lastmod in parse_sitemap(url, await self.request(url, read_url)):
+                        add(kind, url, lastmod)
+                elif kind == 'listing':
+                    for kind, url in parse_listing(url, self.profile.location, await self.request(url, read_url)):
+                        if kind == 'file' or depth < getattr(settings, 'HARVEST_MAX_DEPTH', 10):
+                            add(kind, url, None, depth + 1)
+                else:
+                    await self.hand_over(items, await self.request(url, self.fetch_file, lastmod))
+            except Exception as e:
+                await self.hand_over(items, Record(url, lastmod, False, None, None, None, None, error=str(e)))
+            finally:
+                work.task_done()
+
+    async def request(self, url, function, *args):
+        host = self.hosts.setdefault(urlparse(url).netloc, Host())
+
+        async with self.connections, host.connections:
+            async with host.lock:
+                wait = host.next_request - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                host.next_request = time.monotonic() + getattr(settings, 'HARVEST_DELAY', 0.5)
+
+            return await asyncio.to_thread(function, url, *args)
+
+    async def hand_over(self, items, record):
+        # Waits on a thread for room on the queue, so the other workers carry on meanwhile
+        if not await asyncio.to_thread(self.put, items, record) and record.path:
+            remove(record.path)
+
+class Host:
+    # Connection limit and politeness delay for one host
+
+    def __init__(self):
+        self.connections = asyncio.Semaphore(getattr(settings, 'HARVEST_HOST_CONNECTIONS', 2))
+        self.lock = asyncio.Lock()
+        self.next_request = 0
+
+def parse_sitemap(url, data):
+    # ('sitemap', url, None) for each sitemap in a sitemap index, ('file', url, lastmod) for each
+    # page in a sitemap
+    if url.endswith('.gz'):
+        data = gzip.decompress(data)
+
+    for element in etree.fromstring(data, parser=etree.XMLParser(resolve_entities=False)):
+        if not isinstance(element.tag, str):
+            continue
+        kind = etree.QName(element).localname
+        fields = {etree.QName(child).localname: (child.text or "").strip() for child in element if isinstance(child.tag, str)}
+        if fields.get('loc') and kind in ('sitemap', 'url'):
+            yield ('sitemap' if kind == 'sitemap' else 'file'), urljoin(url, fields['loc']), fields.get('lastmod') or None
+
+class LinkParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+def parse_listing(url, root, data):
+    # ('listing', url) for each directory below root linked from a directory listing, and
+    # ('file', url) for each file with one of the HARVEST_EXTENSIONS
+    parser = LinkParser()
+    parser.feed(data.decode('utf-8', 'replace'))
+
+    extensions = tuple(getattr(settings, 'HARVEST_EXTENSIONS', ('.xml', '.mrc', '.marc', '.pdf')))
+    base = root if root.endswith('/') else root.rsplit('/', 1)[0] + '/'
+
+    for href in parser.links:
+        link = urldefrag(urljoin(url, href))[0]
+        # Sort links, parent directories and anything off site
+        if '?' in link or not link.startswith(base) or len(link) <= len(url):
+            continue
+        if link.endswith('/'):
+            yield 'listing', link
+        elif urlparse(link).path.lower().endswith(extensions):
+            yield 'file', link
+
+def record_format(identifier, default):
+    # The kind of finding aid a file holds, by its extension
+    from .models import FindingAid
+
+    path = urlparse(identifier).path.lower()
+    if path.endswith('.pdf'):
+        return FindingAid.PDF
+    if path.endswith(('.mrc', '.marc')):
+        return FindingAid.MARC
+    return default
+
+def open_record(record):
+    if record.path:
+        return open(record.path, 'rb')
+    return BytesIO(record.metadata)
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def user_agent():
+    return getattr(settings, 'HARVEST_USER_AGENT', 'NAFAN harvester')
+
+def read_url(url):
+    # Listings and sitemaps, small enough to read into memory
+    request = urllib.request.Request(url, headers={'User-Agent': user_agent()})
+    with urllib.request.urlopen(request, timeout=getattr(settings, 'OAI_TIMEOUT', 60)) as response:
+        return response.read()
+
+def download(url, etag="", last_modified="", timeout=None):
+    '''
+    Streams url to a file in HARVEST_DIR, sending the validators from the last fetch.
+    Returns the path, the SHA-256 of the body and the validators to send next time, or a
+    path of None if the server says it hasn't changed.
+    '''
+    request = urllib.request.Request(url, headers={'User-Agent': user_agent()})
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if last_modified:
+        request.add_header('If-Modified-Since', last_modified)
+
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout or getattr(settings, 'OAI_TIMEOUT', 60))
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, None, etag, last_modified
+        raise
+
+    directory = getattr(settings, 'HARVEST_DIR', None) or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+
+    digest = hashlib.sha256()
+    with response, tempfile.NamedTemporaryFile(dir=directory, prefix='harvest-', delete=False) as out:
+        try:
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+        except BaseException:
+            out.close()
+            remove(out.name)
+            raise
+
+    return out.name, digest.hexdigest(), response.headers.get('ETag', ""), response.headers.get('Last-Modified', "")
+
+def harvester_for(profile, user=None, full=False, from_date=None, until=None, **kwargs):
+    # The harvester for the profile's harvest type
+    from .models import HarvestProfile
+
+    if profile.harvest_type == HarvestProfile.OAI:
+        return OAIHarvester(profile, user, from_date, until, full, **kwargs)
+    if profile.harvest_type == HarvestProfile.FILE:
+        return FileHarvester(profile, user, **kwargs)
+    return CrawlHarvester(profile, user, **kwargs)
+
+# Harvest jobs
+#
+# Harvests never run in a web request.  Users and the schedule queue HarvestJobs, which the
+# harvest_worker command claims and runs.  At most HARVEST_MAX_JOBS run at once across all
+# workers, and HARVEST_REPOSITORY_JOBS for any one repository.  Waiting jobs are taken shortest
+# first, going by how long the profile's last harvest took, so one large repository doesn't
+# hold up everyone else's small ones.
+
+def queue_harvest(profile, user=None, full=False):
+    # The job already waiting for profile, or a new one
+    from .models import HarvestJob
+
+    waiting = HarvestJob.objects.filter(profile=profile, status=HarvestJob.QUEUED).first()
+    if waiting:
+        return waiting
+
+    last = HarvestJob.objects.filter(profile=profile, status=HarvestJob.FINISHED).order_by('-finished').first()
+    estimate = int(last.duration().total_seconds()) if last else 0
+    return HarvestJob.objects.create(profile=profile, user=user, full=full, estimate=estimate)
+
+def schedule_harvests(now=None):
+    # Queues a job for every profile whose next harvest is due, returns how many were queued
+    from .models import HarvestJob, HarvestProfile
+
+    now = now or timezone.now()
+    due = HarvestProfile.objects.filter(harvest_interval__isnull=False).filter(Q(next_harvest__isnull=True) | Q(next_harvest__lte=now))
+
+    queued = 0
+    for profile in due:
+        if not HarvestJob.objects.filter(profile=profile, status__in=[HarvestJob.QUEUED, HarvestJob.RUNNING]).exists():
+            queue_harvest(profile)
+            queued += 1
+        profile.next_harvest = now + timedelta(hours=profile.harvest_interval)
+        profile.save(update_fields=['next_harvest'])
+    return queued
+
+def claim_job(worker):
+    '''
+    Claims the next waiting job that fits under the concurrency limits for worker, or returns
+    None.  The limits are checked just before claiming, so workers claiming at the same moment
+    can go over them by a job each.
+    '''
+    from .models import HarvestJob
+
+    running = HarvestJob.objects.filter(status=HarvestJob.RUNNING)
+    if running.count() >= getattr(settings, 'HARVEST_MAX_JOBS', 4):
+        return None
+
+    per_repository = getattr(settings, 'HARVEST_REPOSITORY_JOBS', 1)
+    busy = [repository for repository, jobs in running.values_list('profile__repository').annotate(jobs=Count('pk'))
+            if jobs >= per_repository]
+
+    waiting = (HarvestJob.objects.filter(status=HarvestJob.QUEUED)
+                                 .exclude(profile__repository__in=busy)
+                                 .exclude(profile__in=running.values('profile'))
+                                 .order_by('estimate', 'queued'))
+
+    for job in waiting[:10]:
+        now = timezone.now()
+        # Only one worker's update finds it still queued
+        if HarvestJob.objects.filter(pk=job.pk, status=HarvestJob.QUEUED).update(status=HarvestJob.RUNNING, worker=worker,
+                                                                                 started=now, heartbeat=now):
+            job.refresh_from_db()
+            return job
+    return None
+
+def fail_stale_jobs():
+    # Jobs whose worker has gone without a heartbeat for HARVEST_JOB_TIMEOUT seconds
+    from .models import HarvestJob
+
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'HARVEST_JOB_TIMEOUT', 600))
+    return HarvestJob.objects.filter(status=HarvestJob.RUNNING, heartbeat__lt=cutoff).update(
+        status=HarvestJob.FAILED, finished=now, message="The worker running the harvest stopped responding")
+
+def run_job(job):
+    '''
+    Runs a claimed job, saving the counts on it every HARVEST_PROGRESS_INTERVAL seconds while
+    records are loaded.  Returns the job once it has finished or failed.
+    '''
+    from .models import HarvestJob
+
+    interval = getattr(settings, 'HARVEST_PROGRESS_INTERVAL', 5)
+    saved = time.monotonic()
+
+    def progress(counts, identifier):
+        try:
+            HarvestJob.objects.filter(pk=job.pk).update(last_record=identifier[:255], **counts)
+        except OperationalError:
+            # Locked by another writer (SQLite), the counts are saved again next interval
+            pass
+
+    def report(identifier, response):
+        nonlocal saved
+        if time.monotonic() - saved >= interval:
+            progress(harvester.counts, identifier)
+            saved = time.monotonic()
+
+    harvester = None
+    try:
+        harvester = harvester_for(job.profile, job.user, job.full)
+        harvester.run(report)
+        job.status, job.message = HarvestJob.FINISHED, ""
+    except Exception as e:
+        job.status, job.message = HarvestJob.FAILED, str(e) or e.__class__.__name__
+
+    for name, count in (harvester.counts if harvester else {}).items():
+        setattr(job, name, count)
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'message', 'finished', 'ingested', 'unchanged', 'deleted', 'failed', 'skipped'])
+    return job
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import FindingAid, Repository
+
+import os, tempfile, time
+
+class Command(BaseCommand):
+    """Time EAD ingestion"""
+    help = "Time EAD ingestion of a file, or of a generated file, and roll it back"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ead_file", nargs="?", help="EAD file to ingest, one is generated if not given", type=str
+        )
+        parser.add_argument(
+            "--components", help="number of components in the generated file", type=int, default=10000
+        )
+        parser.add_argument(
+            "--batch-size", help="components per bulk insert", type=int, default=None
+        )
+
+    def handle(self, *args, **options):
+        ead_file = options.get("ead_file")
+        generated = None
+
+        if not ead_file:
+            generated = tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False, encoding='utf8')
+            write_ead(generated, options.get("components"))
+            generated.close()
+            ead_file = generated.name
+
+        try:
+            with transaction.atomic():
+                repository = Repository.objects.create(name="Ingest benchmark", slug="ingest-benchmark")
+
+                start = time.perf_counter()
+                response = FindingAid.ead_index("new", repository, ead_file, None, options.get("batch_size"))
+                elapsed = time.perf_counter() - start
+
+                count = FindingAid.objects.filter(repository=repository).count()
+
+                # Nothing from the benchmark is kept
+                transaction.set_rollback(True)
+
+            print(response)
+            print(f'{count} records in {elapsed:.2f}s, {count / elapsed:.0f} records/s')
+
+        finally:
+            if generated:
+                os.unlink(generated.name)
+
+def write_ead(out, components):
+    # Series of 20 components: a <c01> holding nine <c02> files with a <c03> item each, plus a spare <c02>
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<ead><eadheader><eadid>benchmark</eadid></eadheader>\n')
+    out.write('<archdesc level="collection"><did><unittitle>Benchmark</unittitle><unitdate>1900-1950</unitdate></did>\n')
+    out.write('<scopecontent><p>Generated for benchmarking.</p></scopecontent>\n')
+    out.write('<controlaccess><subject>Benchmarks</subject><persname>Smith, John</persname></controlaccess>\n<dsc>\n')
+
+    for series in range(max(components // 20, 1)):
+        out.write(f'<c01 level="series"><did><unittitle>Series {series}</unittitle><unitid>S{series}</unitid></did>'
+                  f'<scopecontent><p>Series {series}</p></scopecontent>\n')
+        for file in range(9):
+            out.write(f'<c02><did><container type="box">{file}</container><unittitle>File {series}.{file}</unittitle>'
+                      f'<unitdate>19{file:02d}</unitdate></did><c03><did><unittitle>Item</unittitle></did></c03></c02>\n')
+        out.write('<c02><did><unittitle>Miscellany</unittitle></did></c02></c01>\n')
+
+    out.write('</dsc></archdesc></ead>\n')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from core.search import drain_outbox
+
+import time
+
+class Command(BaseCommand):
+    """Send queued finding aid changes to the search engine"""
+    help = "Send queued finding aid changes from the search outbox to Elasticsearch"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once", help="empty the outbox and stop rather than keep polling", action="store_true"
+        )
+        parser.add_argument(
+            "--interval", help="seconds to wait when the outbox is empty", type=float, default=5
+        )
+        parser.add_argument(
+            "--batch-size", help="outbox entries per batch", type=int, default=None
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            handled, retrying = drain_outbox(options.get("batch_size"))
+            if handled:
+                print(f'{handled - retrying} sent, {retrying} to retry')
+
+            if not handled or retrying == handled:
+                if options.get("once"):
+                    break
+                time.sleep(options.get("interval"))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from core.pdf import extract_finding_aid, pending_pdfs
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import time
+
+class Command(BaseCommand):
+    """Extract the text of PDF finding aids"""
+    help = "Read the text of uploaded PDF finding aids into their scope and content and the search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", help="processes extracting pages at once, the number of CPUs if not given", type=int, default=None
+        )
+        parser.add_argument(
+            "--once", help="extract the PDFs waiting and stop rather than keep polling", action="store_true"
+        )
+        parser.add_argument(
+            "--interval", help="seconds between looking for newly uploaded PDFs", type=float, default=30
+        )
+
+    def handle(self, *args, **options):
+        pool = ProcessPoolExecutor(max_workers=options.get("workers"))
+        try:
+            while True:
+                for aid in pending_pdfs().order_by('pk'):
+                    started = time.perf_counter()
+                    try:
+                        extracted = extract_finding_aid(aid, pool)
+                    except BrokenProcessPool as e:
+                        # A worker died, the files still to do get a new pool
+                        print(f'{aid.pk}\t{aid.title}\tunable to extract {e}, tried again later')
+                        pool.shutdown(wait=False)
+                        pool = ProcessPoolExecutor(max_workers=options.get("workers"))
+                        continue
+                    except Exception as e:
+                        # Tried again later, up to PDF_EXTRACT_ATTEMPTS times
+                        print(f'{aid.pk}\t{aid.title}\tunable to extract {e}')
+                        continue
+                    print(f'{aid.pk}\t{aid.title}\t{extracted} ranges of pages extracted in {time.perf_counter() - started:.1f}s')
+
+                if options.get("once"):
+                    break
+                time.sleep(options.get("interval"))
+        finally:
+            pool.shutdown()
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.harvest import HarvestError, harvester_for
+from core.models import HarvestProfile, User
+
+class Command(BaseCommand):
+    """Harvest a profile"""
+    help = "Harvest the finding aids of a harvest profile into its repository"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "profile", help="id of the harvest profile", type=int
+        )
+        parser.add_argument(
+            "--from", dest="from_date", help="only records changed on or after this date (YYYY-MM-DD)", type=str, default=None
+        )
+        parser.add_argument(
+            "--until", help="only records changed on or before this date (YYYY-MM-DD)", type=str, default=None
+        )
+        parser.add_argument(
+            "--full", help="ask for every record rather than those changed since the last harvest", action="store_true"
+        )
+        parser.add_argument(
+            "--batch-size", help="components per bulk insert", type=int, default=None
+        )
+        parser.add_argument(
+            "--user", help="email of the user recorded as doing the update", type=str, default=None
+        )
+
+    def handle(self, *args, **options):
+        try:
+            profile = HarvestProfile.objects.select_related('repository').get(pk=options.get("profile"))
+            user = User.objects.get(email=options["user"]) if options.get("user") else None
+        except (HarvestProfile.DoesNotExist, User.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        harvester = harvester_for(profile, user, options.get("full"), options.get("from_date"), options.get("until"),
+                                  batch_size=options.get("batch_size"))
+
+        try:
+            counts = harvester.run(report=lambda identifier, response: print(f'{identifier}\t{response}'))
+        except HarvestError as e:
+            counts = harvester.counts
+            self.print_counts(counts)
+            raise CommandError(str(e))
+
+        self.print_counts(counts)
+
+    def print_counts(self, counts):
+        print(f'{counts["ingested"]} ingested, {counts["unchanged"]} unchanged, {counts["deleted"]} deleted, '
+              f'{counts["failed"]} failed, {counts["skipped"]} skipped')
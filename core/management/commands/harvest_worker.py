@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.utils import timezone
+
+from core.harvest import claim_job, fail_stale_jobs, run_job, schedule_harvests
+from core.models import HarvestJob
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os, signal, socket, threading
+
+class Command(BaseCommand):
+    """Run queued and scheduled harvests"""
+    help = "Queue the harvests that are due and run queued harvest jobs until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--jobs", help="harvests this worker runs at once, by default 1 on SQLite and 2 otherwise", type=int, default=None
+        )
+        parser.add_argument(
+            "--interval", help="seconds between looking for new jobs", type=float, default=10
+        )
+        parser.add_argument(
+            "--once", help="run the jobs waiting and stop rather than keep polling", action="store_true"
+        )
+        parser.add_argument(
+            "--no-schedule", help="only run jobs, leave queueing scheduled harvests to another worker", action="store_true"
+        )
+
+    def handle(self, *args, **options):
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        # SQLite allows one writer at a time, and a harvest writes for as long as it runs
+        slots = max(options.get("jobs") or (1 if connection.vendor == 'sqlite' else 2), 1)
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            # Finish the running jobs, a second signal stops at once
+            print('Stopping once the running harvests finish')
+            stopping.set()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        def run(job):
+            try:
+                return run_job(job)
+            finally:
+                connection.close()
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=slots) as pool:
+            while True:
+                for future in [future for future in running if future.done()]:
+                    job = future.result()
+                    del running[future]
+                    print(f'{job.profile}\t{job.get_status_display()}\t{job.processed()} records\t{job.message}')
+
+                busy = False
+                try:
+                    # Lets the other workers know these are still alive
+                    if running:
+                        HarvestJob.objects.filter(pk__in=[job.pk for job in running.values()]).update(heartbeat=timezone.now())
+
+                    if not stopping.is_set():
+                        failed = fail_stale_jobs()
+                        if failed:
+                            print(f'{failed} abandoned jobs failed')
+                        if not options.get("no_schedule"):
+                            queued = schedule_harvests()
+                            if queued:
+                                print(f'{queued} scheduled harvests queued')
+
+                        while len(running) < slots:
+                            job = claim_job(name)
+                            if job is None:
+                                break
+                            print(f'{job.profile}\tstarted')
+                            running[pool.submit(run, job)] = job
+                except OperationalError as e:
+                    # The database is locked by a harvest writing (SQLite), tried again after
+                    # the interval.  A heartbeat missed now and then is well inside the timeout.
+                    print(f'Database busy, trying again: {e}')
+                    busy = True
+
+                if stopping.is_set():
+                    if not running:
+                        break
+                elif options.get("once") and not running and not busy:
+                    break
+
+                if running:
+                    wait(running, timeout=options.get("interval"), return_when=FIRST_COMPLETED)
+                else:
+                    stopping.wait(options.get("interval"))
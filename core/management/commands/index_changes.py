@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.search import index_changes
+
+class Command(BaseCommand):
+    """Index the finding aids changed since the last run"""
+    help = "Send finding aids, components and control access terms changed since the last successful run to Elasticsearch"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--name", help="checkpoint to read and move on, one per sync", type=str, default="default"
+        )
+        parser.add_argument(
+            "--since", help="ISO date and time to index changes from instead of the checkpoint", type=str, default=None
+        )
+        parser.add_argument(
+            "--batch-size", help="documents per _bulk request", type=int, default=None
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options.get("since"):
+            since = parse_datetime(options["since"])
+            if since is None:
+                raise CommandError(f'Not a date and time: {options["since"]}')
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        succeeded, failed = index_changes(options.get("name"), since, options.get("batch_size"))
+
+        for action, error in failed[:20]:
+            print(f'{action["_id"]}\t{error}')
+        print(f'{succeeded} documents indexed, {len(failed)} failed')
+
+        if failed:
+            raise CommandError('Checkpoint left where it was, the next run will send these again')
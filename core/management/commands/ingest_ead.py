@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.ead import EADReader
+from core.models import FindingAid, Repository, User
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import django, os
+
+class Command(BaseCommand):
+    """Ingest EAD files"""
+    help = "Ingest a set of EAD files, parsing them in a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "repository", help="slug of the repository the finding aids belong to", type=str
+        )
+        parser.add_argument(
+            "paths", nargs="+", help="EAD files, or directories to search for .xml files", type=str
+        )
+        parser.add_argument(
+            "--workers", help="number of parsing processes", type=int, default=os.cpu_count()
+        )
+        parser.add_argument(
+            "--batch-size", help="components per bulk insert", type=int, default=None
+        )
+        parser.add_argument(
+            "--user", help="email of the user recorded as doing the update", type=str, default=None
+        )
+
+    def handle(self, *args, **options):
+        try:
+            repository = Repository.objects.get(slug=options.get("repository"))
+            user = User.objects.get(email=options["user"]) if options.get("user") else None
+        except (Repository.DoesNotExist, User.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        batch_size = options.get("batch_size")
+        workers = max(options.get("workers") or 1, 1)
+        prefetch = getattr(settings, 'INGEST_PREFETCH_SIZE', 16 * 1024 * 1024)
+        files = iter(ead_files(options.get("paths")))
+        succeeded = failed = 0
+
+        def load(filepath, records):
+            nonlocal succeeded, failed
+
+            aid = FindingAid(record_type=FindingAid.EAD, repository=repository)
+            response = FindingAid.make_ead("new", records, aid, user, filepath, batch_size)
+
+            if response == "OK":
+                succeeded += 1
+            else:
+                failed += 1
+            print(f'{filepath}\t{response}')
+
+        # Parsing is spread over the pool while this process does all of the database writes,
+        # one finding aid at a time, so the database only ever sees a single writer.  A worker
+        # hands back everything parsed from a file at once, so the files parsed ahead are kept
+        # to a couple per worker and prefetch bytes between them, and a file bigger than that
+        # is parsed here as it is written rather than by a worker.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            running = {}
+            queued = 0
+            filepath = next(files, None)
+
+            while True:
+                while filepath is not None and len(running) < workers * 2:
+                    size = file_size(filepath)
+                    if size > prefetch:
+                        load(filepath, stream(filepath))
+                    elif running and queued + size > prefetch:
+                        break
+                    else:
+                        running[pool.submit(read_file, filepath)] = (filepath, size)
+                        queued += size
+                    filepath = next(files, None)
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    done_path, size = running.pop(future)
+                    queued -= size
+                    records, error = future.result()
+                    load(done_path, replay(records, error))
+
+        print(f'{succeeded} files ingested, {failed} failed')
+
+def ead_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith('.xml'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def file_size(filepath):
+    # Unreadable files are left for the parse to report
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+def stream(filepath):
+    # Parses in this process a record at a time, for files too big to hand back from a worker
+    with open(filepath, 'rb') as ead_file:
+        yield from FindingAid.read_ead(EADReader(ead_file))
+
+def read_file(filepath):
+    # Runs in a worker, returns the parsed records and the error that stopped the parse
+    records = []
+    try:
+        with open(filepath, 'rb') as ead_file:
+            records.extend(FindingAid.read_ead(EADReader(ead_file)))
+    except Exception as e:
+        return records, str(e)
+    return records, None
+
+def replay(records, error):
+    # Hands the records to make_ead and raises where the parse failed, so the response
+    # is the same one ead_index would have given
+    yield from records
+    if error is not None:
+        raise ValueError(error)
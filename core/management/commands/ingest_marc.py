@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import FindingAid, Repository, User
+
+import os, time
+
+class Command(BaseCommand):
+    """Ingest MARC files"""
+    help = "Ingest every record of a set of MARC files as a finding aid, reading them one record at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "repository", help="slug of the repository the finding aids belong to", type=str
+        )
+        parser.add_argument(
+            "paths", nargs="+", help="MARC or MARCXML files, or directories to search for .mrc and .marc files", type=str
+        )
+        parser.add_argument(
+            "--batch-size", help="finding aids per bulk insert", type=int, default=None
+        )
+        parser.add_argument(
+            "--user", help="email of the user recorded as doing the update", type=str, default=None
+        )
+
+    def handle(self, *args, **options):
+        try:
+            repository = Repository.objects.get(slug=options.get("repository"))
+            user = User.objects.get(email=options["user"]) if options.get("user") else None
+        except (Repository.DoesNotExist, User.DoesNotExist) as e:
+            raise CommandError(str(e))
+
+        total = failed = 0
+        started = time.perf_counter()
+
+        for filepath in marc_files(options.get("paths")):
+            written, unreadable = FindingAid.marc_index(repository, filepath, user, options.get("batch_size"))
+            print(f'{filepath}\t{written} records ingested, {unreadable} could not be read')
+            total += written
+            failed += unreadable
+
+        elapsed = time.perf_counter() - started
+        print(f'{total} records ingested, {failed} failed, {total / elapsed if elapsed else 0:.0f} records/s')
+
+def marc_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                for name in sorted(names):
+                    if name.lower().endswith(('.mrc', '.marc')):
+                        yield os.path.join(root, name)
+        else:
+            yield path
@@ -0,0 +1,132 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from core.models import FindingAid
+from core.search import (bulk_index, bump_generation, create_versioned_index, document_id, finding_aid_document,
+                         finish_loading, get_client, index_changes, index_name, prune_deleted, swap_alias)
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import threading, time
+
+class Command(BaseCommand):
+    """Rebuild the search index"""
+    help = "Rebuild the search index into a new versioned index and move the alias over to it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", help="number of slices loaded in parallel", type=int, default=4
+        )
+        parser.add_argument(
+            "--batch-size", help="documents per _bulk request", type=int, default=None
+        )
+        parser.add_argument(
+            "--keep-old", help="keep the indexes the alias pointed at before", action="store_true"
+        )
+
+    def handle(self, *args, **options):
+        client = get_client()
+        alias = index_name()
+        workers = max(options.get("workers") or 1, 1)
+        started = timezone.now()
+
+        name = create_versioned_index(alias, client)
+        print(f'Loading {name}')
+
+        bounds = FindingAid.objects.aggregate(low=Min('pk'), high=Max('pk'))
+        slices = pk_slices(bounds['low'], bounds['high'], workers)
+
+        progress = Progress()
+        reporter = threading.Thread(target=progress.report, daemon=True)
+        reporter.start()
+
+        def load(bounds):
+            try:
+                return bulk_index(progress.count(slice_actions(name, *bounds)), batch_size=options.get("batch_size"),
+                                  client=client)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(load, slices))
+
+        progress.stop()
+        reporter.join()
+
+        succeeded = sum(result[0] for result in results)
+        failed = [failure for result in results for failure in result[1]]
+        for action, error in failed[:20]:
+            print(f'{action["_id"]}\t{error}')
+
+        if failed:
+            client.indices.delete(index=name)
+            raise CommandError(f'{len(failed)} documents could not be indexed, {alias} left as it was')
+
+        finish_loading(name, client)
+        previous = swap_alias(name, alias, client)
+        print(f'{succeeded} documents in {progress.elapsed():.0f}s, {alias} now points at {name}')
+
+        # Saves and deletes made during the load went to the old index through the alias.  The
+        # slices may also have read rows before transactions still open at the start committed.
+        since = started - timedelta(seconds=getattr(settings, 'ELASTICSEARCH_DELTA_OVERLAP', 60))
+        changed, failed = index_changes('reindex', since=since, batch_size=options.get("batch_size"), client=client)
+        pruned, prune_failed = prune_deleted(name, client=client)
+        failed += prune_failed
+        bump_generation()
+        print(f'{changed} documents changed and {pruned} deleted during the load')
+
+        for action, error in failed[:20]:
+            print(f'{action["_id"]}\t{error}')
+
+        if not options.get("keep_old"):
+            for index in previous:
+                client.indices.delete(index=index)
+                print(f'Removed {index}')
+
+        if failed:
+            raise CommandError(f'{len(failed)} documents changed during the load could not be brought up to date')
+
+def pk_slices(low, high, count):
+    # Contiguous primary key ranges, one per worker
+    if low is None:
+        return []
+    size = (high - low) // count + 1
+    return [(start, start + size) for start in range(low, high + 1, size)]
+
+def slice_actions(name, low, high):
+    aids = FindingAid.objects.filter(pk__gte=low, pk__lt=high).select_related('repository').order_by('pk')
+    for aid in aids.iterator(chunk_size=2000):
+        yield {'_op_type': 'index', '_index': name, '_id': document_id(aid),
+               '_source': finding_aid_document(aid, aid.repository)}
+
+class Progress:
+    # Counts documents handed to the bulk loaders and prints the rate while they run
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.total = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def count(self, actions):
+        for action in actions:
+            with self.lock:
+                self.total += 1
+            yield action
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        last_total, last_time = 0, self.started
+        while not self.done.wait(self.interval):
+            now, total = time.perf_counter(), self.total
+            print(f'{total} documents, {(total - last_total) / (now - last_time):.0f} docs/s')
+            last_total, last_time = total, now
+
+    def stop(self):
+        self.done.set()
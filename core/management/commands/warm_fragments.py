@@ -0,0 +1,44 @@
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from core.models import FindingAid
+from core.views import FindingAidDetailView
+
+import time
+
+class Command(BaseCommand):
+    """Warm the finding aid page cache"""
+    help = "Render the pages of the most viewed finding aids so their fragments are cached, run after a deploy"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--limit", help="number of finding aids to render, most viewed first", type=int, default=1000
+        )
+        parser.add_argument(
+            "--repository", help="only the finding aids of the repository with this slug", type=str, default=None
+        )
+
+    def handle(self, *args, **options):
+        aids = FindingAid.objects.filter(progenitorID=0)
+        if options.get("repository"):
+            aids = aids.filter(repository__slug=options["repository"])
+        aids = aids.order_by('-view_count', 'pk').values_list('pk', 'repository__slug')[:options.get("limit")]
+
+        # The pages as an anonymous visitor sees them, the fragments are the same for everyone
+        view = FindingAidDetailView.as_view(count_views=False)
+        factory = RequestFactory()
+
+        rendered = failed = 0
+        started = time.perf_counter()
+        for pk, slug in aids:
+            request = factory.get(f'/repositories/{slug}/findingaids/{pk}')
+            request.user = AnonymousUser()
+            try:
+                view(request, slug=slug, pk=pk).render()
+                rendered += 1
+            except Exception as e:
+                failed += 1
+                print(f'{pk}\tunable to render {e}')
+
+        print(f'{rendered} finding aid pages rendered, {failed} failed, in {time.perf_counter() - started:.1f}s')
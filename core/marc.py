@@ -0,0 +1,130 @@
+from pymarc import MARCReader
+from pymarc.marcxml import XmlHandler
+
+from xml.sax import make_parser
+from xml.sax.handler import feature_namespaces
+import re
+
+# Streaming MARC support
+#
+# MARC dumps can hold hundreds of thousands of records in one file.  The readers here hand
+# the records over one at a time as they are read, so nothing but the current record and a
+# read buffer is held whatever the size of the file.  marc_fields and marc_terms map a record
+# onto FindingAid columns and control access entries, FindingAid.from_marc and MARCWriter
+# (core/models.py) turn them into rows.
+
+# Subject added entries and the EAD <controlaccess> element each maps to
+CONTROL_TAGS = {'600': 'persname', '610': 'corpname', '611': 'corpname', '630': 'title', '648': 'subject',
+                '650': 'subject', '651': 'geogname', '653': 'subject', '655': 'genreform', '656': 'occupation',
+                '657': 'function'}
+
+# Subject subdivisions, joined to the heading with ' -- '
+SUBDIVISIONS = frozenset('vxyz')
+
+# Subfields that are codes or links rather than text
+SKIP_SUBFIELDS = frozenset('0123456789')
+
+READ_SIZE = 64 * 1024
+
+def read_marc(source):
+    # MARC records from a binary MARC (ISO 2709) or MARCXML stream, told apart by the first byte
+    if hasattr(source, 'peek'):
+        start = source.peek(64)
+    else:
+        start = source.read(64)
+        source.seek(0)
+    if start.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] == b'<':
+        return read_marcxml(source)
+    return read_iso2709(source)
+
+def read_iso2709(source):
+    # Records that can't be decoded are handed over as None, with the reader's error, rather
+    # than ending the file
+    reader = MARCReader(source, to_unicode=True, force_utf8=True, utf8_handling='replace', permissive=True)
+    for record in reader:
+        if record is None:
+            yield None, str(reader.current_exception)
+        else:
+            yield record, None
+
+def read_marcxml(source):
+    # An incremental SAX parse fed a block at a time, each <record> is handed over once it closes
+    handler = XmlHandler()
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    parser.setFeature(feature_namespaces, 1)
+
+    while True:
+        block = source.read(READ_SIZE)
+        if not block:
+            break
+        parser.feed(block)
+        while handler.records:
+            yield handler.records.pop(0), None
+    parser.close()
+    while handler.records:
+        yield handler.records.pop(0), None
+
+def text(field, codes=None):
+    # The subfields of a field joined with spaces, leaving out codes and links
+    if field is None:
+        return ""
+    values = [subfield.value.strip() for subfield in field.subfields
+              if subfield.code not in SKIP_SUBFIELDS and (codes is None or subfield.code in codes)]
+    return ' '.join(value for value in values if value)
+
+def trim(value):
+    # Cataloguing punctuation left at the end of a field.  A full stop is kept after an
+    # initial or an abbreviation like "Co."
+    value = re.sub(r'\s*[,:;/=]\s*$', '', value.strip())
+    return re.sub(r'(?:(?<=[0-9a-z]{2})|(?<=[)\]]))\.$', '', value).strip()
+
+def control_number(record):
+    field = record['001']
+    return field.data.strip() if field is not None and field.data else ""
+
+def marc_fields(record):
+    '''
+    FindingAid column values for a MARC record: the 1xx main entry as the creator, 245 as the
+    title and dates, 300 as the extent and 520 as the scope and content (and abstract, for a
+    520 with first indicator 3).
+    '''
+    fields = {'reference_code': control_number(record)}
+
+    creator = next(iter(record.get_fields('100', '110', '111', '130')), None)
+    fields['creator'] = trim(text(creator))
+
+    title = record['245']
+    fields['title'] = trim(text(title, 'abknps')) or "No title"
+    dates = trim(text(title, 'f'))
+    bulk = trim(text(title, 'g'))
+    if not dates:
+        published = next(iter(record.get_fields('264', '260')), None)
+        dates = trim(text(published, 'c'))
+    fields['date'] = (dates + (f' [{bulk}]' if bulk else "")).strip()
+
+    fields['extent'] = '; '.join(trim(text(field, 'abcefg')) for field in record.get_fields('300'))
+
+    summaries = record.get_fields('520')
+    fields['scope_and_content'] = '\n'.join(text(field, 'ab') for field in summaries)
+    fields['abstract'] = '\n'.join(text(field, 'ab') for field in summaries if field.indicator1 == '3')
+
+    return fields
+
+def marc_terms(record):
+    # (control_type, term, link) for each 6xx subject added entry, link being its $0 authority id
+    entries = []
+    for field in record.get_fields(*CONTROL_TAGS):
+        heading, subdivisions, link = [], [], ""
+        for subfield in field.subfields:
+            value = (subfield.value or "").strip()
+            if subfield.code == '0':
+                link = link or value
+            elif subfield.code in SUBDIVISIONS:
+                subdivisions.append(trim(value))
+            elif subfield.code not in SKIP_SUBFIELDS and value:
+                heading.append(value)
+        term = ' -- '.join(part for part in [trim(' '.join(heading))] + subdivisions if part)
+        if term:
+            entries.append((CONTROL_TAGS[field.tag], term[:255], link[:1255]))
+    return entries
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.10 on 2026-10-18 08:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_findingaid_associated_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('findingAidID', models.IntegerField()),
+                ('elasticsearch_id', models.CharField(blank=True, max_length=32)),
+                ('operation', models.CharField(choices=[('I', 'Index'), ('D', 'Delete')], default='I', max_length=1)),
+                ('components', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.0.10 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_searchoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32, unique=True)),
+                ('position', models.DateTimeField(blank=True, null=True)),
+                ('last_run', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='controlaccess',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='findingaid',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
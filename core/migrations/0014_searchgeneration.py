@@ -0,0 +1,20 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_searchcheckpoint_controlaccess_modified_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
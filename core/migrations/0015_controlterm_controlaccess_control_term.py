@@ -0,0 +1,89 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_control_terms(apps, schema_editor):
+    # One ControlTerm per distinct (control_type, term, link), then point every ControlAccess
+    # row at its term
+    ControlAccess = apps.get_model('core', 'ControlAccess')
+    ControlTerm = apps.get_model('core', 'ControlTerm')
+
+    ids = {}
+    rows = ControlAccess.objects.values_list('control_type', 'term', 'link').distinct()
+    new = [ControlTerm(control_type=control_type[:32], term=term, link=link) for control_type, term, link in rows.iterator()]
+    ControlTerm.objects.bulk_create(new, batch_size=1000, ignore_conflicts=True)
+
+    for id, control_type, term, link in ControlTerm.objects.values_list('id', 'control_type', 'term', 'link').iterator():
+        ids[(control_type, term, link)] = id
+
+    batch = []
+    for access in ControlAccess.objects.only('control_type', 'term', 'link').iterator(chunk_size=2000):
+        access.control_term_id = ids[(access.control_type[:32], access.term, access.link)]
+        batch.append(access)
+        if len(batch) >= 2000:
+            ControlAccess.objects.bulk_update(batch, ['control_term'])
+            batch = []
+    ControlAccess.objects.bulk_update(batch, ['control_term'])
+
+
+def copy_control_terms_back(apps, schema_editor):
+    ControlAccess = apps.get_model('core', 'ControlAccess')
+
+    batch = []
+    for access in ControlAccess.objects.select_related('control_term').iterator(chunk_size=2000):
+        access.control_type = access.control_term.control_type
+        access.term = access.control_term.term
+        access.link = access.control_term.link
+        batch.append(access)
+        if len(batch) >= 2000:
+            ControlAccess.objects.bulk_update(batch, ['control_type', 'term', 'link'])
+            batch = []
+    ControlAccess.objects.bulk_update(batch, ['control_type', 'term', 'link'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_searchgeneration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ControlTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('control_type', models.CharField(max_length=32)),
+                ('term', models.CharField(blank=True, max_length=255)),
+                ('link', models.CharField(blank=True, max_length=1255)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='controlterm',
+            constraint=models.UniqueConstraint(fields=('control_type', 'term', 'link'), name='unique_control_term'),
+        ),
+        migrations.AddField(
+            model_name='controlaccess',
+            name='control_term',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='core.controlterm'),
+        ),
+        migrations.RunPython(fill_control_terms, copy_control_terms_back),
+        migrations.RemoveField(
+            model_name='controlaccess',
+            name='control_type',
+        ),
+        migrations.RemoveField(
+            model_name='controlaccess',
+            name='link',
+        ),
+        migrations.RemoveField(
+            model_name='controlaccess',
+            name='term',
+        ),
+        migrations.AlterField(
+            model_name='controlaccess',
+            name='control_term',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='core.controlterm'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_controlterm_controlaccess_control_term'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HarvestRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=255)),
+                ('datestamp', models.CharField(blank=True, max_length=32)),
+                ('harvested', models.DateTimeField(auto_now=True)),
+                ('finding_aid', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.findingaid')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.harvestprofile')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='harvestrecord',
+            constraint=models.UniqueConstraint(fields=('profile', 'identifier'), name='unique_harvest_record'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_harvestrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='harvestprofile',
+            name='last_datestamp',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='harvestprofile',
+            name='last_harvest',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='harvestprofile',
+            name='resumption_date',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='harvestprofile',
+            name='resumption_token',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='harvestrecord',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='harvestrecord',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='harvestrecord',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:12
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0017_harvest_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='harvestprofile',
+            name='harvest_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Hours between scheduled harvests, leave blank to only harvest on request', null=True, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='harvestprofile',
+            name='next_harvest',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='HarvestJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('full', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('Q', 'Queued'), ('R', 'Running'), ('F', 'Finished'), ('X', 'Failed')], default='Q', max_length=1)),
+                ('estimate', models.IntegerField(default=0)),
+                ('queued', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('ingested', models.IntegerField(default=0)),
+                ('unchanged', models.IntegerField(default=0)),
+                ('deleted', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('skipped', models.IntegerField(default=0)),
+                ('last_record', models.CharField(blank=True, max_length=255)),
+                ('message', models.TextField(blank=True)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.harvestprofile')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='harvestjob',
+            index=models.Index(fields=['status', 'estimate', 'queued'], name='harvest_job_queue'),
+        ),
+    ]
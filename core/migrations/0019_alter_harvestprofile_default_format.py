@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_harvestjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='harvestprofile',
+            name='default_format',
+            field=models.CharField(choices=[('E', 'EAD'), ('M', 'MARC'), ('P', 'PDF (under development)')], default='E', max_length=1),
+        ),
+    ]
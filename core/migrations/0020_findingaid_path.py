@@ -0,0 +1,71 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+def segment(pk):
+    # Same as core.models.tree_segment
+    return '%010d/' % pk
+
+
+def fill_paths(apps, schema_editor):
+    # Walks each finding aid's components by parentID, one finding aid at a time so only the
+    # keys and paths of the largest one are held at once
+    FindingAid = apps.get_model('core', 'FindingAid')
+
+    batch = []
+
+    def add(pk, path):
+        batch.append(FindingAid(pk=pk, path=path))
+        if len(batch) >= 2000:
+            FindingAid.objects.bulk_update(batch, ['path'])
+            batch.clear()
+
+    for progenitor in FindingAid.objects.filter(progenitorID=0).values_list('pk', flat=True).iterator(chunk_size=2000):
+        paths = {progenitor: segment(progenitor)}
+        add(progenitor, paths[progenitor])
+
+        pending = list(FindingAid.objects.filter(progenitorID=progenitor).order_by('pk').values_list('pk', 'parentID'))
+        while pending:
+            waiting = []
+            for pk, parent in pending:
+                if parent in paths:
+                    paths[pk] = paths[parent] + segment(pk)
+                    add(pk, paths[pk])
+                else:
+                    waiting.append((pk, parent))
+
+            if len(waiting) == len(pending):
+                # Parents that no longer exist, hang the orphans off the finding aid
+                for pk, parent in waiting:
+                    paths[pk] = paths[progenitor] + segment(pk)
+                    add(pk, paths[pk])
+                break
+            pending = waiting
+
+    FindingAid.objects.bulk_update(batch, ['path'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_alter_harvestprofile_default_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='findingaid',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='findingaid',
+            name='progenitorID',
+            field=models.IntegerField(blank=True, db_index=True, default=0),
+        ),
+        migrations.AddIndex(
+            model_name='findingaid',
+            index=models.Index(fields=['parentID', 'path'], name='findingaid_children'),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
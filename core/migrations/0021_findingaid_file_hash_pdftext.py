@@ -0,0 +1,33 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_findingaid_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDFText',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('first_page', models.IntegerField()),
+                ('last_page', models.IntegerField()),
+                ('page_count', models.IntegerField()),
+                ('text', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='findingaid',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='pdftext',
+            constraint=models.UniqueConstraint(fields=('content_hash', 'first_page'), name='unique_pdf_pages'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_findingaid_file_hash_pdftext'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(fields=['name', 'id'], name='repository_name'),
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(fields=['status', 'name', 'id'], name='repository_status'),
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(fields=['state', 'name', 'id'], name='repository_state'),
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(fields=['st_city', 'id'], name='repository_city'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['is_active', 'email'], name='user_active'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['first_name', 'id'], name='user_first_name'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['last_name', 'id'], name='user_last_name'),
+        ),
+    ]
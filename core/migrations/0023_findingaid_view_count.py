@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_repository_user_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='findingaid',
+            name='view_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
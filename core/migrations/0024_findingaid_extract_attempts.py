@@ -0,0 +1,28 @@
+# Generated by Django 4.0.10 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_findingaid_view_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='findingaid',
+            name='extract_after',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='findingaid',
+            name='extract_attempts',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='findingaid',
+            name='extract_error',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
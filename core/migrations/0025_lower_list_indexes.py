@@ -0,0 +1,55 @@
+# Generated by Django 4.0.10 on 2026-10-18 10:21
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_findingaid_extract_attempts'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='repository',
+            name='repository_state',
+        ),
+        migrations.RemoveIndex(
+            model_name='repository',
+            name='repository_city',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_first_name',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_last_name',
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(django.db.models.functions.text.Lower('name'), django.db.models.expressions.F('name'), django.db.models.expressions.F('id'), name='repository_name_lower'),
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(django.db.models.functions.text.Lower('state'), django.db.models.expressions.F('name'), django.db.models.expressions.F('id'), name='repository_state_lower'),
+        ),
+        migrations.AddIndex(
+            model_name='repository',
+            index=models.Index(django.db.models.functions.text.Lower('st_city'), django.db.models.expressions.F('name'), django.db.models.expressions.F('id'), name='repository_city_lower'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('email'), django.db.models.expressions.F('email'), django.db.models.expressions.F('id'), name='user_email_lower'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('first_name'), django.db.models.expressions.F('email'), django.db.models.expressions.F('id'), name='user_first_name_lower'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(django.db.models.functions.text.Lower('last_name'), django.db.models.expressions.F('email'), django.db.models.expressions.F('id'), name='user_last_name_lower'),
+        ),
+    ]
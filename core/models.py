@@ -1,22 +1,28 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Lower
 from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.base_user import AbstractBaseUser
+from django.core.validators import MinValueValidator
 from django.utils.translation import gettext_lazy as _
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 from .managers import UserManager
+from .ead import EADReader, empty, find, first, get_string, get_text, index_elements, to_markup
+from .marc import marc_fields, marc_terms, read_marc
+from .search import document_id, get_client
 
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search, Q
-from bs4 import BeautifulSoup
-from pymarc import MARCReader
-from PyPDF2 import PdfFileReader
-from sickle import Sickle
-
+from datetime import timedelta
 import json, re
 
+# name__lower__startswith and the like, for the searches the Lower() indexes serve
+models.CharField.register_lookup(Lower)
+
 class UserRole(models.Model):
     repository = models.ForeignKey('Repository', on_delete=models.CASCADE)
     user = models.ForeignKey('User', on_delete=models.CASCADE)
@@ -29,6 +35,20 @@ class UserRole(models.Model):
                             choices=USER_ROLES,
                             default=CONTRIBUTOR,)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.clear_user_roles()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.clear_user_roles()
+        return result
+
+    def clear_user_roles(self):
+        # Only the loaded user's map can be stale here, any other instance belongs to another request
+        if UserRole.user.is_cached(self):
+            self.user.clear_roles()
+
 class User(AbstractBaseUser, PermissionsMixin):
     email = models.EmailField(_('email address'), unique=True)
     first_name = models.CharField(_('first name'), max_length=30, blank=True)
@@ -46,6 +66,12 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
+        # The user list, in email order and filtered by status, or by the start of an email or
+        # name whatever its case (see UserListView)
+        indexes = [models.Index(fields=['is_active', 'email'], name='user_active'),
+                   models.Index(Lower('email'), 'email', 'id', name='user_email_lower'),
+                   models.Index(Lower('first_name'), 'email', 'id', name='user_first_name_lower'),
+                   models.Index(Lower('last_name'), 'email', 'id', name='user_last_name_lower')]
 
     def get_full_name(self):
         '''
@@ -60,27 +86,49 @@ class User(AbstractBaseUser, PermissionsMixin):
         '''
         return self.first_name
 
+    @cached_property
+    def roles(self):
+        '''
+        The user's roles in each repository, looked up by repository id or slug.  Loaded with one
+        query the first time it's needed and kept on the instance, and as request.user is a new
+        instance for every request the permission checks of a request share a single query.
+        '''
+        roles = {}
+        for repository_id, slug, role in UserRole.objects.filter(user=self).values_list('repository_id', 'repository__slug', 'role'):
+            roles.setdefault(repository_id, set()).add(role)
+            roles.setdefault(slug, set()).add(role)
+        return roles
+
+    def clear_roles(self):
+        self.__dict__.pop('roles', None)
+
+    def repository_roles(self, repo):
+        # repo may be a Repository, its id or its slug
+        return self.roles.get(repo.pk if isinstance(repo, Repository) else repo, ())
+
     def get_user_repositories(self):
         if self.is_site_admin:
             return Repository.objects.all()
         else:
-            return Repository.objects.filter(pk__in=self.userrole_set.all().values_list('repository__pk', flat=True))
+            return Repository.objects.filter(pk__in=[key for key in self.roles if isinstance(key, int)])
         
     def is_repo_admin(self, repo):
-        return self.is_site_admin or UserRole.objects.filter(repository=repo, user=self, role=UserRole.REPO_ADMIN).exists()
+        return self.is_site_admin or UserRole.REPO_ADMIN in self.repository_roles(repo)
 
     def is_repo_member(self, repo):
-        return self.is_site_admin or UserRole.objects.filter(repository=repo, user=self).exists()
+        return self.is_site_admin or bool(self.repository_roles(repo))
     
     def is_admin(self):
-        return self.is_site_admin or UserRole.objects.filter(user=self, role=UserRole.REPO_ADMIN).exists()
+        return self.is_site_admin or any(UserRole.REPO_ADMIN in roles for roles in self.roles.values())
     
     def user_type(self):
+        # Goes through userrole_set so that a list of users can prefetch the roles
+        roles = {user_role.role for user_role in self.userrole_set.all()}
         if self.is_site_admin:
             return "Site Admin"
-        elif UserRole.objects.file(role=UserRole.REPO_ADMIN).exists():
+        elif UserRole.REPO_ADMIN in roles:
             return "Repository Admin"
-        elif UserRole.objects.file(role=UserRole.CONTRIBUTOR).exists():
+        elif UserRole.CONTRIBUTOR in roles:
             return "Contributor"
         else:
             return "Unassigned"
@@ -131,6 +179,16 @@ class Repository(models.Model):
 
     elasticsearch_id = models.CharField(max_length=32, blank=True)
 
+    class Meta:
+        # The repository list, in name order and filtered by status, state or city (see
+        # RepositoryListView).  Searches match the lowercased columns, states whole and names
+        # and cities by their start.
+        indexes = [models.Index(fields=['name', 'id'], name='repository_name'),
+                   models.Index(fields=['status', 'name', 'id'], name='repository_status'),
+                   models.Index(Lower('name'), 'name', 'id', name='repository_name_lower'),
+                   models.Index(Lower('state'), 'name', 'id', name='repository_state_lower'),
+                   models.Index(Lower('st_city'), 'name', 'id', name='repository_city_lower')]
+
     def get_defaults(self):
         return FindingAidDefaults.objects.get(repository=self)
 
@@ -174,9 +232,21 @@ class HarvestProfile(models.Model):
     EAD = 'E'
     MARC = 'M'
     PDF = 'P'
-    FILE_TYPES = [(EAD, 'EAD'), (MARC, 'MARC (under development)'), (PDF, 'PDF (under development)')]
+    FILE_TYPES = [(EAD, 'EAD'), (MARC, 'MARC'), (PDF, 'PDF (under development)')]
     default_format = models.CharField(max_length=1, choices=FILE_TYPES, default=EAD)
 
+    # Where harvesting got to, see core/harvest.py.  last_datestamp is the OAI from date for the
+    # next harvest.  While a harvest is running resumption_token is the last page fully loaded,
+    # and resumption_date the from date it will leave behind once it finishes.
+    last_datestamp = models.CharField(max_length=32, blank=True, editable=False)
+    resumption_token = models.TextField(blank=True, editable=False)
+    resumption_date = models.CharField(max_length=32, blank=True, editable=False)
+    last_harvest = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Harvested by the harvest_worker every harvest_interval hours, or only when asked if blank
+    harvest_interval = models.PositiveIntegerField(null=True, blank=True, validators=[MinValueValidator(1)], help_text="Hours between scheduled harvests, leave blank to only harvest on request")
+    next_harvest = models.DateTimeField(null=True, blank=True, editable=False, db_index=True)
+
     def get_harvest_type(self):
         return self.harvest_type #self.HARVEST_TYPES[self.harvest_type]
     
@@ -189,6 +259,25 @@ class HarvestProfile(models.Model):
     def __str__(self):
         return self.name
 
+# A record or file brought in by a harvest profile, and the finding aid made from it
+class HarvestRecord(models.Model):
+    profile = models.ForeignKey('HarvestProfile', on_delete=models.CASCADE)
+    identifier = models.CharField(max_length=255)
+    datestamp = models.CharField(max_length=32, blank=True)
+    finding_aid = models.ForeignKey('FindingAid', null=True, blank=True, on_delete=models.SET_NULL)
+
+    # Validators sent back on the next fetch of a file, and the SHA-256 of what was loaded
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+    harvested = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['profile', 'identifier'], name='unique_harvest_record')]
+
+    def __str__(self):
+        return self.identifier
+
 
 class FindingAid(models.Model):
     repository = models.ForeignKey('Repository', on_delete=models.CASCADE)
@@ -249,36 +338,161 @@ class FindingAid(models.Model):
     
     # This is the base Finding aid ID used to maintain relationships between the archref and <cXX>
     # components within the search engine as each are independent entries
-    progenitorID = models.IntegerField(default=0, blank=True)
+    progenitorID = models.IntegerField(default=0, blank=True, db_index=True)
 
     # This is used to keep the relationship going through <cXX> components
     parentID = models.IntegerField(default=0, blank=True)
 
+    # Materialized path, the keys from the finding aid down to this row (see tree_segment).  A
+    # subtree is one range of the index and sorts in document order.
+    path = models.CharField(max_length=255, blank=True, db_index=True, editable=False)
+
+    # Page views, roughly (see core/fragments.py)
+    view_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # SHA-256 of the PDF in associated_file once its text has been extracted (core/pdf.py),
+    # blank while that is still to do
+    file_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    # Failed extractions of the current file, and when the next attempt is due
+    extract_attempts = models.IntegerField(default=0, editable=False)
+    extract_after = models.DateTimeField(null=True, blank=True, editable=False)
+    extract_error = models.TextField(blank=True, editable=False)
+
     component = models.CharField(max_length=10, blank=True)
 
+    # When the row was last written, used by the delta indexer (index_changes) to find what
+    # has to be sent to the search engine.  last_update is the contribution date shown to users.
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        # One level of the tree in document order
+        indexes = [models.Index(fields=['parentID', 'path'], name='findingaid_children')]
+
+    def save(self, *args, index=True, **kwargs):
+        # index=False leaves queueing the finding aid for the search index to the caller
+
+        if self.associated_file and not self.associated_file._committed:
+            self.file_changed()
+
+        # The search index is updated from the outbox, written in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            if not self.path:
+                parent = FindingAid.objects.filter(pk=self.parentID).values_list('path', flat=True).first() if self.parentID else ""
+                self.path = (parent or "") + tree_segment(self.pk)
+                FindingAid.objects.filter(pk=self.pk).update(path=self.path)
+
+            if index:
+                SearchOutbox.enqueue(self)
+
+            # A component is part of its finding aid's page
+            if self.progenitorID:
+                FindingAid.touch(self.progenitorID)
+
+    def file_changed(self):
+        # A newly uploaded PDF has to be read again, however the last file went
+        self.file_hash = ""
+        self.extract_attempts = 0
+        self.extract_after = None
+        self.extract_error = ""
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            SearchOutbox.enqueue(self, SearchOutbox.DELETE)
+            if self.progenitorID:
+                FindingAid.touch(self.progenitorID)
+            else:
+                # The components aren't linked by a foreign key, so they and their index
+                # entries go with the finding aid here
+                self.clear_contents()
+            return super().delete(*args, **kwargs)
+
+    def touch(pk):
+        # Marks a finding aid, and the finding aid it belongs to if it's a component, as changed.
+        # Moving modified on means the cached fragments of its page aren't used again.
+        progenitor = FindingAid.objects.filter(pk=pk, progenitorID__gt=0).values('progenitorID')
+        FindingAid.objects.filter(Q(pk=pk) | Q(pk__in=progenitor)).update(modified=timezone.now())
+
     def get_absolute_url(self):
         return reverse('detail-findingaid', kwargs={'pk' : self.pk, 'slug': self.repository.slug})
 
+    def clear_contents(self):
+        # Removes the components, chronology and control access terms, so the finding aid can
+        # be loaded again.  Components aren't linked by a foreign key so their index entries
+        # are queued for removal here.
+        components = FindingAid.objects.filter(progenitorID=self.pk)
+        SearchOutbox.objects.bulk_create([SearchOutbox(findingAidID=component.pk, elasticsearch_id=document_id(component),
+                                                       operation=SearchOutbox.DELETE)
+                                          for component in components.only('pk', 'elasticsearch_id').iterator()],
+                                         batch_size=1000)
+        components.delete()
+        self.chronology_set.all().delete()
+        self.controlaccess_set.all().delete()
+
     def __str__(self):
         return self.title
     
     def get_contents(self):
-        return FindingAid.objects.filter(progenitorID=self.id).order_by('pk')
+        return self.get_subtree()
+
+    def get_subtree(self):
+        # Everything below this row in document order
+        return FindingAid.objects.filter(path__gt=self.path, path__lt=self.path + '~').order_by('path')
+
+    def get_ancestors(self):
+        # From the finding aid down to this row's parent
+        keys = [int(key) for key in self.path.split('/')[:-2]]
+        return FindingAid.objects.filter(pk__in=keys).order_by('path')
+
+    def get_children(self):
+        return FindingAid.objects.filter(parentID=self.pk).order_by('path')
+
+    # The columns a component is shown with in the tree
+    TREE_FIELDS = ('title', 'date', 'container', 'extent', 'scope_and_content', 'digital_link', 'reference_code',
+                   'intra_repository', 'note', 'component', 'parentID', 'path')
+
+    def get_level(self, parent=None, after="", size=None):
+        '''
+        One page of the components directly below parent (a component of this finding aid, the
+        finding aid itself if None) in document order, each with has_children set.  after is the
+        cursor from the previous page.  Returns the components and the cursor for the next page,
+        None on the last.  A single query on the findingaid_children index however big the tree.
+        '''
+        size = size or getattr(settings, 'COMPONENT_PAGE_SIZE', 100)
+
+        components = list(FindingAid.objects.filter(parentID=parent or self.pk, progenitorID=self.pk, path__gt=after or "")
+                                            .annotate(has_children=Exists(FindingAid.objects.filter(parentID=OuterRef('pk'))))
+                                            .only(*FindingAid.TREE_FIELDS).order_by('path')[:size + 1])
+        if len(components) > size:
+            return components[:size], components[size - 1].path
+        return components, None
 
     def get_chron(self):
         return self.chronology_set.all().order_by('sort_order')
     
     def get_series(self):        
-        return FindingAid.objects.filter(progenitorID=self.id,level="c01").order_by('pk')
+        return self.get_children()
+
+    def get_terms(self, control_type):
+        return ControlTerm.objects.filter(controlaccess__finding_aid=self, control_type=control_type).distinct().order_by('term')
 
     def get_names(self):
-        return self.controlaccess_set.filter(control_type="persname").order_by('term')
+        return self.get_terms("persname")
     
     def get_subjects(self):
-        return self.controlaccess_set.filter(control_type="subject").order_by('term')
+        return self.get_terms("subject")
     
     def get_materials(self):
-        return self.controlaccess_set.filter(control_type="genreform").order_by('term')
+        return self.get_terms("genreform")
+
+    def get_control_terms(self):
+        # All the control access terms by control_type in one query, for pages showing several types
+        terms = {}
+        for term in ControlTerm.objects.filter(controlaccess__finding_aid=self).distinct().order_by('term'):
+            terms.setdefault(term.control_type, []).append(term)
+        return terms
 
     # The Elasticsearch index consists of:
     # id - finding aid ID
@@ -294,7 +508,7 @@ class FindingAid(models.Model):
 
         # If there is something to index
         if title or description:
-            es = Elasticsearch([{'host': 'localhost', 'port': 9200}])
+            es = get_client()
             
             # For insert no need for {'doc': }
             record = {'id': id, 'type': index_type, 'title': title, 'repository': repository_name, 'content': description, 'source': source, 'destination': ""}
@@ -314,7 +528,7 @@ class FindingAid(models.Model):
         # If there is something to index
         if title or description:
             
-            es = Elasticsearch([{'host': 'localhost', 'port': 9200}])
+            es = get_client()
 
             # For update it needs to be wrapped in {'doc': }
             record = {'doc':{'id': id, 'type': index_type, 'title': title, 'repository': repository_name, 'content': description, 'source': source, 'destination': ""}}
@@ -330,7 +544,7 @@ class FindingAid(models.Model):
         return elasticsearch_id
 
     def remove_index(elasticsearch_id):
-        es = Elasticsearch([{'host': 'localhost', 'port': 9200}])
+        es = get_client()
 
         try:
             es.delete(index="nafan",doc_type="_doc", id=elasticsearch_id)
@@ -338,290 +552,247 @@ class FindingAid(models.Model):
             print('Error in indexing data')
             print(str(ex))
 
-    def ead_index(id, repository, filepath, user_name):                    
+    def ead_index(id, repository, filepath, user_name, batch_size=None):                    
         response = "OK"
 
-        with open(filepath, newline='', encoding="utf8") as ead_file:
+        with open(filepath, 'rb') as ead_file:
 
             if id == "new":
                 f = FindingAid()
             else:
                 f = FindingAid.objects.get(id=id)
 
-            f.record_type = "ead"
+            f.record_type = FindingAid.EAD
             f.repository = repository
 
-            # Yank the text and start parsing it
-            html_doc = ead_file.read()
-            soup = BeautifulSoup(html_doc, 'html.parser')
+            # Stream the file rather than reading it in and building the whole tree,
+            # the reader hands over each part of the finding aid once it is closed
+            records = FindingAid.read_ead(EADReader(ead_file))
 
             # Make an internal EAD from the initial file
             # The EAD parsing is not as elegant as it should be in a final implementation
-            response = f.make_ead(id, soup, f, user_name, filepath)
+            response = FindingAid.make_ead(id, records, f, user_name, filepath, batch_size)
 
         return response
 
-    def make_ead(id, soup, aid, user_name, filepath):
-        
-        response = "OK"
+    def marc_index(repository, filepath, user_name, batch_size=None):
+        # Loads every record of a MARC file as a finding aid.  Records are read one at a time
+        # and written in batches, so memory use doesn't grow with the size of the file.
+        # Returns the number of finding aids written and of records that couldn't be read.
+        writer = MARCWriter(repository, user_name, batch_size)
+        failed = 0
 
-        # Access the search engine for indexing
-        es = Elasticsearch([{'host': 'localhost', 'port': 9200}])
+        with open(filepath, 'rb') as marc_file:
+            for record, error in read_marc(marc_file):
+                if record is None:
+                    print(f'Unable to read a record in the {filepath} file {error}')
+                    failed += 1
+                    continue
+                writer.add(*FindingAid.from_marc(record))
+            writer.flush()
 
-        try:
+        return writer.count, failed
+
+    def from_marc(record):
+        # An unsaved finding aid and its control access entries for a pymarc Record
+        aid = FindingAid(record_type=FindingAid.MARC, level="archdesc", **marc_fields(record))
+        return aid, marc_terms(record)
+
+    # The fields parse_did fills in, copied from the parsed archdesc did onto the finding aid
+    DID_FIELDS = ('level', 'title', 'date', 'container', 'intra_repository', 'reference_code', 'creator', 'extent',
+                  'abstract', 'languages', 'governing_access', 'rights', 'citation', 'bioghist', 'scope_and_content',
+                  'originals_location', 'note')
 
-            archdesc = soup.find('archdesc')
-            did = archdesc.find('did')
+    def read_ead(reader):
+        # Turns what the EADReader hands over into (event, record, depth) tuples.  This is the
+        # CPU heavy part of an ingest and doesn't touch the database, so the records can be
+        # built in another process and written by make_ead.
 
-            # parse the archdesc did
-            aid = FindingAid.parse_did(did, aid, "archdesc")
+        for event, elem, depth in reader:
 
-            # if the following weren't found in the high did, go look for them
+            if event == 'archdesc':
+                # parse the archdesc did
+                yield event, FindingAid.parse_did(elem, FindingAid(), "archdesc"), depth
+
+            elif event == 'component':
+                # Process the component fields, the reader walks the levels for us
+                yield event, FindingAid.process_components(elem, depth), depth
+
+            elif event == 'chronitem':
+                yield event, (get_string(find(elem, 'date')), get_string(find(elem, 'event'))), depth
+
+            elif event == 'controlaccess':
+                yield event, FindingAid.parse_control(elem), depth
 
             # Have to consider there will be more than one dao
             # The digital object can be specified with an entityref attribute.  Need example.
-            digital_link = soup.find_all('dao') 
-            # if FindingAid.legit_component(digital_link, component_level):
-            for digitals in digital_link:
-                aid.digital_link = digitals['href']   
-
-            # There can be multiple accessrestrict entries
-            if not aid.governing_access:
-                aid.governing_access = String_or_p_tag(soup, 'accessrestrict')
-                # governing_access = did.find_all('accessrestrict') 
-                # if governing_access:
-                #     for entry in governing_access:
-                #         aid.governing_access = aid.governing_access + entry.get_text() + " "
-                #     aid.governing_access = cleanhtml(str(aid.governing_access))
-                #     aid.governing_access = aid.governing_access.strip()
-
-            if not aid.rights:
-                aid.rights = String_or_p_tag(soup, 'userestrict')
-            
-            if not aid.citation:
-                aid.citation = String_no_p_tag(soup, 'prefercite')
+            elif event == 'dao':
+                if elem.get('href'):
+                    yield event, elem.get('href'), depth
+
+            elif event == 'field':
+                if elem.tag == 'processinfo':
+                    value = get_string(find(elem, 'p'))
+                elif elem.tag == 'prefercite':
+                    value = String_no_p_element(elem)
+                else:
+                    value = String_or_p_element(elem)
+                yield event, (elem.tag, value), depth
+
+    def make_ead(id, records, aid, user_name, filepath, batch_size=None):
+        
+        response = "OK"
+
+        try:
+
+            # Everything for one finding aid is written in a single transaction
+            with transaction.atomic():
+
+                # Loading over an existing finding aid replaces what it held
+                if aid.pk:
+                    aid.clear_contents()
+
+                # The first of each FIELD_TAGS element in the file, used for anything not in the high did
+                fields = {}
+                processinfo = []
+                chronology = []
+                control = None
+
+                # The most recent entry at each level, parents[0] is the archdesc
+                parents = []
+
+                # Components are buffered and written in batches rather than saved one at a time
+                writer = ComponentWriter(batch_size)
+
+                for event, record, depth in records:
+
+                    if event == 'archdesc':
+
+                        for field in FindingAid.DID_FIELDS:
+                            setattr(aid, field, getattr(record, field))
+
+                        # Mark the indexing date and the user who did the indexing
+                        aid.last_update = timezone.now()
+                        aid.updated_by = user_name
+
+                        # Saved now so the components can refer to it, the rest is filled in at the end.
+                        # It is queued for the index once, with its components, when it's complete.
+                        aid.save(index=False)
+                        parents = [aid]
+
+                    elif event == 'component':
+                        if not parents:
+                            raise ValueError("component found before the archdesc did")
+
+                        record.repository_id = aid.repository_id
+                        record.record_type = aid.record_type
+                        record.last_update = aid.last_update
+                        record.updated_by_id = aid.updated_by_id
+                        record.progenitorID = aid.pk
+
+                        del parents[depth:]
+                        writer.add(record, parents[-1])
+                        parents.append(record)
+
+                    elif event == 'chronitem':
+                        chronology.append(record)
+
+                    elif event == 'controlaccess':
+                        # Only the first <controlaccess> is used
+                        if control is None:
+                            control = record
+
+                    elif event == 'dao':
+                        aid.digital_link = record
+
+                    elif event == 'field':
+                        tag, value = record
+                        if tag == 'processinfo':
+                            processinfo.append(value)
+                        else:
+                            fields.setdefault(tag, value)
+
+                if not parents:
+                    raise ValueError("no archdesc did found")
+
+                writer.flush()
+
+                # if the following weren't found in the high did, use the first found in the file
+
+                # There can be multiple accessrestrict entries
+                if not aid.governing_access:
+                    aid.governing_access = fields.get('accessrestrict', "")
+
+                if not aid.rights:
+                    aid.rights = fields.get('userestrict', "")
+
+                if not aid.citation:
+                    aid.citation = fields.get('prefercite', "")
             
-            if not aid.bioghist:
-                aid.bioghist = String_or_p_tag(soup, 'bioghist')
+                if not aid.bioghist:
+                    aid.bioghist = fields.get('bioghist', "")
             
-            if not aid.scope_and_content:
-                aid.scope_and_content = String_or_p_tag(soup, 'scopecontent')
+                if not aid.scope_and_content:
+                    aid.scope_and_content = fields.get('scopecontent', "")
             
-            if not aid.custodhist:
-                aid.custodhist = String_or_p_tag(soup, 'custodhist')
+                if not aid.custodhist:
+                    aid.custodhist = fields.get('custodhist', "")
             
-            if not aid.acqinfo:
-                aid.acqinfo = String_or_p_tag(soup, 'acqinfo')
+                if not aid.acqinfo:
+                    aid.acqinfo = fields.get('acqinfo', "")
             
-            if not aid.processinfo:
-                process = soup.find_all('processinfo')
-                if process:
-                    for item in process:
+                if not aid.processinfo:
+                    for item in processinfo:
                         try:
-                            aid.processinfo = aid.processinfo + " " + item.p.string
+                            aid.processinfo = aid.processinfo + " " + item
                         except Exception as ex:
                             print('Error handling processinfo ' + str(ex))
 
-            if not aid.originals_location:
-                aid.originals_location = String_or_p_tag(soup, 'originalsloc')
-                
-            # Mark the indexing date and the user who did the indexing
-            today = date.today()
-            aid.last_update = today.strftime("%B %d, %Y")
-            aid.updated_by = user_name
-
-            aid.save()
-
-            # The progenitor is used to keep track of related archdesc and cXX entries
-            progenitorID = aid.pk
-
-            aid.ark = "ark://" + str(aid.pk)
-
-            # If the snac and wiki links are going to be, a method for specifying them
-            # needs to be introduced.  Same problem as always with mass uploads
-            aid.snac = "https://snaccooperative.org"
-            aid.wiki = "https://www.wikidata.org"
-
-            sortOrder = 0
-            chronology = soup.find_all('chronitem')
-            if chronology:
-                for chron in chronology:
-                    item = Chronology()
-                    item.finding_aid_id = aid.pk
-                    item.date = chron.date.string
-                    item.event = chron.event.string
-                    item.sort_order = sortOrder
-                    item.save()
-                    sortOrder = sortOrder + 1
-
-                    # after the aid is saved, other aspects of the finding aid can be associated
-
-                    # the language information probably needs to come down here
-
-                    # <controlaccess>
-                    # subheaders
-                    #   <corpname>
-                    #   <famname>
-                    #   <function>
-                    #   <genreform>
-                    #   <geogname>
-                    #   <occupation>
-                    #   <persname>
-                    #   <subject>
-                    #   <title>
-
-            control = soup.find('controlaccess')
-            if control:
-                entries = control.find_all('corpname')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "corpname"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('famname')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "famname"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('function')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "function"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('genreform')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "genreform"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('geogname')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "geogname"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('occupation')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "occupation"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('persname')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "persname"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('subject')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "subject"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
-                entries = control.find_all('title')
-                if entries:
-                    for entry in entries:
-                        item = ControlAccess()
-                        item.finding_aid_id = progenitorID
-                        item.control_type = "title"
-                        item.term = entry.string
-                        if entry.has_attr('authfilenumber'):
-                            item.link = entry['authfilenumber']
-                        item.save()
+                if not aid.originals_location:
+                    aid.originals_location = fields.get('originalsloc', "")
 
-            # Once the control list is filled, add them to the finding aid through FindingAidSubjectHeader
-            # Needs to be implemented
-                
-            # otherfindaid can be text or an extref link to another finding aid
-            # There can be multiple subheaders or combinations thereof
-            # has to be handled like <controlaccess>
-            temp = ""
-            other = soup.find('otherfindaid')
-            if other:
-                entries = other.find_all('bibref')
-                for entry in entries:
-                    temp = entry.get_text()
-                    temp = cleanhtml(str(temp))
-
-                        # The entry contains all the text of an element with the tags including the searched tag
-                        # So theoretically the get_text could be indexed while the entry is stored in the database
-                        # to be processed converting the tags to html format (or do it on the way into the database)
-                        # print(entry)
-
-                entries = other.find_all('extref')
-                for entry in entries:
-                    temp = entry.string
-                    temp = entry['href']
-
-            # Process the component fields through a recursive function
-            components_list = []
-            c01s = soup.find_all("c01")
-            for c01 in c01s:
-                FindingAid.ProcessComponents(soup, c01, progenitorID, progenitorID, 1)
-
-            try:
+                # The progenitor is used to keep track of related archdesc and cXX entries
+                progenitorID = aid.pk
 
-                # Index the processed portion of the EAD.  Each component is indexed separately.
+                aid.ark = "ark://" + str(aid.pk)
 
-                source_url = filepath
-                destination_url = ""
+                # If the snac and wiki links are going to be, a method for specifying them
+                # needs to be introduced.  Same problem as always with mass uploads
+                aid.snac = "https://snaccooperative.org"
+                aid.wiki = "https://www.wikidata.org"
 
-                if id == "new":
+                aid.elasticsearch_id = document_id(aid)
+                aid.save(index=False)
 
-                    record = {'id': aid.pk, 'type': aid.aid_type, 'title': aid.title, 'repository': aid.repository, 'content': aid.scope_and_content, 'source': source_url, 'destination': destination_url}
-                    json_record = json.dumps(record)
+                # The chronology and control access rows are buffered and written with one insert each
+                Chronology.objects.bulk_create([Chronology(finding_aid_id=aid.pk,
+                                                           date=chron_date or "",
+                                                           event=chron_event or "",
+                                                           sort_order=sortOrder)
+                                                for sortOrder, (chron_date, chron_event) in enumerate(chronology)])
 
-                    outcome = es.index(index='nafan', doc_type='_doc', body=json_record)
-                    elasticsearch_id = outcome['_id']
+                # after the aid is saved, other aspects of the finding aid can be associated
 
-                    aid.elasticsearch_id = elasticsearch_id
-
-                    aid.save()
-                else:
+                # the language information probably needs to come down here
 
-                    # Update an existing entry
-                    record = {'doc':{'id': id, 'type': aid.aid_type, 'title': aid.title, 'repository': aid.repository, 'content': aid.scope_and_content, 'source': source_url, 'destination': ""}}
-                    json_record = json.dumps(record)
+                # Cut to the lengths the ControlTerm columns hold, as marc_terms does
+                entries = [(control_type[:32], (term or "")[:255], (link or "")[:1255])
+                           for control_type, term, link in control or []]
+                term_ids = control_terms.ids(entries)
+                ControlAccess.objects.bulk_create([ControlAccess(finding_aid_id=progenitorID, control_term_id=term_ids[entry])
+                                                   for entry in entries])
 
-                    es.update(id=aid.elasticsearch_id, index='nafan', doc_type='_doc', body=json_record)
+                # Index the processed portion of the EAD.  The archdesc and each component are
+                # separate documents, queued here and sent to the search engine by the outbox
+                # worker so a slow index doesn't hold up the ingest.
+                SearchOutbox.enqueue(aid, components=True)
 
-            except Exception as ex:
-                print('Error in indexing data')
-                print(str(ex))
+            # Once the control list is filled, add them to the finding aid through FindingAidSubjectHeader
+            # Needs to be implemented
+                
+            # otherfindaid can be text or an extref link to another finding aid
+            # There can be multiple subheaders or combinations thereof
+            # has to be handled like <controlaccess>
 
         except Exception as e:
             print("Unable to process the " + filepath + " file " + str(e))
@@ -629,41 +800,64 @@ class FindingAid(models.Model):
 
         return response
 
-    def parse_did(soup, aid, component_level):
+    # <controlaccess>
+    # subheaders
+    #   <corpname>
+    #   <famname>
+    #   <function>
+    #   <genreform>
+    #   <geogname>
+    #   <occupation>
+    #   <persname>
+    #   <subject>
+    #   <title>
+    CONTROL_TYPES = frozenset(['corpname', 'famname', 'function', 'genreform', 'geogname', 'occupation', 'persname', 'subject', 'title'])
+
+    def parse_control(control):
+        # Returns (control_type, term, link) for each entry in document order, classifying
+        # the elements by tag in a single pass over the <controlaccess>
+        entries = []
+        for entry in control.iter():
+            if entry.tag in FindingAid.CONTROL_TYPES:
+                entries.append((entry.tag, get_string(entry), entry.get('authfilenumber')))
+        return entries
 
-        # There is a situation where the parsing of a <cXX> component can pick up the elements
-        # associated with a child of the component since the child's elements are included in the
-        # tag pickup
+    def parse_did(soup, aid, component_level):
 
-        # One way to possibly deal with this is to make sure the item's level matches the expected
-        # level, meaning if we are parsing <c01> and the parent of an element is <c02>, we don't want
-        # the data for that tag
+        # Components are handed over by the EADReader before any of their children are read,
+        # so a <cXX> only holds its own <did> and the elements found here can't belong to a
+        # child component
 
         # ToDo: There are assignments in place that assign a string from an element.  If there is a subfield
         # within the string, the assignment is crashing.  For example some of the abstract elements in components
         # of syr-wayland-smith_p.xml in the eaddiva files.
 
         did = soup.find('did')
-        if not did:
+        if did is None:
             did = soup
 
+        # Walk the did once and pick the elements out of the index rather than searching
+        # the did again for every field
+        elements = index_elements(did)
+
         aid.level = component_level
 
-        title = did.find('unittitle')
-        if FindingAid.legit_component(title, component_level):
-            aid.title = title.string
+        title = first(elements, 'unittitle')
+        if title is not None:
+            aid.title = get_string(title)
 
         try:
             if not aid.title:
-                if title:
-                    searched_title = title.next
-                    if searched_title:
-                        aid.title = searched_title.string
+                if title is not None:
+                    if title.text:
+                        aid.title = title.text
+                    elif len(title):
+                        aid.title = get_string(title[0])
 
             if not aid.title:
-                subtitle = title.find('title')
-                if subtitle:
-                    aid.title = subtitle.string
+                subtitle = find(title, 'title')
+                if subtitle is not None:
+                    aid.title = get_string(subtitle)
 
         except Exception as ex:
             print('Error getting title')
@@ -672,43 +866,43 @@ class FindingAid(models.Model):
         if not aid.title:
             aid.title = "No title"
         
-        dates = did.find_all('unitdate') 
+        dates = elements.get('unitdate', []) 
         for date in dates: 
-            if date.has_attr('type'):
-                attribute = date['type']
+            if 'type' in date.attrib:
+                attribute = date.get('type')
                 if attribute == "bulk":
-                    aid.date = aid.date + " [bulk " + date.string + "]"   
+                    aid.date = aid.date + " [bulk " + get_text(date) + "]"   
                 else:
-                    aid.date = aid.date + " " + date.string
+                    aid.date = aid.date + " " + get_text(date)
             else:
-                aid.date = date.string
+                aid.date = get_text(date)
         if aid.date:
             aid.date = aid.date.strip()    
 
-        containers = did.find_all('container') 
+        containers = elements.get('container', []) 
         for container in containers:
-            if container.has_attr('type'):
-                aid.container = aid.container + container['type']
-            if container.string:
-                aid.container = aid.container + " " + container.string + " "   
-
-        repository = did.find('repository')
-        if FindingAid.legit_component(repository, component_level):
-            corpname = repository.find('corpname')
-            if corpname:
-                aid.intra_repository = corpname.string
+            if 'type' in container.attrib:
+                aid.container = aid.container + container.get('type')
+            if get_string(container):
+                aid.container = aid.container + " " + get_string(container) + " "   
+
+        repository = first(elements, 'repository')
+        if repository is not None:
+            corpname = find(repository, 'corpname')
+            if corpname is not None:
+                aid.intra_repository = get_string(corpname) or ""
             else:
                 aid.intra_repository = ""
 
-        reference_codes = did.find_all('unitid') 
+        reference_codes = elements.get('unitid', []) 
         for entry in reference_codes:
-            aid.reference_code = aid.reference_code + entry.string + "; "
+            aid.reference_code = aid.reference_code + get_text(entry) + "; "
 
         # Multiple creators looks a little weird with this technique
-        creator = did.find_all('origination') 
+        creator = elements.get('origination', []) 
         if creator:
             for entry in creator:
-                aid.creator = aid.creator + entry.get_text() + " "
+                aid.creator = aid.creator + get_text(entry) + " "
             aid.creator = cleanhtml(str(aid.creator))
             aid.creator = aid.creator.strip()
 
@@ -720,74 +914,45 @@ class FindingAid(models.Model):
         #     aid.extent = physdesc.get_text()
         #     aid.extent = cleanhtml(str(aid.extent))
 
-        physdescs = did.find_all('extent') 
+        physdescs = elements.get('extent', []) 
         for entry in physdescs:
-            aid.extent = aid.extent + entry.string + "; "
-
-        aid.abstract = String_or_p_tag(did, 'abstract')
+            aid.extent = aid.extent + get_text(entry) + "; "
 
-        # abstract = did.find('abstract')
-        # if abstract:
-        #     aid.abstract = abstract.string
-
-        # if not aid.abstract:
-        #     searched_abstract = abstract.next
-        #     if searched_abstract:
-        #         aid.abstract = searched_abstract.string
+        aid.abstract = String_or_p_element(first(elements, 'abstract'))
 
         # First see if langmaterial has text
-        languages = did.find_all('langmaterial')
+        languages = elements.get('langmaterial', [])
         for lang in languages:
-            aid.languages = aid.languages  + " " + lang.get_text()
+            aid.languages = aid.languages  + " " + get_text(lang)
 
         # If there is no langmaterial text, look for languages
         aid.languages = aid.languages.strip()
         if not aid.languages:
-            languages = did.find_all('language')
+            languages = elements.get('language', [])
             for lang in languages:
-                if lang.string:
-                    aid.languages = aid.languages + " " + lang.string 
+                if get_string(lang):
+                    aid.languages = aid.languages + " " + get_string(lang) 
                 else:
                     # If no language text, pull the langcode
-                    aid.languages = lang['langcode']
+                    aid.languages = lang.get('langcode', "")
 
         # Although the following are not necessarily in the high did, they are here because
         # they may be contained in a <cXX>
 
         # There can be multiple accessrestrict entries
-        aid.governing_access = String_or_p_tag(did, 'accessrestrict')
-        # governing_access = did.find_all('accessrestrict') 
-        # if governing_access:
-        #     for entry in governing_access:
-        #         aid.governing_access = aid.governing_access + entry.get_text() + " "
-        #     aid.governing_access = cleanhtml(str(aid.governing_access))
-        #     aid.governing_access = aid.governing_access.strip()
-
-        aid.rights = String_or_p_tag(did, 'userestrict')
-        aid.citation = String_no_p_tag(did, 'prefercite')
-
-        aid.bioghist = String_or_p_tag(did, 'bioghist')
-        aid.scope_and_content = String_or_p_tag(did, 'scopecontent')
-        aid.originals_location = String_or_p_tag(did, 'originalsloc')
-        aid.note = String_or_p_tag(did, 'note')
-
-        return aid
-
-    def legit_component(component, component_level):
-
-        if not component:
-            return False
+        aid.governing_access = String_or_p_element(first(elements, 'accessrestrict'))
 
-        component_parent = component.parent
-        if component_parent.name == "did":
-            component_parent = component_parent.parent
+        aid.rights = String_or_p_element(first(elements, 'userestrict'))
+        aid.citation = String_no_p_element(first(elements, 'prefercite'))
 
-        if component_parent.name == component_level:
-            return True
+        aid.bioghist = String_or_p_element(first(elements, 'bioghist'))
+        aid.scope_and_content = String_or_p_element(first(elements, 'scopecontent'))
+        aid.originals_location = String_or_p_element(first(elements, 'originalsloc'))
+        aid.note = String_or_p_element(first(elements, 'note'))
 
-        return False
+        return aid
 
-    def process_components(real_soup, soup, progenitorID, parentID, component_level):
+    def process_components(soup, component_level):
 
         # Process this level
         current_level = ""
@@ -798,64 +963,424 @@ class FindingAid(models.Model):
 
         aid = FindingAid()
 
-        # did = soup.find('did')
-        # if did:
-        #     aid = FindingAid.ParseDid(did, aid, current_level)
-        # else:
-        aid = FindingAid.ParseDid(soup, aid, current_level)
+        aid = FindingAid.parse_did(soup, aid, current_level)
 
         if not aid.scope_and_content:
-            # aid.scope_and_content = String_or_p_tag(soup, 'scopecontent')
 
-                entries = soup.find_all('scopecontent')
-                if entries:
-                    entry = entries[0]
+                # Only the component's own scopecontent, its children have not been read yet
+                entry = soup.find('scopecontent')
+                if entry is not None:
 
                     # finding tag whose child to be deleted
-                    div_bs4 = entry.find('head')
+                    div_bs4 = find(entry, 'head')
                     
                     # delete the child element
-                    if div_bs4:
-                        div_bs4.clear()
+                    if div_bs4 is not None:
+                        empty(div_bs4)
 
-                    element = entry.find('title')
-                    if element:
-                        new_tag = real_soup.new_tag("i")
-                        new_tag.string = element.string
-                        element.replace_with(new_tag)
+                    element = find(entry, 'title')
+                    if element is not None:
+                        string = get_string(element)
+                        empty(element)
+                        element.tag = "i"
+                        element.text = string
 
-                    aid.scope_and_content = str(entry)
+                    aid.scope_and_content = to_markup(entry)
 
-        aid.progenitorID = progenitorID
-        aid.parentID = parentID
+        # The progenitor and parent are filled in by make_ead and the ComponentWriter
         aid.component = current_level
 
         for x in range(1, component_level):
             aid.indent = aid.indent + "&nbsp;&nbsp;"
 
-        aid.save()
+        return aid
+    
+class ComponentWriter:
+    '''
+    Buffers the <cXX> components of a finding aid and writes them with bulk_create.
+
+    Keys are handed out as components are added, so a child's parentID is known before
+    its parent is written and the components keep document order.  Where the database
+    can't hand out keys (see reserve_ids) each component is saved as it is added instead.
+    It has to be used inside the transaction that saved the progenitor.
+    '''
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or getattr(settings, 'INGEST_BATCH_SIZE', 1000)
+        self.pending = []
+        self.ids = iter(())
+        self.last_id = 0
+        self.count = 0
+
+    def add(self, aid, parent):
+        aid.pk = self.next_id()
+        aid.parentID = parent.pk
+        if aid.pk is None:
+            aid.save(index=False)
+            self.count = self.count + 1
+            return
+        aid.path = parent.path + tree_segment(aid.pk)
+        self.pending.append(aid)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            FindingAid.objects.bulk_create(self.pending, batch_size=self.batch_size)
+            self.count = self.count + len(self.pending)
+            self.pending = []
+
+    def next_id(self):
+        id = next(self.ids, None)
+        if id is None:
+            self.ids = iter(reserve_ids(FindingAid, self.batch_size, self.last_id) or ())
+            id = next(self.ids, None)
+        self.last_id = id
+        return id
+
+class MARCWriter:
+    '''
+    Writes finding aids made from MARC records with bulk_create, batch_size at a time.  Each
+    batch is written in its own transaction together with its control access rows and outbox
+    entries.  A finding aid added with the key of an existing one replaces it and keeps the key.
+
+    add() and flush() return (tag, aid) for each finding aid written, tag being whatever was
+    passed to add() for it.
+    '''
+
+    def __init__(self, repository, user=None, batch_size=None):
+        self.repository = repository
+        self.user = user
+        self.batch_size = batch_size or getattr(settings, 'INGEST_BATCH_SIZE', 1000)
+        self.pending = []
+        self.count = 0
+
+    def add(self, aid, entries, replaces=None, tag=None):
+        self.pending.append((aid, entries, replaces, tag))
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self.pending:
+            return []
+
+        pending, self.pending = self.pending, []
+        with transaction.atomic():
+            # Replaced finding aids are removed without their delete(), the index entries are
+            # overwritten under the same key rather than deleted
+            replaced = [replaces for aid, entries, replaces, tag in pending if replaces]
+            if replaced:
+                FindingAid.objects.filter(pk__in=replaced).delete()
+
+            ids = iter(reserve_ids(FindingAid, len(pending) - len(replaced)) or ())
+            now = timezone.now()
+            inserted = []
+            for aid, entries, replaces, tag in pending:
+                aid.pk = replaces or next(ids, None)
+                aid.repository = self.repository
+                aid.last_update = now
+                aid.updated_by = self.user
+                if aid.pk is None:
+                    # The database couldn't hand out keys, so the row is inserted for one
+                    aid.save(index=False)
+                    inserted.append(aid)
+                aid.path = tree_segment(aid.pk)
+                aid.ark = "ark://" + str(aid.pk)
+                aid.snac = "https://snaccooperative.org"
+                aid.wiki = "https://www.wikidata.org"
+                aid.elasticsearch_id = str(aid.pk)
+
+            FindingAid.objects.bulk_create([aid for aid, entries, replaces, tag in pending if aid._state.adding],
+                                           batch_size=self.batch_size)
+            if inserted:
+                FindingAid.objects.bulk_update(inserted, ['ark', 'snac', 'wiki', 'elasticsearch_id'], batch_size=self.batch_size)
+
+            all_entries = [(control_type, term, link) for aid, entries, replaces, tag in pending for control_type, term, link in entries]
+            term_ids = control_terms.ids(all_entries)
+            ControlAccess.objects.bulk_create([ControlAccess(finding_aid_id=aid.pk, control_term_id=term_ids[entry])
+                                               for aid, entries, replaces, tag in pending for entry in entries],
+                                              batch_size=self.batch_size)
+
+            SearchOutbox.objects.bulk_create([SearchOutbox(findingAidID=aid.pk, elasticsearch_id=aid.elasticsearch_id)
+                                              for aid, entries, replaces, tag in pending],
+                                             batch_size=self.batch_size)
+
+        self.count = self.count + len(pending)
+        return [(tag, aid) for aid, entries, replaces, tag in pending]
+
+# Materialized paths are the keys from the finding aid down, zero padded so that the rows of a
+# subtree sort together and, as keys are handed out in document order, in document order
+PATH_DIGITS = 10
+
+def tree_segment(pk):
+    return '%0*d/' % (PATH_DIGITS, pk)
+
+def reserve_ids(model, count, after=0):
+    '''
+    Hands out count primary keys for rows of model not yet written.  Returns None on
+    databases other than PostgreSQL and SQLite, where the rows get their keys as they are
+    inserted instead.
+    '''
+    table = connection.ops.quote_name(model._meta.db_table)
+
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return None
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)", [model._meta.db_table, count])
+            return [row[0] for row in cursor.fetchall()]
+
+        # SQLite only allows one writer, so take the write lock before reading anything, a
+        # write statement takes it even when it changes no rows.  Keys start after the
+        # AUTOINCREMENT counter in sqlite_sequence rather than MAX(id) so the keys of deleted
+        # rows are never handed out again, and the counter is moved past the reserved keys so
+        # neither a later insert nor a later reservation reuses them.  after skips keys handed
+        # out but not yet written.
+        name = model._meta.db_table
+        cursor.execute("UPDATE sqlite_sequence SET seq = seq WHERE name = %s", [name])
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [name])
+        row = cursor.fetchone()
+        cursor.execute("SELECT MAX(id) FROM " + table)
+        start = max(row[0] if row else 0, cursor.fetchone()[0] or 0, after) + 1
+        if row:
+            cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [start + count - 1, name])
+        else:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [name, start + count - 1])
+        return range(start, start + count)
+
+class ControlTermCache:
+    '''
+    ControlTerm ids by (control_type, term, link), kept between finding aids so an ingest
+    only goes to the database for terms it hasn't seen yet.  Missing terms are created in
+    the caller's transaction and only cached once it commits.
+    '''
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or getattr(settings, 'CONTROL_TERM_CACHE_SIZE', 100000)
+        self.cache = {}
+
+    def ids(self, entries):
+        found = {entry: self.cache[entry] for entry in entries if entry in self.cache}
+        missing = set(entries) - set(found)
+        if not missing:
+            return found
+
+        fetched = self.fetch(missing)
+        new = missing - set(fetched)
+        if new:
+            ControlTerm.objects.bulk_create([ControlTerm(control_type=control_type, term=term, link=link)
+                                             for control_type, term, link in new], ignore_conflicts=True)
+            fetched.update(self.fetch(new))
+
+        transaction.on_commit(lambda: self.remember(fetched))
+        found.update(fetched)
+        return found
+
+    def fetch(self, entries):
+        # One query per few hundred distinct terms, matched up here
+        ids = {}
+        terms = sorted({term for control_type, term, link in entries})
+        for start in range(0, len(terms), 500):
+            rows = ControlTerm.objects.filter(term__in=terms[start:start + 500]).values_list('control_type', 'term', 'link', 'id')
+            for control_type, term, link, id in rows:
+                if (control_type, term, link) in entries:
+                    ids[(control_type, term, link)] = id
+        return ids
+
+    def remember(self, ids):
+        if len(self.cache) + len(ids) > self.max_size:
+            self.cache.clear()
+        self.cache.update(ids)
+
+    def clear(self):
+        self.cache.clear()
+
+control_terms = ControlTermCache()
+
+# Changes waiting to be sent to the search engine.  Entries are written in the same transaction
+# as the finding aid and removed by the outbox worker (drain_search_outbox) once the index has
+# them, so the database and the index can't drift apart for good.
+class SearchOutbox(models.Model):
+    # Not a foreign key, deletes have to outlive the finding aid
+    findingAidID = models.IntegerField()
+    elasticsearch_id = models.CharField(max_length=32, blank=True)
 
-        # Process the children
-        component_level = component_level + 1
+    INDEX = 'I'
+    DELETE = 'D'
+    OPERATIONS = [(INDEX, 'Index'), (DELETE, 'Delete')]
+    operation = models.CharField(max_length=1, choices=OPERATIONS, default=INDEX)
 
-        if component_level < 10:
-            search_for = "c0" + str(component_level)
-        else:
-            search_for = "c" + str(component_level)
-
-        components = soup.find_all(search_for)
-        for component in components:
-            # did = component.find('did')
-            # if did:
-            #     FindingAid.ProcessComponents(did, progenitorID, aid.pk, component_level)
-            # else:
-                FindingAid.ProcessComponents(real_soup, component, progenitorID, aid.pk, component_level)
-    
-class ControlAccess(models.Model):
-    finding_aid = models.ForeignKey('FindingAid', on_delete=models.CASCADE)
+    # Index the components linked to the finding aid by progenitorID as well
+    components = models.BooleanField(default=False)
+
+    created = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def enqueue(aid, operation=INDEX, components=False):
+        return SearchOutbox.objects.create(findingAidID=aid.pk,
+                                           elasticsearch_id=document_id(aid),
+                                           operation=operation,
+                                           components=components)
+
+    def __str__(self):
+        return f'{self.get_operation_display()} {self.findingAidID}'
+
+# A run of a harvest profile, queued by the schedule or a user and run by the harvest_worker
+# command.  The table is the queue: workers claim QUEUED jobs by switching them to RUNNING, and
+# report progress and a heartbeat on the row while they run.
+class HarvestJob(models.Model):
+    profile = models.ForeignKey('HarvestProfile', on_delete=models.CASCADE)
+    user = models.ForeignKey('User', null=True, blank=True, on_delete=models.SET_NULL)
+    full = models.BooleanField(default=False)
+
+    QUEUED = 'Q'
+    RUNNING = 'R'
+    FINISHED = 'F'
+    FAILED = 'X'
+    STATUSES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (FINISHED, 'Finished'), (FAILED, 'Failed')]
+    status = models.CharField(max_length=1, choices=STATUSES, default=QUEUED)
+
+    # Seconds the profile's last finished harvest took, the shortest jobs are run first
+    estimate = models.IntegerField(default=0)
+
+    queued = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=255, blank=True)
+
+    ingested = models.IntegerField(default=0)
+    unchanged = models.IntegerField(default=0)
+    deleted = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    last_record = models.CharField(max_length=255, blank=True)
+    message = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'estimate', 'queued'], name='harvest_job_queue')]
+
+    def processed(self):
+        return self.ingested + self.unchanged + self.deleted + self.failed + self.skipped
+
+    def duration(self):
+        if self.started is None:
+            return None
+        # To the second, for display
+        return timedelta(seconds=int(((self.finished or timezone.now()) - self.started).total_seconds()))
+
+    def __str__(self):
+        return f'{self.profile} {self.get_status_display()}'
+
+# Text extracted from a range of pages of a PDF, by the SHA-256 of the file.  Pages are
+# numbered from 0 and last_page is the first page after the range.
+class PDFText(models.Model):
+    content_hash = models.CharField(max_length=64)
+    first_page = models.IntegerField()
+    last_page = models.IntegerField()
+    page_count = models.IntegerField()
+    text = models.TextField(blank=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['content_hash', 'first_page'], name='unique_pdf_pages')]
+
+    def __str__(self):
+        return f'{self.content_hash[:12]} pages {self.first_page + 1}-{self.last_page}'
+
+# Bumped whenever the live index changes, cached search results from an older generation are
+# never used again.  A single row.
+class SearchGeneration(models.Model):
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.value)
+
+# Controlled vocabulary shared by all finding aids, one row per control type (persname,
+# subject, ...), term and authority file number (link)
+class ControlTerm(models.Model):
+    control_type = models.CharField(max_length=32)
     term = models.CharField(max_length=255, blank=True)
     link = models.CharField(max_length=1255, blank=True)
-    control_type = models.CharField(max_length=1255, blank=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['control_type', 'term', 'link'], name='unique_control_term')]
+
+    def __str__(self):
+        return self.term
+
+    def save(self, *args, **kwargs):
+        # A new term isn't used by anything yet
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if not adding:
+                self.changed()
+        # An edited term is no longer what it was cached under
+        control_terms.clear()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self.changed()
+            result = super().delete(*args, **kwargs)
+        # Ingests in this process mustn't refer to it any more
+        control_terms.clear()
+        return result
+
+    def changed(self):
+        # The finding aids using the term show it and have it in their index documents.  Their
+        # control access rows and the finding aids are marked as changed, which index_changes,
+        # the suggestions and the fragment cache go by, and the finding aids are queued for
+        # indexing.  Terms only belong to archdescs, so there are no progenitors to touch.
+        now = timezone.now()
+        access = ControlAccess.objects.filter(control_term_id=self.pk)
+        aids = FindingAid.objects.filter(pk__in=access.values('finding_aid_id'))
+        SearchOutbox.objects.bulk_create([SearchOutbox(findingAidID=aid.pk, elasticsearch_id=document_id(aid))
+                                          for aid in aids.only('pk', 'elasticsearch_id').iterator()],
+                                         batch_size=1000)
+        aids.update(modified=now)
+        access.update(modified=now)
+
+# Base of the rows that belong to one finding aid
+class FindingAidPart(models.Model):
+    '''
+    A row shown on its finding aid's page.  Saving or deleting one touches the finding aid so
+    the page isn't served from fragments cached before the change.  The bulk inserts and
+    deletes of an ingest go around this, but they save the finding aid itself.
+    '''
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        FindingAid.touch(self.finding_aid_id)
+
+    def delete(self, *args, **kwargs):
+        FindingAid.touch(self.finding_aid_id)
+        return super().delete(*args, **kwargs)
+
+# The control access terms of a finding aid
+class ControlAccess(FindingAidPart):
+    finding_aid = models.ForeignKey('FindingAid', on_delete=models.CASCADE)
+    control_term = models.ForeignKey('ControlTerm', on_delete=models.PROTECT)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return str(self.control_term)
+
+# High-water marks for index_changes, one per named delta sync.  position is when the last
+# run that indexed everything successfully started.
+class SearchCheckpoint(models.Model):
+    name = models.CharField(max_length=32, unique=True)
+    position = models.DateTimeField(null=True, blank=True)
+    last_run = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
 
 # Audits of Finding Aid creation and modification
 class FindingAidAudit(models.Model):
@@ -867,7 +1392,7 @@ class FindingAidAudit(models.Model):
     def __str__(self):
         return self.revision_notes
 
-class Chronology(models.Model):
+class Chronology(FindingAidPart):
     finding_aid = models.ForeignKey('FindingAid', on_delete=models.CASCADE)
     date = models.CharField(max_length=255, blank=True)
     event = models.CharField(max_length=1255, blank=True)
@@ -876,7 +1401,7 @@ class Chronology(models.Model):
 # Used to add Subject Headers for a finding aid to be used with searches.  These have not been added to
 # the Elasticsearch functionality.  I believe the desired implementation is to have them as available values
 # per repository and then make them available to select at the finding aid level.
-class SubjectHeader(models.Model):
+class SubjectHeader(FindingAidPart):
     finding_aid = models.ForeignKey('FindingAid', on_delete=models.CASCADE)
     subject_header = models.CharField(max_length=255, blank=True)
 
@@ -901,26 +1426,23 @@ def strip_p(text):
   return cleantext
 
 def String_or_p_tag(soup, tag):
+    return String_or_p_element(find(soup, tag))
+
+def String_or_p_element(element):
 
     # Need to consider multiple <p> tags within a tag
 
     response = ""
-    element = soup.find(tag)
-    if element:
+    if element is not None:
 
-        div_bs4 = element.find('head')
+        div_bs4 = find(element, 'head')
                 
         # # delete the child element
-        if div_bs4:
-            div_bs4.clear()
+        if div_bs4 is not None:
+            empty(div_bs4)
 
-        response = element.string
-
-        # If the return_value is blank, see if they put in a <p> entries
-        if not response:
-            response = str(element)
-
-        response = element.get_text()
+        # Covers both plain text and text split across <p> entries
+        response = get_text(element)
 
     if not response:
         response = ""
@@ -928,17 +1450,21 @@ def String_or_p_tag(soup, tag):
     return response
 
 def String_no_p_tag(soup, tag):
+    return String_no_p_element(find(soup, tag))
+
+def String_no_p_element(element):
 
     # Need to consider multiple <p> tags within a tag
 
     response = ""
-    element = soup.find(tag)
-    if element:
-        response = element.string
+    if element is not None:
+        response = get_string(element)
 
         # If the return_value is blank, see if they put in a <p> entries
         if not response:
-            response = element.p.string
+            p = find(element, 'p')
+            if p is not None:
+                response = get_string(p)
 
     if not response:
         response = ""
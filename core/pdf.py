@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from concurrent.futures import as_completed
+from datetime import timedelta
+import hashlib, re
+
+from PyPDF2 import PdfReader
+
+# PDF finding aids
+#
+# Scanned and OCRed guides run to hundreds of pages, so their text is pulled out by a pool of
+# processes, PDF_PAGES_PER_TASK pages per task.  Each range of pages is saved (PDFText) under
+# the SHA-256 of the file as soon as it is done, so an interrupted extraction carries on where
+# it stopped and a file uploaded again with the same contents does no extraction at all.  The
+# first PDF_SUMMARY_LENGTH characters become the finding aid's scope and content and the full
+# text goes to the search index (finding_aid_document).
+
+def file_hash(field_file):
+    digest = hashlib.sha256()
+    with field_file.open('rb') as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def page_count(path):
+    return len(PdfReader(path).pages)
+
+def extract_pages(path, first, last):
+    # Runs in a pool process, the text of pages first to last - 1 with a form feed after each
+    reader = PdfReader(path)
+    pages = []
+    for number in range(first, last):
+        try:
+            pages.append(reader.pages[number].extract_text() or "")
+        except Exception as e:
+            # One damaged page shouldn't lose the rest of the range
+            pages.append("")
+            print(f'Unable to read page {number + 1} of {path} {e}')
+    return '\f'.join(pages) + '\f'
+
+def page_ranges(count, size):
+    return [(first, min(first + size, count)) for first in range(0, count, size)]
+
+def extract_text(digest, path, pool):
+    '''
+    Extracts the text of the PDF at path, whose SHA-256 is digest, into PDFText rows.  Ranges
+    already extracted are skipped.  Returns the number of ranges that had to be extracted.
+    '''
+    from .models import PDFText
+
+    done = set(PDFText.objects.filter(content_hash=digest).values_list('first_page', flat=True))
+    cached = PDFText.objects.filter(content_hash=digest).first()
+    count = cached.page_count if cached else page_count(path)
+
+    size = getattr(settings, 'PDF_PAGES_PER_TASK', 20)
+    missing = [(first, last) for first, last in page_ranges(count, size) if first not in done]
+    if not missing:
+        return 0
+
+    futures = {pool.submit(extract_pages, path, first, last): (first, last) for first, last in missing}
+    for future in as_completed(futures):
+        first, last = futures[future]
+        PDFText.objects.get_or_create(content_hash=digest, first_page=first,
+                                      defaults={'last_page': last, 'page_count': count, 'text': future.result()})
+    return len(missing)
+
+def pdf_text(digest):
+    # The extracted text of a file, one range of pages at a time
+    from .models import PDFText
+
+    for text in PDFText.objects.filter(content_hash=digest).order_by('first_page').values_list('text', flat=True).iterator():
+        yield text
+
+def summarize(texts, length=None):
+    # The start of the text with the white space collapsed, cut at a word
+    length = length or getattr(settings, 'PDF_SUMMARY_LENGTH', 2000)
+
+    summary = ""
+    for text in texts:
+        summary = (summary + " " + re.sub(r'\s+', ' ', text)).strip()
+        if len(summary) > length:
+            return summary[:length].rsplit(' ', 1)[0] + " ..."
+    return summary
+
+def extract_finding_aid(aid, pool):
+    '''
+    Brings a PDF finding aid's scope and content and search index entry up to date with its
+    associated_file.  Returns the number of ranges of pages that had to be extracted.
+    '''
+    from .models import FindingAid
+
+    try:
+        digest = file_hash(aid.associated_file)
+        extracted = extract_text(digest, aid.associated_file.path, pool)
+    except Exception as e:
+        # Tried again later with a growing delay, up to PDF_EXTRACT_ATTEMPTS times, a broken
+        # pool or a locked database passes but a damaged file keeps failing
+        attempts = aid.extract_attempts + 1
+        FindingAid.objects.filter(pk=aid.pk).update(extract_attempts=attempts,
+                                                    extract_after=timezone.now() + timedelta(seconds=min(60 * 2 ** attempts, 86400)),
+                                                    extract_error=str(e) or e.__class__.__name__)
+        raise
+
+    with transaction.atomic():
+        aid.scope_and_content = summarize(pdf_text(digest))
+        aid.file_hash = digest
+        aid.extract_attempts = 0
+        aid.extract_after = None
+        aid.extract_error = ""
+        # Saving queues the finding aid, and so its full text, for indexing
+        aid.save(update_fields=['scope_and_content', 'file_hash', 'extract_attempts', 'extract_after', 'extract_error',
+                                'modified'])
+
+    return extracted
+
+def pending_pdfs():
+    # PDF finding aids whose file hasn't been read since it was uploaded, leaving out those
+    # waiting to be tried again and those that have failed too often
+    from .models import FindingAid
+
+    return (FindingAid.objects.filter(record_type=FindingAid.PDF, progenitorID=0, file_hash="",
+                                      extract_attempts__lt=getattr(settings, 'PDF_EXTRACT_ATTEMPTS', 5))
+                              .filter(Q(extract_after__isnull=True) | Q(extract_after__lte=timezone.now()))
+                              .exclude(associated_file=""))
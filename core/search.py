@@ -0,0 +1,545 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from elasticsearch import Elasticsearch, NotFoundError, helpers
+from elasticsearch_dsl import Q as SearchQ, Search
+
+from .pdf import pdf_text
+
+from collections import deque
+from datetime import timedelta
+from itertools import islice
+
+import base64, hashlib, json, os, re, threading, time
+
+# Elasticsearch client
+#
+# Creating an Elasticsearch client sets up a new connection pool, so everything that talks
+# to the search engine shares one client per process.  The client keeps its connections
+# alive between requests and is rebuilt if the process forks.
+
+client = None
+client_pid = None
+client_lock = threading.Lock()
+
+def get_client():
+    global client, client_pid
+
+    if client is None or client_pid != os.getpid():
+        with client_lock:
+            if client is None or client_pid != os.getpid():
+                client = Elasticsearch(getattr(settings, 'ELASTICSEARCH_HOSTS', [{'host': 'localhost', 'port': 9200}]),
+                                       timeout=getattr(settings, 'ELASTICSEARCH_TIMEOUT', 10),
+                                       maxsize=getattr(settings, 'ELASTICSEARCH_MAXSIZE', 10),
+                                       max_retries=getattr(settings, 'ELASTICSEARCH_MAX_RETRIES', 3),
+                                       retry_on_timeout=True)
+                client_pid = os.getpid()
+
+    return client
+
+# Bulk indexing
+#
+# A finding aid and its components go to the search engine through the _bulk API in
+# batches, rather than one request per document.  Batches are capped both by count and
+# by size, and items the cluster rejects as overloaded or unavailable are sent again.
+
+# Item statuses worth sending again
+RETRY_STATUSES = (429, 502, 503, 504)
+
+def index_name():
+    return getattr(settings, 'ELASTICSEARCH_INDEX', 'nafan')
+
+def document_id(aid):
+    # Finding aids indexed one at a time have an id from Elasticsearch, anything else is
+    # indexed under its primary key
+    if aid.elasticsearch_id and aid.elasticsearch_id != "Fail":
+        return aid.elasticsearch_id
+    return str(aid.pk)
+
+def finding_aid_document(aid, repository, source="", terms=None):
+    # Same fields as FindingAid.create_index, plus the links between the archdesc and components
+    # and the fields searches are filtered and faceted on
+    from .models import FindingAid
+
+    date_from, date_to = date_range(aid.date)
+
+    if terms is None:
+        # Control access terms only belong to the archdesc
+        terms = [] if aid.progenitorID else aid.controlaccess_set.values_list('control_term__control_type', 'control_term__term')
+
+    return {'id': aid.pk,
+            'type': aid.record_type,
+            'title': aid.title,
+            'repository': repository.name,
+            'slug': repository.slug,
+            'content': aid.scope_and_content,
+            'source': source or aid.associated_file.name or "",
+            'destination': "",
+            'progenitor': aid.progenitorID,
+            'parent': aid.parentID,
+            'component': aid.component,
+            'date': aid.date,
+            'date_from': date_from,
+            'date_to': date_to,
+            'controlaccess': [{'type': control_type, 'term': term} for control_type, term in terms if term],
+            # The whole text of a PDF finding aid, once core/pdf.py has extracted it
+            'full_text': ''.join(pdf_text(aid.file_hash)) if aid.record_type == FindingAid.PDF and aid.file_hash else ""}
+
+def date_range(text):
+    # Earliest and latest year in a free text date such as "1890-1925 [bulk 1900-1910]"
+    years = [int(year) for year in re.findall(r'(?<!\d)(1\d{3}|20\d{2})(?!\d)', text or "")]
+    if not years:
+        return None, None
+    return min(years), max(years)
+
+def finding_aid_actions(aid, source="", index=None):
+    # The archdesc followed by all of its components, read from the database in chunks
+    from .models import FindingAid
+
+    index = index or index_name()
+    repository = aid.repository
+
+    yield {'_op_type': 'index', '_index': index, '_id': document_id(aid),
+           '_source': finding_aid_document(aid, repository, source)}
+
+    for component in FindingAid.objects.filter(progenitorID=aid.pk).order_by('pk').iterator(chunk_size=2000):
+        yield {'_op_type': 'index', '_index': index, '_id': document_id(component),
+               '_source': finding_aid_document(component, repository, source)}
+
+def bulk_index(actions, batch_size=None, max_bytes=None, max_retries=None, refresh=None, client=None):
+    '''
+    Sends index/update/delete actions through the _bulk API.  Returns the number of
+    actions that succeeded and a list of (action, error) for those that didn't.  With
+    refresh='wait_for' each batch returns only once its changes can be searched.
+    '''
+    client = client or get_client()
+    batch_size = batch_size or getattr(settings, 'ELASTICSEARCH_BULK_SIZE', 500)
+    max_bytes = max_bytes or getattr(settings, 'ELASTICSEARCH_BULK_BYTES', 10 * 1024 * 1024)
+    if max_retries is None:
+        max_retries = getattr(settings, 'ELASTICSEARCH_BULK_RETRIES', 3)
+
+    succeeded = 0
+    failed = []
+    actions = iter(actions)
+
+    for attempt in range(max_retries + 1):
+        retry = []
+
+        # streaming_bulk reports the items of each batch in order, so the actions in flight
+        # are kept to match them up with their results
+        sent = deque()
+
+        def tracked(actions):
+            for action in actions:
+                sent.append(action)
+                yield action
+
+        results = helpers.streaming_bulk(client, tracked(actions), chunk_size=batch_size, max_chunk_bytes=max_bytes,
+                                         raise_on_error=False, raise_on_exception=False, max_retries=0,
+                                         **({'refresh': refresh} if refresh else {}))
+
+        for ok, item in results:
+            action = sent.popleft()
+            if ok:
+                succeeded += 1
+                continue
+
+            error = next(iter(item.values()), {})
+            if action.get('_op_type') == 'delete' and error.get('status') == 404:
+                # Already gone
+                succeeded += 1
+            elif (error.get('status') in RETRY_STATUSES or 'exception' in error) and attempt < max_retries:
+                retry.append(action)
+            else:
+                failed.append((action, error))
+
+        if not retry:
+            break
+
+        time.sleep(min(2 ** attempt, 30))
+        actions = iter(retry)
+
+    return succeeded, failed
+
+def index_finding_aid(aid, source="", **kwargs):
+    # Indexes the finding aid and every component linked to it by progenitorID
+    return bulk_index(finding_aid_actions(aid, source), **kwargs)
+
+# Outbox
+#
+# Finding aid changes are queued in SearchOutbox in the same transaction that makes them.
+# drain_outbox claims a batch of entries, sends them with bulk_index and removes the ones
+# the index accepted.  Failures are tried again later with a growing delay, and never dropped.
+
+def drain_outbox(batch_size=None, lease=300):
+    '''
+    Sends one batch of queued changes to the search engine.  Returns the number of
+    entries handled and the number that will be tried again.
+    '''
+    from .models import FindingAid, SearchOutbox
+
+    batch_size = batch_size or getattr(settings, 'SEARCH_OUTBOX_BATCH_SIZE', 200)
+    now = timezone.now()
+
+    # Claim the entries so another worker leaves them alone while they are being sent
+    with transaction.atomic():
+        entries = SearchOutbox.objects.filter(available_at__lte=now).order_by('pk')
+        if connection.features.has_select_for_update_skip_locked:
+            entries = entries.select_for_update(skip_locked=True)
+        entries = list(entries[:batch_size])
+        SearchOutbox.objects.filter(pk__in=[entry.pk for entry in entries]).update(available_at=now + timedelta(seconds=lease))
+
+    if not entries:
+        return 0, 0
+
+    # Only the latest change to a finding aid needs sending
+    changes = {}
+    for entry in entries:
+        changes.setdefault(entry.findingAidID, []).append(entry)
+
+    aids = FindingAid.objects.select_related('repository').in_bulk(list(changes))
+
+    # Document id to finding aid, so failures can be traced back to their entries
+    owners = {}
+
+    def actions():
+        for findingAidID, group in changes.items():
+            latest = group[-1]
+            aid = aids.get(findingAidID)
+
+            if latest.operation == SearchOutbox.DELETE or aid is None:
+                owners[latest.elasticsearch_id] = findingAidID
+                yield {'_op_type': 'delete', '_index': index_name(), '_id': latest.elasticsearch_id}
+            elif any(entry.components for entry in group):
+                for action in finding_aid_actions(aid):
+                    owners[action['_id']] = findingAidID
+                    yield action
+            else:
+                owners[document_id(aid)] = findingAidID
+                yield {'_op_type': 'index', '_index': index_name(), '_id': document_id(aid),
+                       '_source': finding_aid_document(aid, aid.repository)}
+
+    # The generation only moves on once the changes can be searched, or a search in between
+    # would cache the old results under the new generation
+    succeeded, failed = bulk_index(actions(), refresh='wait_for')
+    if succeeded:
+        bump_generation()
+
+    errors = {}
+    for action, error in failed:
+        errors.setdefault(owners.get(action['_id']), str(error))
+
+    for findingAidID, group in changes.items():
+        if findingAidID in errors:
+            for entry in group:
+                entry.attempts = entry.attempts + 1
+                entry.available_at = timezone.now() + timedelta(seconds=min(30 * 2 ** entry.attempts, 3600))
+                entry.last_error = errors[findingAidID]
+            SearchOutbox.objects.bulk_update(group, ['attempts', 'available_at', 'last_error'])
+        else:
+            SearchOutbox.objects.filter(pk__in=[entry.pk for entry in group]).delete()
+
+    return len(entries), sum(len(changes[findingAidID]) for findingAidID in errors if findingAidID in changes)
+
+# Delta indexing
+#
+# FindingAid (archdescs and components alike) and ControlAccess rows carry a modified
+# timestamp.  index_changes re-indexes the finding aids changed since the last successful run,
+# recorded in SearchCheckpoint, and only moves the checkpoint on once the index has accepted
+# everything.  Each run reaches back ELASTICSEARCH_DELTA_OVERLAP seconds before the checkpoint
+# so rows written by transactions still open during the previous run aren't missed; indexing a
+# document twice does no harm.  Deletes aren't visible here and go through the outbox.
+
+def changed_finding_aids(since=None):
+    from .models import ControlAccess, FindingAid
+
+    aids = FindingAid.objects.select_related('repository').order_by('pk')
+    if since is not None:
+        terms = ControlAccess.objects.filter(modified__gte=since).values('finding_aid_id')
+        aids = aids.filter(Q(modified__gte=since) | Q(pk__in=terms))
+    return aids
+
+def index_changes(name='default', since=None, batch_size=None, client=None):
+    '''
+    Indexes everything changed since the checkpoint called name, or since the given time.
+    With neither, everything is indexed.  Returns the number of documents indexed and a
+    list of (action, error) for those that failed.
+    '''
+    from .models import SearchCheckpoint
+
+    started = timezone.now()
+    checkpoint, _ = SearchCheckpoint.objects.get_or_create(name=name)
+
+    if since is None and checkpoint.position is not None:
+        since = checkpoint.position - timedelta(seconds=getattr(settings, 'ELASTICSEARCH_DELTA_OVERLAP', 60))
+
+    def actions():
+        for aid in changed_finding_aids(since).iterator(chunk_size=2000):
+            yield {'_op_type': 'index', '_index': index_name(), '_id': document_id(aid),
+                   '_source': finding_aid_document(aid, aid.repository)}
+
+    succeeded, failed = bulk_index(actions(), batch_size=batch_size, refresh='wait_for', client=client)
+    if succeeded:
+        bump_generation()
+
+    if not failed:
+        checkpoint.position = started
+    checkpoint.save()
+
+    return succeeded, failed
+
+# Versioned indexes
+#
+# The index name in ELASTICSEARCH_INDEX is an alias.  A full reindex loads a new
+# <name>_<timestamp> index alongside the live one and then moves the alias over in a single
+# _aliases call, so searches never see a missing or half built index.  Writes made while
+# the new index loads still go to the old one through the alias, so once the alias has moved
+# the reindex indexes what changed since it started and prunes what was deleted meanwhile.
+
+INDEX_MAPPING = {
+    # The full text of a PDF is searched but never returned, so it isn't kept in _source
+    '_source': {'excludes': ['full_text']},
+    'properties': {
+        'id': {'type': 'integer'},
+        'type': {'type': 'keyword'},
+        'title': {'type': 'text'},
+        'repository': {'type': 'text', 'fields': {'keyword': {'type': 'keyword'}}},
+        'slug': {'type': 'keyword'},
+        'content': {'type': 'text'},
+        'source': {'type': 'keyword'},
+        'destination': {'type': 'keyword'},
+        'progenitor': {'type': 'integer'},
+        'parent': {'type': 'integer'},
+        'component': {'type': 'keyword'},
+        'date': {'type': 'text', 'index': False},
+        'date_from': {'type': 'integer'},
+        'date_to': {'type': 'integer'},
+        'controlaccess': {'type': 'nested', 'properties': {'type': {'type': 'keyword'}, 'term': {'type': 'keyword'}}},
+        'full_text': {'type': 'text'},
+    }
+}
+
+def create_versioned_index(alias=None, client=None):
+    # A new, empty index for the alias, set up for loading: no refreshes and no replicas
+    client = client or get_client()
+    alias = alias or index_name()
+    name = alias + '_' + timezone.now().strftime('%Y%m%d%H%M%S')
+
+    client.indices.create(index=name, body={'settings': {'refresh_interval': '-1', 'number_of_replicas': 0},
+                                            'mappings': INDEX_MAPPING})
+    return name
+
+def finish_loading(name, client=None):
+    client = client or get_client()
+    client.indices.put_settings(index=name, body={'refresh_interval': '1s',
+                                                  'number_of_replicas': getattr(settings, 'ELASTICSEARCH_REPLICAS', 1)})
+    client.indices.refresh(index=name)
+
+def aliased_indexes(alias=None, client=None):
+    client = client or get_client()
+    alias = alias or index_name()
+    try:
+        return list(client.indices.get_alias(name=alias))
+    except NotFoundError:
+        return []
+
+def swap_alias(name, alias=None, client=None):
+    '''
+    Points the alias at the new index and returns the indexes it used to point at.  An
+    old unversioned index with the alias's name is removed in the same call.
+    '''
+    client = client or get_client()
+    alias = alias or index_name()
+
+    previous = aliased_indexes(alias, client)
+    actions = [{'remove': {'index': index, 'alias': alias}} for index in previous]
+    if not previous and client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': name, 'alias': alias}})
+
+    client.indices.update_aliases(body={'actions': actions})
+    return previous
+
+def prune_deleted(name, batch_size=2000, client=None):
+    '''
+    Deletes the documents in the index whose finding aid no longer exists.  Returns the
+    number deleted and a list of (action, error) for those that failed.
+    '''
+    from .models import FindingAid
+
+    client = client or get_client()
+
+    def actions():
+        hits = helpers.scan(client, index=name, query={'query': {'match_all': {}}}, _source=['id'], size=batch_size)
+        while True:
+            chunk = list(islice(hits, batch_size))
+            if not chunk:
+                break
+            existing = set(FindingAid.objects.filter(pk__in=[hit['_source']['id'] for hit in chunk])
+                           .values_list('pk', flat=True))
+            for hit in chunk:
+                if hit['_source']['id'] not in existing:
+                    yield {'_op_type': 'delete', '_index': name, '_id': hit['_id']}
+
+    return bulk_index(actions(), refresh='wait_for', client=client)
+
+# Search
+#
+# Public searches go to the alias through elasticsearch_dsl.  Results are paged with
+# search_after on (score, id) rather than from/size, so a deep page costs the same as the
+# first, and only the fields the result list shows come back.  Facets are only worked out
+# for the first page.
+
+RESULT_FIELDS = ['id', 'type', 'title', 'repository', 'slug', 'date', 'progenitor', 'component']
+
+# Request parameter to the keyword field it filters on
+TERM_FILTERS = {'repository': 'repository.keyword', 'type': 'type'}
+
+# Width in years of the date facet buckets
+DATE_INTERVAL = 50
+
+def search_finding_aids(text="", filters=None, after=None, size=None, client=None):
+    '''
+    Searches finding aids and components.  filters may hold repository, type, control_type,
+    control_term, date_from and date_to.  after is the cursor from the previous page.
+    Returns a dict of total, results, facets and the cursor for the next page.
+    '''
+    filters = filters or {}
+    size = min(size or getattr(settings, 'SEARCH_PAGE_SIZE', 20), 100)
+
+    search = Search(using=client or get_client(), index=index_name())
+
+    if text:
+        search = search.query('simple_query_string', query=text, fields=['title^3', 'content', 'full_text', 'repository'],
+                              default_operator='and')
+
+    for name, field in TERM_FILTERS.items():
+        if filters.get(name):
+            search = search.filter('term', **{field: filters[name]})
+
+    control = [SearchQ('term', **{'controlaccess.' + name: filters['control_' + name]})
+               for name in ('type', 'term') if filters.get('control_' + name)]
+    if control:
+        search = search.filter('nested', path='controlaccess', query=SearchQ('bool', filter=control))
+
+    # Anything whose dates overlap the range asked for
+    if filters.get('date_from') is not None:
+        search = search.filter('range', date_to={'gte': filters['date_from']})
+    if filters.get('date_to') is not None:
+        search = search.filter('range', date_from={'lte': filters['date_to']})
+
+    search = search.sort('_score', {'id': 'asc'}).source(RESULT_FIELDS).extra(size=size)
+
+    if after:
+        search = search.extra(search_after=after)
+    else:
+        search.aggs.bucket('repository', 'terms', field='repository.keyword', size=25)
+        search.aggs.bucket('type', 'terms', field='type')
+        search.aggs.bucket('controlaccess', 'nested', path='controlaccess') \
+            .bucket('type', 'terms', field='controlaccess.type', size=10) \
+            .bucket('term', 'terms', field='controlaccess.term', size=10) \
+            .bucket('aids', 'reverse_nested')
+        search.aggs.bucket('date', 'histogram', field='date_from', interval=DATE_INTERVAL, min_doc_count=1)
+
+    response = search.execute()
+    hits = list(response.hits)
+
+    results = {'total': response.hits.total.value,
+               'results': [hit.to_dict() for hit in hits],
+               'next': encode_cursor(hits[-1].meta.sort) if len(hits) == size else None}
+
+    if not after:
+        aggs = response.aggregations
+        results['facets'] = {
+            'repository': [{'value': b.key, 'count': b.doc_count} for b in aggs.repository.buckets],
+            'type': [{'value': b.key, 'count': b.doc_count} for b in aggs.type.buckets],
+            'controlaccess': [{'value': b.key, 'count': b.doc_count,
+                               'terms': [{'value': t.key, 'count': t.aids.doc_count} for t in b.term.buckets]}
+                              for b in aggs.controlaccess.type.buckets],
+            'date': [{'from': int(b.key), 'to': int(b.key) + DATE_INTERVAL - 1, 'count': b.doc_count}
+                     for b in aggs.date.buckets],
+        }
+
+    return results
+
+def encode_cursor(sort):
+    return base64.urlsafe_b64encode(json.dumps(list(sort)).encode()).decode()
+
+def decode_cursor(cursor):
+    # Raises ValueError for anything that isn't a cursor handed out by search_finding_aids
+    try:
+        sort = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(sort, list) or len(sort) != 2:
+        raise ValueError('Invalid cursor')
+    return sort
+
+# Search cache
+#
+# Searches are cached in the 'search' cache (see CACHES in settings) under the normalized
+# query, filters, cursor and page size.  The key also holds the index generation, which the
+# indexers bump whenever a change to the live index has become searchable, so older results
+# are never used again and age out of the cache.  The generation is read from the database at most once every
+# SEARCH_GENERATION_TTL seconds per process.
+
+generation = {'value': None, 'read': 0}
+
+def index_generation():
+    from .models import SearchGeneration
+
+    now = time.monotonic()
+    if generation['value'] is None or now - generation['read'] > getattr(settings, 'SEARCH_GENERATION_TTL', 5):
+        current, _ = SearchGeneration.objects.get_or_create(pk=1)
+        generation.update(value=current.value, read=now)
+    return generation['value']
+
+def bump_generation():
+    from .models import SearchGeneration
+
+    if not SearchGeneration.objects.filter(pk=1).update(value=F('value') + 1):
+        SearchGeneration.objects.get_or_create(pk=1, defaults={'value': 1})
+    generation['value'] = None
+
+def search_cache_key(text="", filters=None, after=None, size=None):
+    # Case and spacing of the query, and filters that aren't set, don't change the results
+    search = {'text': ' '.join((text or "").lower().split()),
+              'filters': {name: value for name, value in (filters or {}).items() if value not in (None, "")},
+              'after': after,
+              'size': size}
+    digest = hashlib.sha1(json.dumps(search, sort_keys=True).encode()).hexdigest()
+    return f'search:{index_generation()}:{digest}'
+
+def cached_search(text="", filters=None, after=None, size=None):
+    # search_finding_aids through the search cache
+    cache = caches['search']
+    key = search_cache_key(text, filters, after, size)
+
+    results = cache.get(key)
+    if results is None:
+        count_cache('misses')
+        results = search_finding_aids(text, filters, after, size)
+        cache.set(key, results)
+    else:
+        count_cache('hits')
+
+    return results
+
+def count_cache(name):
+    cache = caches['search']
+    key = 'search-stats:' + name
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Culled between the add and the incr
+        cache.set(key, 1, timeout=None)
+
+def search_cache_stats():
+    # Hits and misses so far, for a locmem cache only those of this process
+    cache = caches['search']
+    hits = cache.get('search-stats:hits', 0)
+    misses = cache.get('search-stats:misses', 0)
+    return {'hits': hits, 'misses': misses, 'rate': hits / (hits + misses) if hits + misses else 0}
@@ -0,0 +1,214 @@
+from django.conf import settings
+from django.db.models import Count, Max, Q
+
+from bisect import bisect_left
+import copy, heapq, threading, time
+
+# Typeahead suggestions
+#
+# Control access terms and repository names are held in memory, one sorted array per kind
+# (persname, subject, ..., repository), and looked up by prefix with a binary search rather
+# than a LIKE query per keystroke.  Suggestions are ranked by how many finding aids use the
+# term.  The best suggestions for one and two character prefixes, whose ranges can cover most
+# of an array, are worked out ahead of time so every lookup only ranks a short range.
+#
+# Each process builds the arrays on first use.  Terms changed since then (ControlAccess.modified)
+# are merged in every SUGGEST_REFRESH seconds, and everything is rebuilt every SUGGEST_REBUILD
+# seconds to drop terms that have been deleted.
+
+REPOSITORY = 'repository'
+
+# Length of the prefixes whose suggestions are kept ready
+SHORT_PREFIX = 2
+
+# Changed terms merged in place, more than this and the arrays are rebuilt
+MAX_MERGE = 500
+
+# Suggestions kept per short prefix, and the most a lookup returns
+MAX_SUGGESTIONS = 20
+
+def normalize(text):
+    return ' '.join((text or "").casefold().split())
+
+class Suggestions:
+    '''
+    The values of one kind sorted by their normalized form, with the number of uses of each.
+    '''
+
+    def __init__(self, counts):
+        self.counts = {}
+        self.keys = []
+        self.values = []
+        self.top = {}
+
+        for value, count in counts.items():
+            if value:
+                self.counts[value] = count
+
+        entries = sorted((normalize(value), value) for value in self.counts)
+        self.keys = [key for key, value in entries]
+        self.values = [value for key, value in entries]
+
+        for prefix in {key[:length] for key in self.keys for length in range(1, SHORT_PREFIX + 1)}:
+            self.top[prefix] = self.rank(prefix, MAX_SUGGESTIONS)
+
+    def span(self, prefix):
+        # Positions of the keys starting with prefix
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + '\U0010ffff')
+
+    def rank(self, prefix, limit):
+        start, end = self.span(prefix)
+        best = heapq.nlargest(limit, range(start, end), key=lambda position: self.counts[self.values[position]])
+        return [(self.values[position], self.counts[self.values[position]]) for position in best]
+
+    def lookup(self, text, limit=10):
+        prefix = normalize(text)
+        if not prefix:
+            return []
+        if len(prefix) <= SHORT_PREFIX:
+            return self.top.get(prefix, [])[:limit]
+        return self.rank(prefix, limit)
+
+    def merged(self, counts):
+        # A copy with new counts for some values merged in.  Lookups in other threads may be
+        # reading this one, so it is never changed once built, the copy is swapped in whole.
+        merged = copy.copy(self)
+        merged.counts = dict(self.counts)
+        merged.keys = list(self.keys)
+        merged.values = list(self.values)
+        merged.top = dict(self.top)
+        merged.update(counts)
+        return merged
+
+    def update(self, counts):
+        # Merges in new counts for some values, a count of 0 removes the value.  Only for a
+        # copy no lookup can see yet, see merged().
+        touched = set()
+
+        for value, count in counts.items():
+            if not value:
+                continue
+
+            key = normalize(value)
+            if value in self.counts:
+                if count <= 0:
+                    position = bisect_left(self.keys, key)
+                    while self.values[position] != value:
+                        position += 1
+                    del self.keys[position]
+                    del self.values[position]
+                    del self.counts[value]
+                else:
+                    self.counts[value] = count
+            elif count > 0:
+                position = bisect_left(self.keys, key)
+                self.keys.insert(position, key)
+                self.values.insert(position, value)
+                self.counts[value] = count
+
+            touched.update(key[:length] for length in range(1, SHORT_PREFIX + 1))
+
+        for prefix in touched:
+            self.top[prefix] = self.rank(prefix, MAX_SUGGESTIONS)
+
+class Suggester:
+    '''
+    Suggestions for every kind, loaded from the database and kept up to date.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = None
+        self.since = None
+        self.refreshed = 0
+        self.rebuilt = 0
+
+    def suggest(self, kind, text, limit=10):
+        self.refresh()
+        suggestions = self.kinds.get(kind)
+        if suggestions is None:
+            return []
+        return suggestions.lookup(text, min(limit, MAX_SUGGESTIONS))
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.kinds is not None and now - self.refreshed < getattr(settings, 'SUGGEST_REFRESH', 60):
+            return
+
+        with self.lock:
+            if self.kinds is not None and now - self.refreshed < getattr(settings, 'SUGGEST_REFRESH', 60):
+                return
+
+            if self.kinds is None or now - self.rebuilt > getattr(settings, 'SUGGEST_REBUILD', 3600):
+                self.build()
+                self.rebuilt = now
+            else:
+                self.merge_changes()
+            self.refreshed = now
+
+    def build(self):
+        from .models import ControlAccess, ControlTerm
+
+        kinds = {}
+        self.since = ControlAccess.objects.aggregate(latest=Max('modified'))['latest']
+
+        for kind, counts in term_counts(ControlTerm.objects.all()).items():
+            kinds[kind] = Suggestions(counts)
+        kinds[REPOSITORY] = Suggestions(repository_counts())
+
+        self.kinds = kinds
+
+    def merge_changes(self):
+        from .models import ControlAccess, ControlTerm
+
+        changed = ControlAccess.objects.all()
+        if self.since is not None:
+            changed = changed.filter(modified__gt=self.since)
+
+        latest = changed.aggregate(latest=Max('modified'))['latest']
+        if latest is None:
+            return
+
+        # Count every use of the changed terms, not just the changed rows.  After a large
+        # ingest a rebuild is cheaper than recounting term by term.
+        term_ids = set(changed.values_list('control_term_id', flat=True)[:MAX_MERGE + 1])
+        if len(term_ids) > MAX_MERGE:
+            return self.build()
+
+        # By term rather than id, so the other authority links of a term are counted too.  The
+        # merged suggestions are built aside and swapped in with one assignment.
+        kinds = dict(self.kinds)
+        terms = ControlTerm.objects.filter(pk__in=term_ids).values('term')
+        for kind, counts in term_counts(ControlTerm.objects.filter(term__in=terms)).items():
+            if kind in kinds:
+                kinds[kind] = kinds[kind].merged(counts)
+            else:
+                kinds[kind] = Suggestions(counts)
+
+        # Repository names are few enough to reload whenever anything changes
+        kinds[REPOSITORY] = Suggestions(repository_counts())
+        self.kinds = kinds
+        self.since = latest
+
+def term_counts(terms):
+    # {control_type: {term: finding aids using it}} for a ControlTerm queryset.  The same term
+    # can appear with several authority links, those are counted together.
+    kinds = {}
+    rows = terms.values('control_type', 'term').annotate(uses=Count('controlaccess__finding_aid', distinct=True))
+    for row in rows.iterator():
+        kinds.setdefault(row['control_type'], {})[row['term']] = row['uses']
+    return kinds
+
+def repository_counts():
+    # Public repositories ranked by their number of collection guides, the suggestions are
+    # served to anyone
+    from .models import Repository
+
+    rows = Repository.objects.filter(status=Repository.PUBLIC).values('name').annotate(uses=Count('findingaid', filter=Q(findingaid__progenitorID=0)))
+    return {row['name']: row['uses'] for row in rows}
+
+suggester = Suggester()
+
+def suggest(kind, text, limit=10):
+    # [(value, count)] for the values of kind starting with text, most used first
+    return suggester.suggest(kind, text, limit)
@@ -1,3 +1,1750 @@
-from django.test import TestCase
+from django.apps import apps
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from elasticsearch import ConnectionError as SearchConnectionError, NotFoundError
+from elasticsearch.serializer import JSONSerializer
 
-# Create your tests here.
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+import gzip, hashlib, io, json, os, re, tempfile, threading, time, tracemalloc
+
+from .models import (Chronology, ControlAccess, ControlTerm, FindingAid, FindingAidDefaults, HarvestJob, HarvestProfile,
+                     HarvestRecord, MARCWriter, PDFText, Repository, SearchCheckpoint, SearchGeneration, SearchOutbox, User,
+                     UserRole, reserve_ids, tree_segment)
+from .ead import EADReader
+from .harvest import HarvestError, claim_job, download, fail_stale_jobs, harvester_for, queue_harvest
+from .management.commands import ingest_ead
+from .marc import marc_fields, marc_terms, read_marc
+from .pdf import extract_finding_aid, file_hash, pending_pdfs
+from .search import (INDEX_MAPPING, bulk_index, bump_generation, cached_search, changed_finding_aids, create_versioned_index,
+                     decode_cursor, drain_outbox, encode_cursor, finding_aid_document, finish_loading, get_client, index_changes,
+                     search_cache_key, swap_alias)
+from .suggest import Suggestions, repository_counts
+
+#
+# Query counts
+#
+# Each page is requested against the fixture and again after adding as many rows again, and
+# must run the same number of queries both times, so the count depends on the page and not
+# on how many finding aids, components, terms or users there are.  The fragment cache is
+# turned off so the pages are rendered in full every time.
+#
+
+FRAGMENT_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'search': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'search'},
+    'fragments': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+}
+
+@override_settings(CACHES=FRAGMENT_CACHES)
+class QueryCountTests(TestCase):
+    FINDING_AIDS = 100
+    COMPONENTS = 20
+    TERMS = 10
+    USERS = 50
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test", status=Repository.PUBLIC)
+        FindingAidDefaults.objects.create(repository=cls.repository, creative_commons="https://creativecommons.org/")
+        cls.admin = User.objects.create_user(email="admin@example.com", is_site_admin=True)
+        cls.grown = 0
+        cls.grow()
+        cls.aid = FindingAid.objects.filter(progenitorID=0).order_by('pk').first()
+
+    @classmethod
+    def grow(cls):
+        # Adds FINDING_AIDS finding aids with their components and terms, USERS users with roles
+        # and a harvest profile
+        cls.grown += 1
+        now = timezone.now()
+
+        for number in range(cls.FINDING_AIDS):
+            aid = FindingAid.objects.create(repository=cls.repository, title=f"Finding aid {cls.grown}.{number}",
+                                            last_update=now, updated_by=cls.admin)
+
+            series = FindingAid.objects.create(repository=cls.repository, title="Series", level="series", component="c01",
+                                               progenitorID=aid.pk, parentID=aid.pk, last_update=now)
+            FindingAid.objects.bulk_create([FindingAid(repository=cls.repository, title=f"File {item}", component="c02",
+                                                       progenitorID=aid.pk, parentID=series.pk,
+                                                       last_update=now)
+                                            for item in range(cls.COMPONENTS)])
+            for component in FindingAid.objects.filter(parentID=series.pk, path=""):
+                FindingAid.objects.filter(pk=component.pk).update(path=series.path + tree_segment(component.pk))
+
+            terms = [ControlTerm.objects.create(control_type=control_type, term=f"{control_type} {cls.grown}.{number}.{item}")
+                     for control_type in ('persname', 'subject', 'genreform') for item in range(cls.TERMS)]
+            ControlAccess.objects.bulk_create([ControlAccess(finding_aid=aid, control_term=term) for term in terms])
+
+        for number in range(cls.USERS):
+            user = User.objects.create_user(email=f"user{cls.grown}.{number}@example.com")
+            UserRole.objects.create(repository=cls.repository, user=user,
+                                    role=UserRole.REPO_ADMIN if number % 2 else UserRole.CONTRIBUTOR)
+
+        HarvestProfile.objects.create(repository=cls.repository, name=f"Profile {cls.grown}",
+                                      location="http://localhost/sitemap.xml")
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def assertBounded(self, url, data=None):
+        # The same number of queries however many rows there are, returns that number
+        counts = []
+        for attempt in range(2):
+            if attempt:
+                self.grow()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, data or {})
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1], f'{url} ran {counts[0]} queries and then {counts[1]}')
+        return counts[0]
+
+    def test_repository_detail(self):
+        self.assertLessEqual(self.assertBounded(reverse('detail-repository', args=['test'])), 6)
+
+    def test_findingaid_list(self):
+        self.assertLessEqual(self.assertBounded(reverse('list-findingaids', args=['test'])), 6)
+
+    def test_findingaid_list_leaves_out_components(self):
+        response = self.client.get(reverse('list-findingaids', args=['test']))
+        self.assertEqual(len(response.context['object_list']), self.FINDING_AIDS)
+
+    def test_findingaid_detail(self):
+        url = reverse('detail-findingaid', args=['test', self.aid.pk])
+        self.assertLessEqual(self.assertBounded(url), 8)
+
+    def test_findingaid_control_terms(self):
+        response = self.client.get(reverse('detail-findingaid', args=['test', self.aid.pk]))
+        terms = response.context['control_terms']
+        self.assertEqual(len(terms['persname']), self.TERMS)
+        self.assertEqual([term.term for term in terms['subject']], [term.term for term in self.aid.get_subjects()])
+
+    def test_components(self):
+        series = self.aid.get_children().first()
+        url = reverse('api-components', args=['test', self.aid.pk])
+        self.assertLessEqual(self.assertBounded(url, {'parent': series.pk}), 4)
+
+    def test_user_list(self):
+        self.assertLessEqual(self.assertBounded(reverse('list-users')), 5)
+
+    def test_user_type(self):
+        response = self.client.get(reverse('list-users'))
+        types = {user.email: user.user_type() for user in response.context['object_list']}
+        self.assertEqual(types['admin@example.com'], "Site Admin")
+        self.assertEqual(types['user1.0@example.com'], "Contributor")
+        self.assertEqual(types['user1.1@example.com'], "Repository Admin")
+
+    def test_profile_list(self):
+        self.assertLessEqual(self.assertBounded(reverse('list-profiles', args=['test'])), 6)
+
+    def test_dashboard(self):
+        self.assertLessEqual(self.assertBounded(reverse('dashboard')), 6)
+
+#
+# Permissions
+#
+
+class PermissionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.other = Repository.objects.create(name="Other Repository", slug="other")
+        cls.user = User.objects.create_user(email="contributor@example.com")
+        UserRole.objects.create(repository=cls.repository, user=cls.user, role=UserRole.REPO_ADMIN)
+        UserRole.objects.create(repository=cls.other, user=cls.user, role=UserRole.CONTRIBUTOR)
+
+    def test_roles_loaded_once(self):
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(user.is_repo_admin(self.repository))
+            self.assertTrue(user.is_repo_admin(self.repository.pk))
+            self.assertTrue(user.is_repo_admin('test'))
+            self.assertFalse(user.is_repo_admin(self.other))
+            self.assertTrue(user.is_repo_member('other'))
+            self.assertFalse(user.is_repo_member('missing'))
+            self.assertTrue(user.is_admin())
+
+    def test_roles_cleared_when_changed(self):
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(user.is_repo_admin(self.other))
+        UserRole.objects.create(repository=self.other, user=user, role=UserRole.REPO_ADMIN)
+        self.assertTrue(user.is_repo_admin(self.other))
+        user.userrole_set.get(repository=self.repository).delete()
+        self.assertFalse(user.is_repo_member(self.repository))
+
+    def test_one_role_query_per_request(self):
+        HarvestProfile.objects.create(repository=self.repository, name="Profile", location="http://localhost/sitemap.xml")
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('list-profiles', args=['test']))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([query for query in queries if 'core_userrole' in query['sql']]), 1)
+        self.assertEqual(self.client.get(reverse('list-profiles', args=['other'])).status_code, 403)
+
+#
+# Lists
+#
+
+@override_settings(LIST_PAGE_SIZE=7)
+class ListTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(email="admin@example.com", first_name="Site", last_name="Admin", is_site_admin=True)
+        # Repeated names so that pages break between rows with the same name
+        Repository.objects.bulk_create([Repository(name=f"Archive {number % 10}", slug=f"archive-{number}",
+                                                   state="CA" if number % 3 else "NY", st_city="Portland",
+                                                   status=Repository.PUBLIC if number % 2 else Repository.UNKNOWN)
+                                        for number in range(40)])
+        User.objects.bulk_create([User(email=f"user{number:02d}@example.com", first_name="Ada" if number % 2 else "Grace",
+                                       last_name=f"Lovelace{number}", is_active=bool(number % 4))
+                                  for number in range(30)])
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def all_pages(self, url, params=None):
+        # Every row of every page, following the next cursors
+        rows, params = [], dict(params or {})
+        while True:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            rows.extend(response.context['object_list'])
+            if not response.context['next']:
+                return rows
+            params['after'] = response.context['next']
+
+    def test_repository_pages(self):
+        rows = self.all_pages(reverse('list-repositories'))
+        self.assertEqual([row.pk for row in rows],
+                         list(Repository.objects.order_by('name', 'pk').values_list('pk', flat=True)))
+
+    def test_repository_filters(self):
+        rows = self.all_pages(reverse('list-repositories'), {'search_field': 'State', 'search_term': 'ny', 'status_filter': Repository.PUBLIC})
+        self.assertEqual({row.pk for row in rows},
+                         set(Repository.objects.filter(state="NY", status=Repository.PUBLIC).values_list('pk', flat=True)))
+        rows = self.all_pages(reverse('list-repositories'), {'search_field': 'Repository', 'search_term': 'archive 3'})
+        self.assertEqual({row.name for row in rows}, {"Archive 3"})
+        self.assertEqual(len(self.all_pages(reverse('list-repositories'), {'search_field': 'City', 'search_term': 'PORT'})), 40)
+
+    def test_user_filters(self):
+        rows = self.all_pages(reverse('list-users'), {'search_field': 'full_name', 'search_term': 'ada lovelace1', 'status_filter': 'Active'})
+        self.assertEqual({row.email for row in rows},
+                         {"user01@example.com", "user11@example.com", "user13@example.com", "user15@example.com", "user17@example.com",
+                          "user19@example.com"})
+        self.assertEqual(len(self.all_pages(reverse('list-users'), {'status_filter': 'Inactive'})), 8)
+        self.assertEqual(len(self.all_pages(reverse('list-users'), {'search_term': 'USER0'})), 10)
+
+    def test_searches_indexed(self):
+        # Prefixes are matched as a range on the lowercased column, which the Lower() indexes
+        # serve, never with LIKE, which can't use them
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('list-repositories'), {'search_field': 'City', 'search_term': 'port'})
+            self.client.get(reverse('list-users'), {'search_field': 'full_name', 'search_term': 'ada'})
+        searches = [query['sql'] for query in queries if 'LOWER(' in query['sql']]
+        self.assertEqual(len(searches), 2)
+        self.assertFalse([sql for sql in searches if ' LIKE ' in sql])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(reverse('list-repositories'), {'after': 'nonsense'}).status_code, 400)
+
+#
+# Fragment cache
+#
+
+@override_settings(CACHES=dict(FRAGMENT_CACHES, fragments={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                           'LOCATION': 'fragments'}))
+class FragmentCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.aid = FindingAid.objects.create(repository=cls.repository, title="Papers", last_update=now)
+        cls.series = FindingAid.objects.create(repository=cls.repository, title="Correspondence", component="c01",
+                                               progenitorID=cls.aid.pk, parentID=cls.aid.pk, last_update=now)
+
+    def setUp(self):
+        caches['fragments'].clear()
+        self.url = reverse('detail-findingaid', args=['test', self.aid.pk])
+
+    def page(self):
+        return self.client.get(self.url).content.decode()
+
+    def test_cached(self):
+        self.page()
+        # The finding aid is read for its version, everything else comes from the cache
+        with self.assertNumQueries(1):
+            self.assertIn("Correspondence", self.page())
+
+    def test_finding_aid_saved(self):
+        self.page()
+        self.aid.title = "Family papers"
+        self.aid.save()
+        self.assertIn("Family papers", self.page())
+
+    def test_component_saved(self):
+        self.page()
+        self.series.title = "Letters"
+        self.series.save()
+        self.assertIn("Letters", self.page())
+
+    def test_control_access_and_chronology(self):
+        self.page()
+        term = ControlTerm.objects.create(control_type="persname", term="Lovelace, Ada")
+        access = ControlAccess.objects.create(finding_aid=self.aid, control_term=term)
+        Chronology.objects.create(finding_aid=self.aid, date="1843", event="Notes published", sort_order=0)
+        page = self.page()
+        self.assertIn("Lovelace, Ada", page)
+        self.assertIn("Notes published", page)
+
+        access.delete()
+        self.assertNotIn("Lovelace, Ada", self.page())
+
+    def test_control_term_edited(self):
+        term = ControlTerm.objects.create(control_type="persname", term="Lovelace, Ada")
+        ControlAccess.objects.create(finding_aid=self.aid, control_term=term)
+        self.assertIn("Lovelace, Ada", self.page())
+        since = timezone.now()
+        SearchOutbox.objects.all().delete()
+
+        term.term = "Lovelace, Augusta Ada"
+        term.save()
+        self.assertIn("Lovelace, Augusta Ada", self.page())
+        # Picked up by index_changes and queued for the index
+        self.assertEqual(list(changed_finding_aids(since).values_list('pk', flat=True)), [self.aid.pk])
+        self.assertEqual(list(SearchOutbox.objects.values_list('findingAidID', flat=True)), [self.aid.pk])
+
+#
+# Component tree
+#
+
+class ComponentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.aid = FindingAid.objects.create(repository=cls.repository, title="Papers", last_update=now)
+        for number in range(3):
+            FindingAid.objects.create(repository=cls.repository, title=f"Series {number}", component="c01",
+                                      progenitorID=cls.aid.pk, parentID=cls.aid.pk, last_update=now)
+        cls.url = reverse('api-components', args=['test', cls.aid.pk])
+
+    def tree(self):
+        # Finding aid > Series 0 > File > Item, and Series 1 and 2
+        series = list(FindingAid.objects.filter(parentID=self.aid.pk).order_by('pk'))
+        now = timezone.now()
+        file = FindingAid.objects.create(repository=self.repository, title="File", component="c02",
+                                         progenitorID=self.aid.pk, parentID=series[0].pk, last_update=now)
+        item = FindingAid.objects.create(repository=self.repository, title="Item", component="c03",
+                                         progenitorID=self.aid.pk, parentID=file.pk, last_update=now)
+        return series, file, item
+
+    def test_paths(self):
+        series, file, item = self.tree()
+        item.refresh_from_db()
+        self.assertEqual(item.path, tree_segment(self.aid.pk) + tree_segment(series[0].pk) + tree_segment(file.pk)
+                         + tree_segment(item.pk))
+        self.assertEqual([aid.title for aid in self.aid.get_subtree()],
+                         ["Series 0", "File", "Item", "Series 1", "Series 2"])
+        self.assertEqual([aid.title for aid in series[0].get_subtree()], ["File", "Item"])
+        self.assertEqual([aid.title for aid in item.get_ancestors()], ["Papers", "Series 0", "File"])
+        self.assertEqual([aid.title for aid in self.aid.get_children()], ["Series 0", "Series 1", "Series 2"])
+
+    def test_backfill(self):
+        # Migration 0020 fills in the paths of rows written before there were any
+        series, file, item = self.tree()
+        paths = dict(FindingAid.objects.values_list('pk', 'path'))
+        orphan = FindingAid.objects.create(repository=self.repository, title="Orphan", component="c02",
+                                           progenitorID=self.aid.pk, parentID=10 ** 6, last_update=timezone.now())
+        FindingAid.objects.update(path="")
+
+        import_module('core.migrations.0020_findingaid_path').fill_paths(apps, None)
+        self.assertEqual(dict(FindingAid.objects.exclude(pk=orphan.pk).values_list('pk', 'path')), paths)
+        self.assertEqual(FindingAid.objects.get(pk=orphan.pk).path, tree_segment(self.aid.pk) + tree_segment(orphan.pk))
+
+    def test_pages(self):
+        first = self.client.get(self.url, {'size': 2}).json()
+        self.assertEqual([component['title'] for component in first['components']], ["Series 0", "Series 1"])
+        rest = self.client.get(self.url, {'size': 2, 'after': first['after']}).json()
+        self.assertEqual([component['title'] for component in rest['components']], ["Series 2"])
+        self.assertIsNone(rest['after'])
+
+    def test_size_out_of_range(self):
+        response = self.client.get(self.url, {'size': -5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['components']), 1)
+        self.assertEqual(self.client.get(self.url, {'size': 'all'}).status_code, 400)
+
+    def test_other_repository(self):
+        # Only found under the finding aid's own repository, by the page and the API alike
+        Repository.objects.create(name="Other Repository", slug="other")
+        self.assertEqual(self.client.get(reverse('api-components', args=['other', self.aid.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('detail-findingaid', args=['other', self.aid.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('detail-findingaid', args=['test', self.aid.pk])).status_code, 200)
+
+#
+# Ingest
+#
+
+# The same finding aid namespaced, declaring the EAD DTD and using its HTML entities, and
+# plain with character references.  Both must load the same way.
+NAMESPACED_EAD = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE ead PUBLIC "+//ISBN 1-931666-00-8//DTD ead.dtd (Encoded Archival Description (EAD) Version 2002)//EN" "ead.dtd">
+<ead xmlns="urn:isbn:1-931666-22-9" xmlns:xlink="http://www.w3.org/1999/xlink">
+<eadheader><eadid>x</eadid></eadheader>
+<archdesc level="collection">
+<did><unittitle>Papers&nbsp;of Ada Lovelace</unittitle><unitdate>1833&ndash;1852</unitdate><unitid>MS 1</unitid>
+<physdesc><extent>3 boxes</extent></physdesc><abstract>Letters and notes</abstract></did>
+<accessrestrict><p>Open.</p></accessrestrict>
+<bioghist><chronlist><chronitem><date>1815</date><event>Born</event></chronitem>
+<chronitem><date>1843</date><event>Notes published</event></chronitem></chronlist></bioghist>
+<controlaccess><persname authfilenumber="n1">Lovelace, Ada</persname><subject>Mathematics</subject>
+<controlaccess><genreform>Letters</genreform></controlaccess></controlaccess>
+<dsc>
+<c01 level="series"><did><unittitle>Correspondence</unittitle></did>
+  <c02><did><container type="box">1</container><unittitle>Babbage</unittitle></did>
+    <c03><did><unittitle>Analytical Engine</unittitle></did></c03>
+  </c02>
+  <c02><did><unittitle>Somerville</unittitle><dao xlink:href="http://example.com/somerville"/></did></c02>
+</c01>
+<c01 level="series"><did><unittitle>Notes</unittitle></did></c01>
+</dsc>
+</archdesc></ead>
+"""
+
+PLAIN_EAD = """<?xml version="1.0" encoding="UTF-8"?>
+<ead><eadheader><eadid>x</eadid></eadheader>
+<archdesc level="collection">
+<did><unittitle>Papers&#160;of Ada Lovelace</unittitle><unitdate>1833&#8211;1852</unitdate><unitid>MS 1</unitid>
+<physdesc><extent>3 boxes</extent></physdesc><abstract>Letters and notes</abstract></did>
+<accessrestrict><p>Open.</p></accessrestrict>
+<bioghist><chronlist><chronitem><date>1815</date><event>Born</event></chronitem>
+<chronitem><date>1843</date><event>Notes published</event></chronitem></chronlist></bioghist>
+<controlaccess><persname authfilenumber="n1">Lovelace, Ada</persname><subject>Mathematics</subject>
+<controlaccess><genreform>Letters</genreform></controlaccess></controlaccess>
+<dsc>
+<c01 level="series"><did><unittitle>Correspondence</unittitle></did>
+  <c02><did><container type="box">1</container><unittitle>Babbage</unittitle></did>
+    <c03><did><unittitle>Analytical Engine</unittitle></did></c03>
+  </c02>
+  <c02><did><unittitle>Somerville</unittitle><dao href="http://example.com/somerville"/></did></c02>
+</c01>
+<c01 level="series"><did><unittitle>Notes</unittitle></did></c01>
+</dsc>
+</archdesc></ead>
+"""
+
+def wide_ead(count):
+    # A finding aid with count folders, for the memory and prefetch bounds
+    folders = "".join(f'<c01><did><unittitle>Folder {number}</unittitle></did><scopecontent><p>Letters</p></scopecontent></c01>'
+                      for number in range(count))
+    return f'<ead><archdesc level="collection"><did><unittitle>Papers</unittitle></did><dsc>{folders}</dsc></archdesc></ead>'
+
+class IngestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+
+    def ingest(self, text, id="new", batch_size=None):
+        # Loads text as an EAD file, returns the finding aid
+        with tempfile.NamedTemporaryFile(suffix=".xml") as ead_file:
+            ead_file.write(text.encode())
+            ead_file.flush()
+            self.assertEqual(FindingAid.ead_index(id, self.repository, ead_file.name, None, batch_size), "OK")
+        return FindingAid.objects.filter(progenitorID=0).latest('pk') if id == "new" else FindingAid.objects.get(pk=id)
+
+    def contents(self, aid):
+        # What was loaded, without the keys
+        parents = dict(aid.get_subtree().values_list('pk', 'title'))
+        parents[aid.pk] = None
+        return {
+            'aid': {field: getattr(aid, field) for field in FindingAid.DID_FIELDS + ('governing_access', 'digital_link')},
+            'components': [(component.component, component.title, component.container, parents[component.parentID],
+                            component.path.count('/'))
+                           for component in aid.get_subtree()],
+            'chronology': list(aid.chronology_set.order_by('sort_order').values_list('date', 'event')),
+            'terms': sorted(aid.controlaccess_set.values_list('control_term__control_type', 'control_term__term',
+                                                             'control_term__link')),
+        }
+
+    def test_parse(self):
+        contents = self.contents(self.ingest(NAMESPACED_EAD))
+        self.assertEqual(contents['aid']['title'], "Papers\xa0of Ada Lovelace")
+        self.assertEqual(contents['aid']['date'], "1833\u20131852")
+        self.assertEqual(contents['aid']['governing_access'], "Open.")
+        self.assertEqual(contents['components'], [
+            ("c01", "Correspondence", "", None, 2),
+            ("c02", "Babbage", "box 1 ", "Correspondence", 3),
+            ("c03", "Analytical Engine", "", "Babbage", 4),
+            ("c02", "Somerville", "", "Correspondence", 3),
+            ("c01", "Notes", "", None, 2),
+        ])
+        self.assertEqual(contents['chronology'], [("1815", "Born"), ("1843", "Notes published")])
+        self.assertEqual(contents['terms'], [("genreform", "Letters", ""), ("persname", "Lovelace, Ada", "n1"),
+                                             ("subject", "Mathematics", "")])
+
+    def test_namespaces_and_entities(self):
+        self.assertEqual(self.contents(self.ingest(NAMESPACED_EAD)), self.contents(self.ingest(PLAIN_EAD)))
+
+    def test_batches(self):
+        # Keys reserved a couple at a time still follow document order
+        aid = self.ingest(NAMESPACED_EAD, batch_size=2)
+        components = list(aid.get_subtree())
+        self.assertEqual([component.pk for component in components], sorted(component.pk for component in components))
+        self.assertEqual(self.contents(aid), self.contents(self.ingest(NAMESPACED_EAD)))
+
+    def test_reingest(self):
+        aid = self.ingest(NAMESPACED_EAD)
+        old = list(aid.get_subtree().values_list('pk', flat=True))
+        SearchOutbox.objects.all().delete()
+
+        aid = self.ingest(NAMESPACED_EAD.replace("Notes</unittitle>", "Drafts</unittitle>"), id=aid.pk)
+        contents = self.contents(aid)
+        self.assertEqual([title for component, title, container, parent, depth in contents['components']],
+                         ["Correspondence", "Babbage", "Analytical Engine", "Somerville", "Drafts"])
+        self.assertEqual(len(contents['chronology']), 2)
+        self.assertEqual(len(contents['terms']), 3)
+
+        # The old components and their index entries are gone, the finding aid is indexed again
+        self.assertFalse(FindingAid.objects.filter(pk__in=old).exists())
+        self.assertEqual(sorted(SearchOutbox.objects.filter(operation=SearchOutbox.DELETE).values_list('findingAidID', flat=True)), old)
+        self.assertEqual(list(SearchOutbox.objects.filter(findingAidID=aid.pk).values_list('operation', 'components')),
+                         [(SearchOutbox.INDEX, True)])
+
+    def test_queued_once(self):
+        aid = self.ingest(NAMESPACED_EAD)
+        self.assertEqual(list(SearchOutbox.objects.filter(findingAidID=aid.pk).values_list('operation', 'components')),
+                         [(SearchOutbox.INDEX, True)])
+
+    def test_deleted_keys_not_reused(self):
+        now = timezone.now()
+        deleted = [FindingAid.objects.create(repository=self.repository, title=f"Deleted {number}", last_update=now).pk
+                   for number in range(5)]
+        FindingAid.objects.filter(pk__in=deleted).delete()
+
+        writer = MARCWriter(self.repository)
+        for number in range(3):
+            writer.add(FindingAid(record_type=FindingAid.MARC, title=f"Record {number}"), [])
+        written = [aid.pk for tag, aid in writer.flush()]
+        self.assertEqual(len(set(written)), 3)
+        self.assertGreater(min(written), max(deleted))
+
+        # Neither a later insert nor a later reservation is given a key already handed out
+        aid = FindingAid.objects.create(repository=self.repository, title="Saved", last_update=now)
+        self.assertGreater(aid.pk, max(written))
+        with transaction.atomic():
+            self.assertGreater(min(reserve_ids(FindingAid, 10)), aid.pk)
+
+    def test_components_let_go(self):
+        # Components are cleared once handed over, so reading ten times as many doesn't take
+        # ten times the memory
+        def peak(count):
+            data = wide_ead(count).encode()
+            tracemalloc.start()
+            try:
+                for item in EADReader(io.BytesIO(data)):
+                    pass
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        self.assertLess(peak(20000), peak(2000) * 2)
+
+    @override_settings(INGEST_PREFETCH_SIZE=20000)
+    def test_large_files_streamed(self):
+        # Files over the prefetch size are parsed by the command as it writes them, the rest by
+        # the worker processes
+        with tempfile.TemporaryDirectory() as directory:
+            for name, text in (("small.xml", NAMESPACED_EAD), ("large.xml", wide_ead(500))):
+                with open(os.path.join(directory, name), "w") as ead_file:
+                    ead_file.write(text)
+
+            output = io.StringIO()
+            with mock.patch('core.management.commands.ingest_ead.stream', wraps=ingest_ead.stream) as stream, \
+                 redirect_stdout(output):
+                call_command('ingest_ead', 'test', directory, workers=1)
+
+        self.assertEqual([call.args[0] for call in stream.call_args_list], [os.path.join(directory, "large.xml")])
+        self.assertIn("2 files ingested, 0 failed", output.getvalue())
+        self.assertEqual(FindingAid.objects.filter(progenitorID=FindingAid.objects.get(title="Papers").pk).count(), 500)
+        self.assertTrue(FindingAid.objects.filter(title="Papers\xa0of Ada Lovelace").exists())
+
+    def test_keys_without_reservation(self):
+        # Other databases insert the rows one at a time for their keys
+        expected = self.contents(self.ingest(NAMESPACED_EAD))
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            self.assertIsNone(reserve_ids(FindingAid, 10))
+            self.assertEqual(self.contents(self.ingest(NAMESPACED_EAD)), expected)
+
+            writer = MARCWriter(self.repository)
+            writer.add(FindingAid(record_type=FindingAid.MARC, title="Record"), [("subject", "Mathematics", "")])
+            (tag, aid), = writer.flush()
+        aid.refresh_from_db()
+        self.assertEqual((aid.path, aid.ark, aid.elasticsearch_id), (tree_segment(aid.pk), f"ark://{aid.pk}", str(aid.pk)))
+        self.assertEqual(list(aid.controlaccess_set.values_list('control_term__term', flat=True)), ["Mathematics"])
+
+    def test_long_terms_truncated(self):
+        # Cut to what the ControlTerm columns hold, so the insert works on any database
+        heading = "Mathematics -- History" * 15
+        text = NAMESPACED_EAD.replace("<subject>Mathematics</subject>", f'<subject authfilenumber="{"n" * 1300}">{heading}</subject>')
+        term = self.ingest(text).controlaccess_set.get(control_term__control_type="subject").control_term
+        self.assertEqual((term.term, term.link), (heading[:255], "n" * 1255))
+
+        # and found again under the cut term
+        self.ingest(text)
+        self.assertEqual(ControlTerm.objects.filter(control_type="subject").count(), 1)
+
+    def test_delete_removes_components(self):
+        now = timezone.now()
+        aid = FindingAid.objects.create(repository=self.repository, title="Papers", last_update=now)
+        series = FindingAid.objects.create(repository=self.repository, title="Series", component="c01",
+                                           progenitorID=aid.pk, parentID=aid.pk, last_update=now)
+        keys = [aid.pk, series.pk]
+        SearchOutbox.objects.all().delete()
+
+        aid.delete()
+        self.assertFalse(FindingAid.objects.filter(pk__in=keys).exists())
+        self.assertEqual(sorted(SearchOutbox.objects.filter(operation=SearchOutbox.DELETE).values_list('findingAidID', flat=True)),
+                         keys)
+
+#
+# MARC
+#
+
+# Two MARCXML records, the first with a subject heading longer than a term can hold
+MARCXML = '''<?xml version="1.0" encoding="UTF-8"?>
+<collection xmlns="http://www.loc.gov/MARC21/slim">
+  <record>
+    <leader>00000npcaa2200000 a 4500</leader>
+    <controlfield tag="001">mss0042</controlfield>
+    <datafield tag="100" ind1="1" ind2=" ">
+      <subfield code="a">Lovelace, Ada,</subfield>
+      <subfield code="d">1815-1852.</subfield>
+      <subfield code="0">n1</subfield>
+    </datafield>
+    <datafield tag="245" ind1="1" ind2="0">
+      <subfield code="a">Papers,</subfield>
+      <subfield code="f">1833-1852</subfield>
+      <subfield code="g">1840-1845.</subfield>
+    </datafield>
+    <datafield tag="300" ind1=" " ind2=" ">
+      <subfield code="a">2 linear feet</subfield>
+      <subfield code="b">(4 boxes).</subfield>
+    </datafield>
+    <datafield tag="520" ind1="3" ind2=" ">
+      <subfield code="a">Letters and notes.</subfield>
+    </datafield>
+    <datafield tag="520" ind1=" " ind2=" ">
+      <subfield code="a">Drafts on the Analytical Engine.</subfield>
+    </datafield>
+    <datafield tag="600" ind1="1" ind2="0">
+      <subfield code="a">Babbage, Charles,</subfield>
+      <subfield code="d">1791-1871</subfield>
+      <subfield code="x">Correspondence.</subfield>
+      <subfield code="0">n2</subfield>
+    </datafield>
+    <datafield tag="650" ind1=" " ind2="0">
+      <subfield code="a">LONGTERM</subfield>
+    </datafield>
+  </record>
+  <record>
+    <leader>00000npcaa2200000 a 4500</leader>
+    <controlfield tag="001">mss0043</controlfield>
+    <datafield tag="245" ind1="0" ind2="0">
+      <subfield code="a">Notebook /</subfield>
+    </datafield>
+    <datafield tag="260" ind1=" " ind2=" ">
+      <subfield code="c">1843.</subfield>
+    </datafield>
+  </record>
+</collection>
+'''.replace('LONGTERM', 'Mathematics ' * 30)
+
+class MARCTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+
+    def records(self):
+        return [record for record, error in read_marc(io.BytesIO(MARCXML.encode()))]
+
+    def test_fields(self):
+        papers, notebook = self.records()
+        self.assertEqual(marc_fields(papers), {
+            'reference_code': "mss0042", 'creator': "Lovelace, Ada, 1815-1852", 'title': "Papers",
+            'date': "1833-1852 [1840-1845]", 'extent': "2 linear feet (4 boxes)",
+            'scope_and_content': "Letters and notes.\nDrafts on the Analytical Engine.", 'abstract': "Letters and notes."})
+        # The date from 260 when 245 has none
+        self.assertEqual((marc_fields(notebook)['title'], marc_fields(notebook)['date']), ("Notebook", "1843"))
+
+        self.assertEqual(marc_terms(papers), [("persname", "Babbage, Charles, 1791-1871 -- Correspondence", "n2"),
+                                              ("subject", ("Mathematics " * 30)[:255], "")])
+        self.assertEqual(marc_terms(notebook), [])
+
+    def test_load(self):
+        before = FindingAid.objects.create(repository=self.repository, title="Existing", last_update=timezone.now())
+        with tempfile.NamedTemporaryFile(suffix=".xml") as marc_file:
+            marc_file.write(MARCXML.encode())
+            marc_file.flush()
+            self.assertEqual(FindingAid.marc_index(self.repository, marc_file.name, None, batch_size=1), (2, 0))
+
+        # Keys reserved batch by batch, after those already used
+        papers, notebook = FindingAid.objects.filter(pk__gt=before.pk).order_by('pk')
+        self.assertEqual((papers.title, notebook.title), ("Papers", "Notebook"))
+        self.assertEqual(notebook.pk, papers.pk + 1)
+        self.assertEqual((papers.path, papers.ark, papers.elasticsearch_id),
+                         (tree_segment(papers.pk), f"ark://{papers.pk}", str(papers.pk)))
+
+        self.assertEqual(sorted(len(term) for term in papers.controlaccess_set.values_list('control_term__term', flat=True)),
+                         [45, 255])
+        self.assertEqual(sorted(SearchOutbox.objects.filter(findingAidID__gt=before.pk).values_list('findingAidID', flat=True)),
+                         [papers.pk, notebook.pk])
+
+    def test_replaced(self):
+        papers, notebook = self.records()
+        writer = MARCWriter(self.repository)
+        writer.add(*FindingAid.from_marc(papers))
+        (tag, old), = writer.flush()
+        SearchOutbox.objects.all().delete()
+
+        # The record comes back as the notebook under the same key, with only its own terms
+        writer.add(*FindingAid.from_marc(notebook), replaces=old.pk, tag="again")
+        (tag, aid), = writer.flush()
+        self.assertEqual((tag, aid.pk), ("again", old.pk))
+        self.assertEqual(FindingAid.objects.get(pk=old.pk).title, "Notebook")
+        self.assertFalse(ControlAccess.objects.filter(finding_aid_id=old.pk).exists())
+
+        # Overwritten in the index rather than deleted
+        self.assertEqual(list(SearchOutbox.objects.values_list('findingAidID', 'operation')), [(old.pk, SearchOutbox.INDEX)])
+
+#
+# PDF finding aids
+#
+
+def make_pdf(pages):
+    # A PDF with a line of text on each page
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    pages_id = 2 * pages + 2
+    for number in range(1, pages + 1):
+        text = b"BT /F1 12 Tf 72 720 Td (Guide page %d) Tj ET" % number
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(text), text))
+        objects.append(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 1 0 R >> >> >>" % (pages_id, len(objects)))
+    objects.append(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % (2 * number + 1)
+                                                                            for number in range(1, pages + 1)), pages))
+    objects.append(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, len(objects), xref)
+    return data
+
+@override_settings(PDF_PAGES_PER_TASK=2)
+class PDFTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.user = User.objects.create_user(email="admin@example.com")
+        UserRole.objects.create(repository=cls.repository, user=cls.user, role=UserRole.REPO_ADMIN)
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.client.force_login(self.user)
+
+    def upload(self, data, title="Box list"):
+        response = self.client.post(reverse('create-findingaid', args=['test']) + '?record_type=pdf',
+                                    {'repository': self.repository.pk, 'record_type': FindingAid.PDF, 'title': title,
+                                     'associated_file': SimpleUploadedFile("guide.pdf", data, "application/pdf")})
+        self.assertEqual(response.status_code, 302)
+        return FindingAid.objects.get(title=title)
+
+    def extract(self):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            return {aid.title: extract_finding_aid(aid, pool) for aid in pending_pdfs()}
+
+    def test_upload_extracted(self):
+        aid = self.upload(make_pdf(5))
+        self.assertEqual(aid.updated_by, self.user)
+        self.assertIsNotNone(aid.last_update)
+
+        # Five pages two at a time
+        self.assertEqual(self.extract(), {"Box list": 3})
+        aid.refresh_from_db()
+        self.assertEqual(aid.scope_and_content, " ".join(f"Guide page {number}" for number in range(1, 6)))
+        self.assertEqual(self.extract(), {})
+
+        # The whole text is indexed, only PDFs have any
+        self.assertEqual(finding_aid_document(aid, self.repository)['full_text'],
+                         "".join(f"Guide page {number}\f" for number in range(1, 6)))
+        aid.record_type = FindingAid.EAD
+        self.assertEqual(finding_aid_document(aid, self.repository)['full_text'], "")
+
+    def test_same_file_not_extracted_again(self):
+        self.upload(make_pdf(5))
+        self.extract()
+        self.upload(make_pdf(5), title="Box list again")
+        self.assertEqual(self.extract(), {"Box list again": 0})
+        self.assertEqual(FindingAid.objects.get(title="Box list again").scope_and_content,
+                         FindingAid.objects.get(title="Box list").scope_and_content)
+
+    def test_failure_tried_again(self):
+        aid = self.upload(make_pdf(3))
+        with mock.patch('core.pdf.extract_text', side_effect=OSError("Worker stopped")):
+            with self.assertRaises(OSError):
+                self.extract()
+        aid.refresh_from_db()
+        self.assertEqual((aid.file_hash, aid.extract_attempts, aid.extract_error), ("", 1, "Worker stopped"))
+
+        # Left alone until it is due again, then read as usual
+        self.assertFalse(pending_pdfs().exists())
+        FindingAid.objects.filter(pk=aid.pk).update(extract_after=timezone.now())
+        self.assertEqual(self.extract(), {"Box list": 2})
+        aid.refresh_from_db()
+        self.assertEqual((aid.extract_attempts, aid.extract_after, aid.extract_error), (0, None, ""))
+        self.assertTrue(aid.file_hash)
+
+    @override_settings(PDF_EXTRACT_ATTEMPTS=2)
+    def test_damaged_file_given_up(self):
+        aid = self.upload(b"%PDF-1.4 not really")
+        for attempt in range(2):
+            FindingAid.objects.filter(pk=aid.pk).update(extract_after=None)
+            with self.assertRaises(Exception):
+                self.extract()
+        FindingAid.objects.filter(pk=aid.pk).update(extract_after=None)
+        self.assertFalse(pending_pdfs().exists())
+
+        # Until a new file is uploaded
+        aid.refresh_from_db()
+        aid.associated_file = SimpleUploadedFile("guide.pdf", make_pdf(1), "application/pdf")
+        aid.save()
+        self.assertEqual(self.extract(), {"Box list": 1})
+
+    def test_interrupted_extraction_carried_on(self):
+        aid = self.upload(make_pdf(5))
+        digest = file_hash(aid.associated_file)
+        PDFText.objects.create(content_hash=digest, first_page=0, last_page=2, page_count=5, text="Cached\f")
+        self.assertEqual(self.extract(), {"Box list": 2})
+        aid.refresh_from_db()
+        self.assertTrue(aid.scope_and_content.startswith("Cached Guide page 3"))
+
+#
+# Elasticsearch client
+#
+
+class ClientTests(TestCase):
+
+    @override_settings(ELASTICSEARCH_HOSTS=[{'host': 'search.example', 'port': 9201}], ELASTICSEARCH_TIMEOUT=3,
+                       ELASTICSEARCH_MAXSIZE=7, ELASTICSEARCH_MAX_RETRIES=1)
+    def test_settings_and_reuse(self):
+        with mock.patch.multiple('core.search', client=None, client_pid=None):
+            client = get_client()
+            self.assertIs(get_client(), client)
+
+            transport = client.transport
+            self.assertEqual((transport.hosts, transport.max_retries, transport.retry_on_timeout),
+                             ([{'host': 'search.example', 'port': 9201}], 1, True))
+            connection, = transport.connection_pool.connections
+            self.assertEqual((connection.host, connection.timeout, connection.pool.pool.maxsize),
+                             ("http://search.example:9201", 3, 7))
+
+            # A forked process doesn't share the parent's connections
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                forked = get_client()
+                self.assertIsNot(forked, client)
+                self.assertIs(get_client(), forked)
+
+#
+# Search outbox
+#
+
+class OutboxTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.aid = FindingAid.objects.create(repository=cls.repository, title="Papers", last_update=now)
+        cls.series = FindingAid.objects.create(repository=cls.repository, title="Series", component="c01",
+                                               progenitorID=cls.aid.pk, parentID=cls.aid.pk, last_update=now)
+
+    def setUp(self):
+        SearchOutbox.objects.all().delete()
+
+    def drain(self, failures=()):
+        # Runs drain_outbox against a stand-in for the index, returns the actions sent
+        sent = []
+
+        def bulk_index(actions, **kwargs):
+            sent.extend(actions)
+            failed = [(action, {'status': 400}) for action in sent if action['_id'] in failures]
+            return len(sent) - len(failed), failed
+
+        with mock.patch('core.search.bulk_index', bulk_index):
+            drain_outbox()
+        return [(action['_op_type'], action['_id']) for action in sent]
+
+    def test_latest_change_sent(self):
+        SearchOutbox.enqueue(self.aid)
+        SearchOutbox.enqueue(self.aid)
+        SearchOutbox.enqueue(self.series)
+        SearchOutbox.enqueue(self.series, SearchOutbox.DELETE)
+        self.assertEqual(self.drain(), [('index', str(self.aid.pk)), ('delete', str(self.series.pk))])
+        self.assertFalse(SearchOutbox.objects.exists())
+
+    def test_components_merged(self):
+        SearchOutbox.enqueue(self.aid, components=True)
+        SearchOutbox.enqueue(self.aid)
+        self.assertEqual(self.drain(), [('index', str(self.aid.pk)), ('index', str(self.series.pk))])
+
+    def test_failures_kept(self):
+        SearchOutbox.enqueue(self.aid)
+        SearchOutbox.enqueue(self.aid)
+        SearchOutbox.enqueue(self.series)
+        self.drain(failures=[str(self.aid.pk)])
+        self.assertEqual(list(SearchOutbox.objects.values_list('findingAidID', 'attempts')),
+                         [(self.aid.pk, 1), (self.aid.pk, 1)])
+        self.assertGreater(SearchOutbox.objects.first().available_at, timezone.now())
+
+#
+# Versioned indexes
+#
+
+class FakeElasticsearch:
+    '''
+    Just enough of the Elasticsearch client for the indexers, in memory.  indexes maps each
+    index name to its documents by _id, aliases each alias to the indexes it points at.
+    '''
+
+    def __init__(self):
+        self.indexes = {}
+        self.settings = {}
+        self.mappings = {}
+        self.aliases = {}
+        self.scrolls = {}
+        self.transport = SimpleNamespace(serializer=JSONSerializer())
+        self.indices = SimpleNamespace(create=self.create, put_settings=self.put_settings, refresh=lambda index: None,
+                                       get_alias=self.get_alias, exists=lambda index: index in self.indexes,
+                                       update_aliases=self.update_aliases, delete=self.delete)
+
+    def documents(self, name):
+        # The documents of an index, or of the one index an alias points at
+        name, = self.aliases.get(name, [name])
+        return self.indexes[name]
+
+    def create(self, index, body):
+        self.indexes[index] = {}
+        self.settings[index] = dict(body['settings'])
+        self.mappings[index] = body['mappings']
+
+    def put_settings(self, index, body):
+        self.settings[index].update(body)
+
+    def get_alias(self, name):
+        if not self.aliases.get(name):
+            raise NotFoundError(404, 'aliases_not_found_exception')
+        return {index: {'aliases': {name: {}}} for index in self.aliases[name]}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            (kind, target), = action.items()
+            if kind == 'add':
+                self.aliases.setdefault(target['alias'], []).append(target['index'])
+            elif kind == 'remove':
+                self.aliases[target['alias']].remove(target['index'])
+            elif kind == 'remove_index':
+                self.delete(target['index'])
+
+    def delete(self, index):
+        del self.indexes[index]
+
+    def bulk(self, body, **kwargs):
+        lines = iter(body.splitlines())
+        items = []
+        for line in lines:
+            (kind, meta), = json.loads(line).items()
+            documents = self.documents(meta['_index'])
+            if kind == 'delete':
+                status = 200 if documents.pop(meta['_id'], None) else 404
+            else:
+                documents[meta['_id']] = json.loads(next(lines))
+                status = 201
+            items.append({kind: {'_id': meta['_id'], 'status': status}})
+        return {'errors': any(item[kind]['status'] >= 300 for item in items), 'items': items}
+
+    def search(self, index, size=10, **kwargs):
+        hits = [{'_id': key, '_source': {'id': document['id']}} for key, document in self.documents(index).items()]
+        self.scrolls['scroll'] = hits[size:]
+        return self.page(hits[:size])
+
+    def scroll(self, scroll_id, **kwargs):
+        hits = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = hits[len(hits):]
+        return self.page(hits)
+
+    def page(self, hits):
+        return {'_scroll_id': 'scroll', 'hits': {'hits': hits}, '_shards': {'total': 1, 'successful': 1}}
+
+    def clear_scroll(self, **kwargs):
+        self.scrolls.clear()
+
+# The loading threads need their own connections, which only see committed rows
+@override_settings(ELASTICSEARCH_INDEX='nafan')
+class ReindexTests(TransactionTestCase):
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.repository = Repository.objects.create(name="Test Repository", slug="test")
+        now = timezone.now()
+        self.aids = [FindingAid.objects.create(repository=self.repository, title=f"Papers {number}", last_update=now)
+                     for number in range(5)]
+        # Long before the reindex starts
+        FindingAid.objects.update(modified=now - timedelta(hours=1))
+
+    def reindex(self, during=None):
+        # Runs the reindex command against the fake, with during() called once the load is done
+        def finish(name, client):
+            if during:
+                during()
+            finish_loading(name, client)
+
+        output = io.StringIO()
+        with mock.patch('core.management.commands.reindex.get_client', return_value=self.es), \
+             mock.patch('core.management.commands.reindex.finish_loading', finish), redirect_stdout(output):
+            call_command('reindex', workers=2)
+        return output.getvalue()
+
+    def titles(self, name='nafan'):
+        return sorted(document['title'] for document in self.es.documents(name).values())
+
+    def test_versioned_index(self):
+        name = create_versioned_index('nafan', self.es)
+        self.assertRegex(name, r'^nafan_\d{14}$')
+        self.assertEqual(self.es.settings[name], {'refresh_interval': '-1', 'number_of_replicas': 0})
+        self.assertEqual(self.es.mappings[name], INDEX_MAPPING)
+
+        with self.settings(ELASTICSEARCH_REPLICAS=2):
+            finish_loading(name, self.es)
+        self.assertEqual(self.es.settings[name], {'refresh_interval': '1s', 'number_of_replicas': 2})
+
+    def test_swap_alias(self):
+        # An unversioned index by the alias's name goes in the same call
+        self.es.create('nafan', {'settings': {}, 'mappings': {}})
+        self.assertEqual(swap_alias('nafan_1', 'nafan', self.es), [])
+        self.assertNotIn('nafan', self.es.indexes)
+        self.assertEqual(self.es.aliases, {'nafan': ['nafan_1']})
+
+        self.assertEqual(swap_alias('nafan_2', 'nafan', self.es), ['nafan_1'])
+        self.assertEqual(self.es.aliases, {'nafan': ['nafan_2']})
+
+    def test_reindex(self):
+        self.reindex()
+        old, = self.es.aliases['nafan']
+        self.assertEqual(self.titles(), [f"Papers {number}" for number in range(5)])
+
+        # The old index is removed once the alias has moved
+        time.sleep(1)
+        self.reindex()
+        self.assertNotIn(old, self.es.indexes)
+        self.assertEqual(len(self.es.indexes), 1)
+
+    def test_changes_during_load(self):
+        def during():
+            aid = FindingAid.objects.get(pk=self.aids[0].pk)
+            aid.title = "Renamed"
+            aid.save(index=False)
+            FindingAid.objects.get(pk=self.aids[1].pk).delete()
+
+        output = self.reindex(during)
+        self.assertIn("1 documents changed and 1 deleted during the load", output)
+        self.assertEqual(self.titles(), ["Papers 2", "Papers 3", "Papers 4", "Renamed"])
+
+#
+# Bulk indexing
+#
+
+class BulkIndexTests(TestCase):
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.es.create('nafan', {'settings': {}, 'mappings': {}})
+        self.sent = []
+
+    def respond(self, *responses):
+        # Each bulk request gets the next response: an exception to raise, or the status to give
+        # the first item instead of the real one.  None leaves the request alone.
+        bulk = self.es.bulk
+        responses = iter(responses)
+
+        def flaky(body, **kwargs):
+            self.sent.append(sorted(json.loads(line)['index']['_id'] for line in body.splitlines()[::2]))
+            response = next(responses, None)
+            if isinstance(response, Exception):
+                raise response
+            result = bulk(body, **kwargs)
+            if response:
+                result['items'][0]['index']['status'] = response
+                result['errors'] = True
+            return result
+
+        self.es.bulk = flaky
+
+    def index(self, **kwargs):
+        actions = [{'_op_type': 'index', '_index': 'nafan', '_id': str(number), '_source': {'id': number}} for number in range(3)]
+        with mock.patch('core.search.time.sleep'):
+            return bulk_index(actions, client=self.es, **kwargs)
+
+    def test_retried(self):
+        # Refused connections and overload are tried again, only with what didn't get in
+        self.respond(SearchConnectionError('N/A', 'Connection refused', None), 429)
+        self.assertEqual(self.index(), (3, []))
+        self.assertEqual(self.sent, [['0', '1', '2'], ['0', '1', '2'], ['0']])
+        self.assertEqual(sorted(self.es.documents('nafan')), ['0', '1', '2'])
+
+    def test_given_up(self):
+        self.respond(429, 429, 429)
+        succeeded, failed = self.index(max_retries=2)
+        self.assertEqual(succeeded, 2)
+        self.assertEqual([(action['_id'], error['status']) for action, error in failed], [('0', 429)])
+        self.assertEqual(len(self.sent), 3)
+
+    def test_rejected_not_retried(self):
+        self.respond(400)
+        succeeded, failed = self.index()
+        self.assertEqual((succeeded, [action['_id'] for action, error in failed]), (2, ['0']))
+        self.assertEqual(len(self.sent), 1)
+
+    def test_missing_delete(self):
+        # Deleting what isn't there is as good as deleting it
+        self.assertEqual(bulk_index([{'_op_type': 'delete', '_index': 'nafan', '_id': '9'}], client=self.es), (1, []))
+
+#
+# Delta indexing
+#
+
+class DeltaIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.aid = FindingAid.objects.create(repository=cls.repository, title="Papers", last_update=timezone.now())
+        cls.other = FindingAid.objects.create(repository=cls.repository, title="Letters", last_update=timezone.now())
+        term = ControlTerm.objects.create(control_type="subject", term="Mathematics")
+        cls.access = ControlAccess.objects.create(finding_aid=cls.other, control_term=term)
+
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.es.create('nafan', {'settings': {}, 'mappings': {}})
+        # Long before the first run, so only what a test changes is inside the overlap
+        hour_ago = timezone.now() - timedelta(hours=1)
+        FindingAid.objects.update(modified=hour_ago)
+        ControlAccess.objects.update(modified=hour_ago)
+
+    def run_changes(self):
+        # The documents sent, the checkpoint after and whether the generation moved
+        before = SearchGeneration.objects.get_or_create(pk=1)[0].value
+        self.es.indexes['nafan'].clear()
+        succeeded, failed = index_changes(client=self.es)
+        self.assertEqual(succeeded, len(self.es.indexes['nafan']))
+        return (sorted(self.es.indexes['nafan']), SearchCheckpoint.objects.get(name='default').position,
+                SearchGeneration.objects.get(pk=1).value != before)
+
+    def test_checkpoint(self):
+        # Everything the first time
+        started = timezone.now()
+        sent, position, bumped = self.run_changes()
+        self.assertEqual((sent, bumped), (sorted([str(self.aid.pk), str(self.other.pk)]), True))
+        self.assertGreaterEqual(position, started)
+
+        # Then nothing, but the checkpoint still moves on
+        sent, second, bumped = self.run_changes()
+        self.assertEqual((sent, bumped), ([], False))
+        self.assertGreater(second, position)
+
+        # A finding aid saved, and one whose control access changed
+        self.aid.save()
+        sent, position, bumped = self.run_changes()
+        self.assertEqual((sent, bumped), ([str(self.aid.pk)], True))
+        FindingAid.objects.filter(pk=self.aid.pk).update(modified=timezone.now() - timedelta(hours=1))
+        self.access.save()
+        self.assertEqual(self.run_changes()[0], [str(self.other.pk)])
+
+    def test_failure_keeps_checkpoint(self):
+        self.run_changes()
+        position = SearchCheckpoint.objects.get(name='default').position
+
+        self.aid.save()
+        with mock.patch('core.search.bulk_index', return_value=(0, [({'_id': str(self.aid.pk)}, {'status': 400})])):
+            index_changes(client=self.es)
+        self.assertEqual(SearchCheckpoint.objects.get(name='default').position, position)
+        self.assertEqual(self.run_changes()[0], [str(self.aid.pk)])
+
+#
+# Search cache
+#
+
+class SearchCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+        cls.aid = FindingAid.objects.create(repository=cls.repository, title="Papers", last_update=timezone.now())
+
+    def setUp(self):
+        caches['search'].clear()
+        SearchOutbox.objects.all().delete()
+        # Also forgets the generation another test left behind
+        bump_generation()
+
+    def test_keys(self):
+        key = search_cache_key("Civil  War", {'repository': "Test Repository", 'type': ""}, None, 20)
+        self.assertEqual(search_cache_key("civil war", {'repository': "Test Repository"}, None, 20), key)
+
+        others = {search_cache_key("civil", {'repository': "Test Repository"}, None, 20),
+                  search_cache_key("civil war", {'repository': "Other"}, None, 20),
+                  search_cache_key("civil war", {'repository': "Test Repository"}, [1.5, 7], 20),
+                  search_cache_key("civil war", {'repository': "Test Repository"}, None, 10)}
+        self.assertEqual(len(others | {key}), 5)
+
+        bump_generation()
+        self.assertNotEqual(search_cache_key("civil war", {'repository': "Test Repository"}, None, 20), key)
+
+    def test_write_invalidates(self):
+        refreshes = []
+
+        def bulk_index(actions, **kwargs):
+            refreshes.append(kwargs.get('refresh'))
+            return len(list(actions)), []
+
+        with mock.patch('core.search.search_finding_aids', side_effect=lambda *args: {'total': len(refreshes)}) as search:
+            self.assertEqual(cached_search("papers"), {'total': 0})
+            self.assertEqual(cached_search("papers"), {'total': 0})
+            self.assertEqual(search.call_count, 1)
+
+            self.aid.title = "Letters"
+            self.aid.save()
+            with mock.patch('core.search.bulk_index', bulk_index):
+                drain_outbox()
+
+            # Sent so that it is searchable before the generation moves on
+            self.assertEqual(refreshes, ['wait_for'])
+            self.assertEqual(cached_search("papers"), {'total': 1})
+            self.assertEqual(search.call_count, 2)
+
+#
+# Search
+#
+
+def search_response(*hits, aggregations=None):
+    # What Elasticsearch answers a search with, for (score, id) hits
+    response = {'took': 1, 'timed_out': False, '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'max_score': None,
+                         'hits': [{'_index': 'nafan', '_id': str(id), '_score': score, 'sort': [score, id],
+                                   '_source': {'id': id, 'title': f"Papers {id}", 'slug': "test", 'type': "EAD"}}
+                                  for score, id in hits]}}
+    if aggregations:
+        response['aggregations'] = aggregations
+    return response
+
+FACETS = {
+    'repository': {'buckets': [{'key': "Test Repository", 'doc_count': 2}]},
+    'type': {'buckets': [{'key': "EAD", 'doc_count': 2}]},
+    'controlaccess': {'doc_count': 3, 'type': {'buckets': [
+        {'key': "subject", 'doc_count': 3, 'term': {'buckets': [{'key': "Mathematics", 'doc_count': 3, 'aids': {'doc_count': 2}}]}}]}},
+    'date': {'buckets': [{'key': 1800.0, 'doc_count': 2}]},
+}
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        caches['search'].clear()
+        bump_generation()
+        self.es = mock.MagicMock()
+        patcher = mock.patch('core.search.get_client', return_value=self.es)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def search(self, **params):
+        response = self.client.get(reverse('api-search'), params)
+        # elasticsearch_dsl passes the request body as keyword arguments
+        body = self.es.search.call_args.kwargs if self.es.search.called else None
+        return response, body
+
+    def test_query_and_facets(self):
+        self.es.search.return_value = search_response((2.5, 7), (1.5, 9), aggregations=FACETS)
+        response, body = self.search(searchTerm=" civil war ", repository="Test Repository", control_type="subject",
+                                     control_term="Mathematics", date_from="1800", date_to="1900", size="2")
+
+        query = body['query']['bool']
+        self.assertEqual(query['must'][0]['simple_query_string']['query'], "civil war")
+        self.assertEqual(query['filter'], [
+            {'term': {'repository.keyword': "Test Repository"}},
+            {'nested': {'path': 'controlaccess', 'query': {'bool': {'filter': [{'term': {'controlaccess.type': "subject"}},
+                                                                              {'term': {'controlaccess.term': "Mathematics"}}]}}}},
+            {'range': {'date_to': {'gte': 1800}}},
+            {'range': {'date_from': {'lte': 1900}}},
+        ])
+        self.assertEqual((body['sort'], body['size']), (['_score', {'id': 'asc'}], 2))
+        self.assertEqual(sorted(body['aggs']), ['controlaccess', 'date', 'repository', 'type'])
+
+        results = response.json()
+        self.assertEqual([result['url'] for result in results['results']],
+                         [reverse('detail-findingaid', kwargs={'pk': 7, 'slug': "test"}),
+                          reverse('detail-findingaid', kwargs={'pk': 9, 'slug': "test"})])
+        self.assertEqual(results['facets'], {
+            'repository': [{'value': "Test Repository", 'count': 2}],
+            'type': [{'value': "EAD", 'count': 2}],
+            'controlaccess': [{'value': "subject", 'count': 3, 'terms': [{'value': "Mathematics", 'count': 2}]}],
+            'date': [{'from': 1800, 'to': 1849, 'count': 2}],
+        })
+        # A full page, so there may be another
+        self.assertEqual(decode_cursor(results['next']), [1.5, 9])
+
+    def test_next_page(self):
+        self.es.search.return_value = search_response((1.0, 12))
+        response, body = self.search(searchTerm="civil war", size="2", after=encode_cursor([1.5, 9]))
+
+        # Carries on after the last hit, without working the facets out again
+        self.assertEqual(body['search_after'], [1.5, 9])
+        self.assertNotIn('aggs', body)
+        results = response.json()
+        self.assertNotIn('facets', results)
+        self.assertIsNone(results['next'])
+
+    def test_page_size(self):
+        self.es.search.return_value = search_response(aggregations=FACETS)
+        self.assertEqual(self.search(size="0")[1]['size'], 1)
+        caches['search'].clear()
+        self.assertEqual(self.search(size="1000")[1]['size'], 100)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.search(after="nonsense")[0].status_code, 400)
+        self.assertEqual(self.search(date_from="then")[0].status_code, 400)
+        self.assertFalse(self.es.search.called)
+
+        self.es.search.side_effect = SearchConnectionError('N/A', 'Connection refused', None)
+        self.assertEqual(self.search(searchTerm="civil war")[0].status_code, 503)
+
+#
+# Suggestions
+#
+
+class SuggestTests(TestCase):
+
+    def test_only_public_repositories(self):
+        Repository.objects.create(name="Public Library", slug="public", status=Repository.PUBLIC)
+        Repository.objects.create(name="Private Library", slug="private")
+        self.assertEqual(list(repository_counts()), ["Public Library"])
+
+    def test_merged_copy(self):
+        suggestions = Suggestions({"Smith, John": 3, "Smith, Jane": 5})
+        merged = suggestions.merged({"Smith, Jane": 0, "Smithson, James": 4})
+        # The suggestions being read aren't changed
+        self.assertEqual(suggestions.lookup("smith"), [("Smith, Jane", 5), ("Smith, John", 3)])
+        self.assertEqual(suggestions.lookup("sm"), [("Smith, Jane", 5), ("Smith, John", 3)])
+        self.assertEqual(merged.lookup("smith"), [("Smithson, James", 4), ("Smith, John", 3)])
+        self.assertEqual(merged.lookup("sm"), [("Smithson, James", 4), ("Smith, John", 3)])
+
+    def test_rank(self):
+        suggestions = Suggestions({"Lovelace, Ada": 5, "lovelace,  ada": 1, "Love, Courtney": 9, "Lovell, James": 2,
+                                   "Babbage, Charles": 7, "": 4})
+        # Most used first, matched on the prefix whatever the case and spacing
+        self.assertEqual(suggestions.rank("love", 10), [("Love, Courtney", 9), ("Lovelace, Ada", 5), ("Lovell, James", 2),
+                                                        ("lovelace,  ada", 1)])
+        self.assertEqual(suggestions.lookup("LOVELACE,   A"), [("Lovelace, Ada", 5), ("lovelace,  ada", 1)])
+        self.assertEqual(suggestions.lookup("lov", limit=2), [("Love, Courtney", 9), ("Lovelace, Ada", 5)])
+        self.assertEqual(suggestions.lookup("l"), suggestions.rank("l", 10))
+        self.assertEqual(suggestions.lookup("zz"), [])
+        self.assertEqual(suggestions.lookup("  "), [])
+
+#
+# Harvesting
+#
+# The harvesters are run against stub servers on localhost.
+#
+
+class StubServer:
+    '''
+    An HTTP server on localhost for the length of a with block.  respond(handler) returns the
+    status, headers and body of each GET.  requests holds the path and headers of each one.
+    '''
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.requests.append((self.path, dict(self.headers)))
+                status, headers, body = stub.respond(self)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path="/"):
+        return f'http://127.0.0.1:{self.server.server_port}{path}'
+
+    def queries(self):
+        return [{name: values[0] for name, values in parse_qs(urlparse(path).query).items()} for path, headers in self.requests]
+
+def ead(title):
+    return f'<ead><archdesc level="collection"><did><unittitle>{title}</unittitle></did></archdesc></ead>'
+
+class OAIStub:
+    '''
+    ListRecords over records, {identifier: (datestamp, title or None if deleted)}, PAGE_SIZE at
+    a time.  from and until are applied by day.  fail_at makes the page starting there fail.
+    '''
+    PAGE_SIZE = 2
+
+    def __init__(self, records):
+        self.records = records
+        self.fail_at = None
+
+    def __call__(self, handler):
+        query = {name: values[0] for name, values in parse_qs(urlparse(handler.path).query).items()}
+        if 'resumptionToken' in query:
+            start, since, until = query['resumptionToken'].split('|')
+            start = int(start)
+            if start == self.fail_at:
+                return 500, {}, b""
+        else:
+            start, since, until = 0, query.get('from', ''), query.get('until', '')
+
+        matching = [(identifier, datestamp, title) for identifier, (datestamp, title) in sorted(self.records.items())
+                    if (not since or datestamp >= since[:10]) and (not until or datestamp <= until[:10])]
+        if not matching:
+            body = '<error code="noRecordsMatch">No records</error>'
+        else:
+            records = []
+            for identifier, datestamp, title in matching[start:start + self.PAGE_SIZE]:
+                if title is None:
+                    records.append(f'<record><header status="deleted"><identifier>{identifier}</identifier>'
+                                   f'<datestamp>{datestamp}</datestamp></header></record>')
+                else:
+                    records.append(f'<record><header><identifier>{identifier}</identifier><datestamp>{datestamp}</datestamp>'
+                                   f'</header><metadata>{ead(title)}</metadata></record>')
+            token = f'{start + self.PAGE_SIZE}|{since}|{until}' if start + self.PAGE_SIZE < len(matching) else ''
+            body = f'<ListRecords>{"".join(records)}<resumptionToken>{token}</resumptionToken></ListRecords>'
+
+        return 200, {'Content-Type': 'text/xml'}, ('<?xml version="1.0" encoding="UTF-8"?>'
+                                                   '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+                                                   '<responseDate>2024-02-01T12:00:00Z</responseDate><request>stub</request>'
+                                                   f'{body}</OAI-PMH>').encode()
+
+@override_settings(OAI_MAX_RETRIES=0, OAI_TIMEOUT=10)
+class OAIHarvestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+
+    def setUp(self):
+        self.stub = OAIStub({f'oai:test:{number}': (f'2024-01-0{number}', f"Papers {number}") for number in range(1, 6)})
+        self.server = StubServer(self.stub)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.profile = HarvestProfile.objects.create(repository=self.repository, name="OAI", location=self.server.url("/oai"),
+                                                     harvest_type=HarvestProfile.OAI)
+
+    def harvest(self, **kwargs):
+        self.server.requests.clear()
+        counts = harvester_for(self.profile, **kwargs).run()
+        self.profile.refresh_from_db()
+        return counts
+
+    def titles(self):
+        return sorted(FindingAid.objects.filter(repository=self.repository).values_list('title', flat=True))
+
+    def test_pages(self):
+        self.assertEqual(self.harvest()['ingested'], 5)
+        self.assertEqual(self.titles(), [f"Papers {number}" for number in range(1, 6)])
+        # Three pages, the later ones by resumption token
+        self.assertEqual([query.get('resumptionToken') for query in self.server.queries()], [None, '2||', '4||'])
+        self.assertEqual((self.profile.last_datestamp, self.profile.resumption_token), ("2024-02-01", ""))
+
+    def test_incremental(self):
+        self.harvest()
+        self.stub.records['oai:test:2'] = ('2024-02-01', "Papers 2 revised")
+        self.stub.records['oai:test:3'] = ('2024-02-01', None)
+        self.stub.records['oai:test:6'] = ('2024-02-02', "Papers 6")
+
+        counts = self.harvest()
+        # Only what changed since the day the last harvest started
+        self.assertEqual(self.server.queries()[0]['from'], "2024-02-01")
+        self.assertEqual((counts['ingested'], counts['deleted']), (2, 1))
+        self.assertEqual(self.titles(), ["Papers 1", "Papers 2 revised", "Papers 4", "Papers 5", "Papers 6"])
+        self.assertFalse(HarvestRecord.objects.filter(profile=self.profile, identifier='oai:test:3').exists())
+
+    def test_unknown_delete_skipped(self):
+        self.stub.records['oai:test:9'] = ('2024-01-09', None)
+        counts = self.harvest()
+        self.assertEqual((counts['ingested'], counts['deleted'], counts['skipped']), (5, 0, 1))
+
+    def test_window(self):
+        counts = self.harvest(from_date="2024-01-02", until="2024-01-03")
+        self.assertEqual(self.server.queries()[0]['from'], "2024-01-02")
+        self.assertEqual(self.server.queries()[0]['until'], "2024-01-03")
+        self.assertEqual(counts['ingested'], 2)
+        self.assertEqual(self.titles(), ["Papers 2", "Papers 3"])
+        # A window doesn't move the checkpoint of the incremental harvests
+        self.assertEqual(self.profile.last_datestamp, "")
+
+    def test_resumed(self):
+        self.stub.fail_at = 4
+        with self.assertRaises(HarvestError):
+            self.harvest()
+        self.assertEqual(self.titles(), [f"Papers {number}" for number in range(1, 5)])
+        # The second page was loaded but the checkpoint is only moved on once the next page
+        # has been fetched, so it is read again
+        self.assertEqual(self.profile.resumption_token, "2||")
+
+        self.stub.fail_at = None
+        counts = self.harvest()
+        self.assertEqual((counts['ingested'], counts['unchanged']), (1, 2))
+        self.assertEqual(self.server.queries()[0]['resumptionToken'], "2||")
+        self.assertEqual((self.profile.last_datestamp, self.profile.resumption_token), ("2024-02-01", ""))
+
+class FileStub:
+    '''
+    Serves files, {path: body}, with an ETag and Last-Modified and answers a matching
+    conditional GET with a 304.  delay holds each response so concurrency shows, busy is the
+    most requests it had running at once.
+    '''
+
+    def __init__(self, files, delay=0):
+        self.files = files
+        self.delay = delay
+        self.running = self.busy = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, handler):
+        with self.lock:
+            self.running += 1
+            self.busy = max(self.busy, self.running)
+        try:
+            time.sleep(self.delay)
+            body = self.files.get(urlparse(handler.path).path)
+            if body is None:
+                return 404, {}, b""
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+            # If-None-Match wins over If-Modified-Since, as in RFC 9110
+            if handler.headers.get('If-None-Match'):
+                unchanged = handler.headers['If-None-Match'] == etag
+            else:
+                unchanged = handler.headers.get('If-Modified-Since') == LAST_MODIFIED
+            if unchanged:
+                return 304, {}, b""
+            return 200, {'ETag': etag, 'Last-Modified': LAST_MODIFIED}, body
+        finally:
+            with self.lock:
+                self.running -= 1
+
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+def sitemap(urls, index=False):
+    tag, entry = ('sitemapindex', 'sitemap') if index else ('urlset', 'url')
+    entries = "".join(f'<{entry}><loc>{url}</loc>{f"<lastmod>{lastmod}</lastmod>" if lastmod else ""}</{entry}>'
+                      for url, lastmod in urls)
+    return f'<{tag} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{entries}</{tag}>'.encode()
+
+def listing(links):
+    return ("<html><body>" + "".join(f'<a href="{link}">{link}</a>' for link in links) + "</body></html>").encode()
+
+@override_settings(HARVEST_DELAY=0, OAI_TIMEOUT=10)
+class CrawlHarvestTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.repository = Repository.objects.create(name="Test Repository", slug="test")
+
+    def serve(self, files, delay=0):
+        self.stub = FileStub(files, delay)
+        self.server = StubServer(self.stub)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def harvest(self, harvest_type, path):
+        profile, _ = HarvestProfile.objects.get_or_create(repository=self.repository, name="Crawl",
+                                                          defaults={'location': self.server.url(path),
+                                                                    'harvest_type': harvest_type})
+        self.server.requests.clear()
+        return harvester_for(profile).run()
+
+    def titles(self):
+        return sorted(FindingAid.objects.filter(repository=self.repository).values_list('title', flat=True))
+
+    def fetched(self):
+        return sorted(path for path, headers in self.server.requests)
+
+    def test_sitemap_index(self):
+        self.serve({
+            '/sitemap.xml': b"",
+            '/guides.xml': sitemap([("/ead/1.xml", "2024-01-01")]),
+            '/more.xml.gz': gzip.compress(sitemap([("/ead/2.xml", None), ("/ead/3.xml", None)])),
+            '/ead/1.xml': ead("Papers 1").encode(),
+            '/ead/2.xml': ead("Papers 2").encode(),
+            '/ead/3.xml': ead("Papers 3").encode(),
+        })
+        self.stub.files['/sitemap.xml'] = sitemap([(self.server.url('/guides.xml'), None), ("/more.xml.gz", None)], index=True)
+
+        self.assertEqual(self.harvest(HarvestProfile.SITEMAP, '/sitemap.xml')['ingested'], 3)
+        self.assertEqual(self.titles(), ["Papers 1", "Papers 2", "Papers 3"])
+
+        # A file whose lastmod hasn't moved isn't fetched at all
+        counts = self.harvest(HarvestProfile.SITEMAP, '/sitemap.xml')
+        self.assertEqual(counts['unchanged'], 3)
+        self.assertNotIn('/ead/1.xml', self.fetched())
+
+    def test_directory_listing(self):
+        self.serve({
+            '/guides/': listing(["../", "/", "1.xml", "notes.txt", "http://example.com/2.xml", "?C=N;O=D", "older/"]),
+            '/guides/1.xml': ead("Papers 1").encode(),
+            '/guides/older/': listing(["../", "2.xml"]),
+            '/guides/older/2.xml': ead("Papers 2").encode(),
+        })
+        self.assertEqual(self.harvest(HarvestProfile.DIR, '/guides/')['ingested'], 2)
+        self.assertEqual(self.titles(), ["Papers 1", "Papers 2"])
+        self.assertEqual(self.fetched(), ['/guides/', '/guides/1.xml', '/guides/older/', '/guides/older/2.xml'])
+
+    def test_conditional_get(self):
+        self.serve({
+            '/guides/': listing(["1.xml", "2.xml"]),
+            '/guides/1.xml': ead("Papers 1").encode(),
+            '/guides/2.xml': ead("Papers 2").encode(),
+        })
+        self.harvest(HarvestProfile.DIR, '/guides/')
+        self.stub.files['/guides/2.xml'] = ead("Papers 2 revised").encode()
+
+        counts = self.harvest(HarvestProfile.DIR, '/guides/')
+        self.assertEqual((counts['ingested'], counts['unchanged']), (1, 1))
+        self.assertEqual(self.titles(), ["Papers 1", "Papers 2 revised"])
+
+        # The validators of the last fetch were sent back, the unchanged file got a 304
+        headers = dict(self.server.requests)
+        self.assertTrue(headers['/guides/1.xml']['If-None-Match'])
+        self.assertEqual(headers['/guides/1.xml']['If-Modified-Since'], LAST_MODIFIED)
+
+    def test_download_not_modified(self):
+        self.serve({'/1.xml': ead("Papers 1").encode()})
+        path, digest, etag, last_modified = download(self.server.url('/1.xml'))
+        self.addCleanup(os.unlink, path)
+        self.assertEqual((digest, last_modified), (hashlib.sha256(ead("Papers 1").encode()).hexdigest(), LAST_MODIFIED))
+        self.assertEqual(download(self.server.url('/1.xml'), etag), (None, None, etag, ""))
+        self.assertEqual(download(self.server.url('/1.xml'), "", last_modified), (None, None, "", last_modified))
+
+    @override_settings(HARVEST_CONNECTIONS=8, HARVEST_HOST_CONNECTIONS=2)
+    def test_host_connections(self):
+        files = {f'/guides/{number}.xml': ead(f"Papers {number}").encode() for number in range(8)}
+        files['/guides/'] = listing([path.rsplit('/', 1)[1] for path in files])
+        self.serve(files, delay=0.2)
+        self.assertEqual(self.harvest(HarvestProfile.DIR, '/guides/')['ingested'], 8)
+        self.assertEqual(self.stub.busy, 2)
+
+#
+# Harvest jobs
+#
+
+@override_settings(HARVEST_MAX_JOBS=2, HARVEST_REPOSITORY_JOBS=1, HARVEST_JOB_TIMEOUT=60)
+class HarvestJobTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first = Repository.objects.create(name="First Repository", slug="first")
+        cls.second = Repository.objects.create(name="Second Repository", slug="second")
+        cls.profiles = {name: HarvestProfile.objects.create(repository=repository, name=name, location="http://example.com/")
+                        for repository, name in ((cls.first, "a"), (cls.first, "b"), (cls.first, "c"), (cls.second, "d"))}
+
+    def queue(self, **estimates):
+        return {name: HarvestJob.objects.create(profile=self.profiles[name], estimate=estimate)
+                for name, estimate in estimates.items()}
+
+    def claimed(self):
+        job = claim_job("worker")
+        return job and job.profile.name
+
+    def test_limits(self):
+        jobs = self.queue(a=10, b=5, c=1, d=20)
+
+        # Shortest first, then one per repository and two in all
+        self.assertEqual([self.claimed(), self.claimed(), self.claimed()], ["c", "d", None])
+
+        HarvestJob.objects.filter(pk=jobs['c'].pk).update(status=HarvestJob.FINISHED)
+        self.assertEqual(self.claimed(), "b")
+        job = HarvestJob.objects.get(pk=jobs['b'].pk)
+        self.assertEqual((job.status, job.worker), (HarvestJob.RUNNING, "worker"))
+        self.assertIsNotNone(job.heartbeat)
+
+    @override_settings(HARVEST_REPOSITORY_JOBS=2)
+    def test_profile_runs_once(self):
+        # A profile isn't harvested twice at once, and is only queued once
+        running = self.queue(a=1)['a']
+        self.assertEqual(self.claimed(), "a")
+        again = queue_harvest(self.profiles["a"])
+        self.assertNotEqual(again.pk, running.pk)
+        self.assertEqual(queue_harvest(self.profiles["a"]).pk, again.pk)
+
+        self.queue(b=5)
+        self.assertEqual(self.claimed(), "b")
+        self.assertEqual(HarvestJob.objects.get(pk=again.pk).status, HarvestJob.QUEUED)
+
+    def test_stale_jobs_failed(self):
+        self.queue(a=1, d=1)
+        self.assertEqual({self.claimed(), self.claimed()}, {"a", "d"})
+        stale = HarvestJob.objects.get(profile__name="a")
+        HarvestJob.objects.filter(pk=stale.pk).update(heartbeat=timezone.now() - timedelta(seconds=120))
+
+        self.assertEqual(fail_stale_jobs(), 1)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, HarvestJob.FAILED)
+        self.assertTrue(stale.message)
+        self.assertEqual(HarvestJob.objects.get(profile__name="d").status, HarvestJob.RUNNING)
+
+        # Which frees its repository for the next job
+        self.queue(b=1)
+        self.assertEqual(self.claimed(), "b")
@@ -6,13 +6,16 @@ from .views import *
 
 urlpatterns = [
     # TODO:
-    #  - search results
     #  - repository record
     #  - collection guides (pdf/ead/marc/local)
     path("", TemplateView.as_view(template_name="home.html"), name="home"),
     # TODO: 
     #   - DB table to add help pages?
     #   - Link from homepage?
+    path("search", SearchView.as_view(), name="search"),
+    path("api/search", SearchAPIView.as_view(), name="api-search"),
+    path("api/suggest", SuggestAPIView.as_view(), name="api-suggest"),
+
     path("help", TemplateView.as_view(template_name="help.html"), name="help"),
     path("joinus", JoinRequestCreateView.as_view(), name="join-us"),
     path("joinus/success", TemplateView.as_view(template_name="join_us_success.html"), name="join-us-success"),
@@ -52,8 +55,8 @@ urlpatterns = [
     path('repositories/<str:slug>/profiles', ProfileListView.as_view(), name='list-profiles'),
     # TODO: hide repo selector
     path('repositories/<str:slug>/profiles/add', ProfileCreateView.as_view(), name='create-profile'),
-    # TODO: do harvest
     path('repositories/<str:slug>/profiles/<int:pk>', ProfileDetailView.as_view(), name='detail-profile'),
+    path('repositories/<str:slug>/profiles/<int:pk>/harvest', ProfileHarvestView.as_view(), name='harvest-profile'),
     path('repositories/<str:slug>/profiles/<int:pk>/update', ProfileUpdateView.as_view(), name='update-profile'),
     path('repositories/<str:slug>/profiles/<int:pk>/delete', ProfileDeleteView.as_view(), name='delete-profile'),
 
@@ -61,6 +64,7 @@ urlpatterns = [
     path('repositories/<str:slug>/findingaids', FindingAidListView.as_view(), name='list-findingaids'),
     path('repositories/<str:slug>/findingaids/add', FindingAidCreateView.as_view(), name='create-findingaid'),
     path('repositories/<str:slug>/findingaids/<int:pk>', FindingAidDetailView.as_view(), name='detail-findingaid'),
+    path('repositories/<str:slug>/findingaids/<int:pk>/components', ComponentAPIView.as_view(), name='api-components'),
     path('repositories/<str:slug>/findingaids/<int:pk>/update', FindingAidUpdateView.as_view(), name='update-findingaid'),
     path('repositories/<str:slug>/findingaids/<int:pk>/delete', FindingAidDeleteView.as_view(), name='delete-findingaid'),
 
@@ -1,12 +1,27 @@
-from django.views.generic import TemplateView
-from django.views.generic.detail import DetailView
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+from django.http import JsonResponse
+from django.shortcuts import redirect
+from django.views.generic import TemplateView, View
+from django.views.generic.detail import DetailView, SingleObjectMixin
 from django.views.generic.list import ListView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 
 from .models import *
 from .forms import *
+from .fragments import fragment_timeout, record_view
+from .harvest import queue_harvest
+from .search import cached_search, decode_cursor, encode_cursor, search_cache_stats
+from .suggest import suggest
+
+from elasticsearch import TransportError
+
+import re
 
 #
 # Dashboard
@@ -19,8 +34,121 @@ class DashboardView(LoginRequiredMixin, TemplateView):
         context = super(DashboardView, self).get_context_data(*args,**kwargs)
         if self.request.user.is_site_admin:
             context['join_requests'] = JoinRequest.objects.all()
+            context['search_cache'] = search_cache_stats()
         return context
     
+#
+# Search
+#
+
+class SearchMixin:
+    # Request parameters shared by the search page and the JSON API
+
+    def get_search(self):
+        params = self.request.GET
+        filters = {name: params.get(name, '').strip() for name in ('repository', 'type', 'control_type', 'control_term')}
+
+        for name in ('date_from', 'date_to'):
+            filters[name] = int(params[name]) if params.get(name, '').strip() else None
+
+        after = decode_cursor(params['after']) if params.get('after') else None
+        size = max(int(params['size']), 1) if params.get('size') else None
+
+        return cached_search(params.get('searchTerm', '').strip(), filters, after, size)
+
+class SearchView(SearchMixin, TemplateView):
+    template_name = "search.html"
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(SearchView, self).get_context_data(*args, **kwargs)
+        context['search_term'] = self.request.GET.get('searchTerm', '')
+        context['record_types'] = dict(FindingAid.RECORD_TYPES)
+
+        # The current search without the page, facet and paging links are added to it
+        query = self.request.GET.copy()
+        query.pop('after', None)
+        context['query'] = query.urlencode()
+
+        try:
+            context['search'] = self.get_search()
+        except ValueError:
+            context['error'] = "The search could not be understood"
+        except TransportError:
+            context['error'] = "Search is not available right now, please try again later"
+        return context
+
+class SearchAPIView(SearchMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        try:
+            search = self.get_search()
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except TransportError:
+            return JsonResponse({'error': 'Search is not available'}, status=503)
+
+        for result in search['results']:
+            result['url'] = reverse('detail-findingaid', kwargs={'pk': result['id'], 'slug': result['slug']})
+        return JsonResponse(search)
+
+class SuggestAPIView(View):
+    # Typeahead for control access terms (kind=persname, subject, ...) and repository names (kind=repository)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            limit = int(request.GET.get('limit', 10))
+        except ValueError:
+            return JsonResponse({'error': 'limit must be a number'}, status=400)
+
+        suggestions = suggest(request.GET.get('kind', ''), request.GET.get('q', ''), limit)
+        return JsonResponse({'suggestions': [{'value': value, 'count': count} for value, count in suggestions]})
+
+#
+# Lists
+#
+
+class KeysetListMixin:
+    '''
+    Pages a ListView in (keyset_field, pk) order, each page carrying on from the after cursor
+    of the one before rather than from an offset, so a late page costs the same as the first.
+    get_queryset applies the filters, the template gets the page as object_list, the cursor of
+    the next page as next and the current filters as query.
+    '''
+    keyset_field = None
+
+    def keyset_page(self, queryset):
+        field = self.keyset_field
+        size = getattr(settings, 'LIST_PAGE_SIZE', 50)
+
+        if self.request.GET.get('after'):
+            try:
+                value, pk = decode_cursor(self.request.GET['after'])
+            except ValueError as e:
+                raise BadRequest(str(e))
+            queryset = queryset.filter(Q(**{field + '__gte': value}), Q(**{field + '__gt': value}) | Q(pk__gt=pk))
+
+        rows = list(queryset.order_by(field, 'pk')[:size + 1])
+        if len(rows) > size:
+            return rows[:size], encode_cursor([getattr(rows[size - 1], field), rows[size - 1].pk])
+        return rows, None
+
+    @staticmethod
+    def prefix(field, term):
+        # field starting with term whatever the case.  A range on the lowercased column rather than
+        # LIKE, which can't use the Lower() indexes.
+        term = term.lower()
+        return Q(**{field + '__lower__gte': term, field + '__lower__lt': term + '\U0010ffff'})
+
+    def get_context_data(self, *args, **kwargs):
+        page, after = self.keyset_page(self.object_list)
+        context = super().get_context_data(*args, object_list=page, **kwargs)
+
+        query = self.request.GET.copy()
+        for name in ('after', 'csrfmiddlewaretoken'):
+            query.pop(name, None)
+        context.update({'next': after, 'query': query.urlencode(), 'filters': self.request.GET})
+        return context
+
 #
 # Repositories
 #
@@ -28,14 +156,44 @@ class DashboardView(LoginRequiredMixin, TemplateView):
 class RepositoryDetailView(DetailView):
     model = Repository
 
-class RepositoryListView(ListView):
+    def get_context_data(self, *args, **kwargs):
+        context = super(RepositoryDetailView, self).get_context_data(*args, **kwargs)
+        # The finding aids only, not their components.  The related manager reads repository_id
+        # from each row, so it mustn't be deferred.
+        context['finding_aids'] = self.object.findingaid_set.filter(progenitorID=0).only('pk', 'title', 'repository').order_by('title')
+        context['profiles'] = self.object.harvestprofile_set.only('pk', 'name', 'repository').order_by('name')
+        return context
+
+class RepositoryListView(KeysetListMixin, ListView):
     model = Repository
+    keyset_field = 'name'
+
+    # search_field choices and the columns they search, states are matched whole
+    SEARCH_FIELDS = {'Repository': 'name', 'City': 'st_city', 'State': 'state'}
 
     def get_queryset(self):
-        if self.request.user:
-            return self.request.user.get_user_repositories()
+        if self.request.user.is_authenticated:
+            repositories = self.request.user.get_user_repositories()
         else:
-            return Repository.objects.filter(status=Repository.PUBLIC)
+            repositories = Repository.objects.filter(status=Repository.PUBLIC)
+
+        params = self.request.GET
+        term = params.get('search_term', '').strip()
+        if term:
+            field = self.SEARCH_FIELDS.get(params.get('search_field'), 'name')
+            if field == 'state':
+                repositories = repositories.filter(state__lower=term.lower())
+            else:
+                repositories = repositories.filter(self.prefix(field, term))
+        if params.get('status_filter') in dict(Repository.STATUSES):
+            repositories = repositories.filter(status=params['status_filter'])
+
+        return repositories.only('pk', 'name', 'slug', 'st_city', 'state')
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(RepositoryListView, self).get_context_data(*args, **kwargs)
+        context['statuses'] = Repository.STATUSES
+        return context
 
 class RepositoryCreateView(UserPassesTestMixin, CreateView):
     model = Repository
@@ -68,14 +226,35 @@ class RepositoryAddUserView(UserPassesTestMixin, CreateView):
         return initial
 
     def test_func(self):
-        return self.request.user.is_site_admin or self.request.user.is_admin_of(self.request.slug)
+        return self.request.user.is_repo_admin(self.kwargs['slug'])
 
 #
 # Users
 #
 
-class UserListView(ListView):
+class UserListView(KeysetListMixin, ListView):
     model = User
+    keyset_field = 'email'
+
+    def get_queryset(self):
+        # user_type reads the prefetched roles
+        users = User.objects.prefetch_related('userrole_set')
+
+        params = self.request.GET
+        term = params.get('search_term', '').strip()
+        if term and params.get('search_field') == 'full_name':
+            names = term.split(None, 1)
+            if len(names) > 1:
+                users = users.filter(self.prefix('first_name', names[0]), self.prefix('last_name', names[1]))
+            else:
+                users = users.filter(self.prefix('first_name', term) | self.prefix('last_name', term))
+        elif term:
+            users = users.filter(self.prefix('email', term))
+
+        status = params.get('status_filter')
+        if status in ('Active', 'Inactive'):
+            users = users.filter(is_active=status == 'Active')
+        return users
 
     def test_func(self):
         return self.request.user.is_site_admin
@@ -118,8 +297,28 @@ class JoinRequestCreateView(CreateView):
 class ProfileDetailView(UserPassesTestMixin, DetailView):
     model = HarvestProfile
 
+    def get_context_data(self, *args, **kwargs):
+        context = super(ProfileDetailView, self).get_context_data(*args, **kwargs)
+        jobs = list(self.object.harvestjob_set.order_by('-queued')[:10])
+        context['jobs'] = jobs
+        context['active'] = [job for job in jobs if job.status in (HarvestJob.QUEUED, HarvestJob.RUNNING)]
+        context['can_harvest'] = self.request.user.is_repo_admin(self.object.repository_id)
+        return context
+
     def test_func(self):
-        return self.request.user.is_repo_member(self.get_object().repository)
+        return self.request.user.is_repo_member(self.get_object().repository_id)
+
+class ProfileHarvestView(UserPassesTestMixin, SingleObjectMixin, View):
+    # Queues a harvest for the harvest_worker, harvests are never run in the request
+    model = HarvestProfile
+
+    def post(self, request, *args, **kwargs):
+        profile = self.get_object()
+        queue_harvest(profile, request.user, full=bool(request.POST.get('full')))
+        return redirect(profile.get_absolute_url())
+
+    def test_func(self):
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
 class ProfileListView(UserPassesTestMixin, ListView):
     model = HarvestProfile
@@ -133,11 +332,11 @@ class ProfileListView(UserPassesTestMixin, ListView):
         return context
 
     def test_func(self):
-        return self.request.user.is_repo_admin(Repository.objects.get(slug=self.kwargs['slug']))
+        return self.request.user.is_repo_admin(self.kwargs['slug'])
 
 class ProfileCreateView(UserPassesTestMixin, CreateView):
     model = HarvestProfile
-    fields = ("repository", "name", "location", "harvest_type", "default_format",)
+    fields = ("repository", "name", "location", "harvest_type", "default_format", "harvest_interval",)
 
     def get_initial(self):
         initial = super().get_initial()
@@ -145,14 +344,14 @@ class ProfileCreateView(UserPassesTestMixin, CreateView):
         return initial
     
     def test_func(self):
-        return self.request.user.is_repo_admin(Repository.objects.get(slug=self.kwargs['slug']))
+        return self.request.user.is_repo_admin(self.kwargs['slug'])
 
 class ProfileUpdateView(UserPassesTestMixin, UpdateView):
     model = HarvestProfile
     fields = '__all__'
 
     def test_func(self):
-        return self.request.user.is_repo_admin(self.get_object().repository)
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
 class ProfileDeleteView(UserPassesTestMixin, DeleteView):
     model = HarvestProfile
@@ -161,7 +360,7 @@ class ProfileDeleteView(UserPassesTestMixin, DeleteView):
         return reverse_lazy('list-profiles', kwargs={'slug': self.get_object().repository.slug})
 
     def test_func(self):
-        return self.request.user.is_repo_admin(self.get_object().repository)
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
 #
 # Finding Aids
@@ -169,17 +368,74 @@ class ProfileDeleteView(UserPassesTestMixin, DeleteView):
 
 class FindingAidDetailView(DetailView):
     model = FindingAid
+    # Off when warm_fragments renders the pages
+    count_views = True
+
+    # Only under the finding aid's own repository, as in ComponentAPIView
+    slug_field = 'repository__slug'
+    query_pk_and_slug = True
+
+    def get_queryset(self):
+        return FindingAid.objects.select_related('repository')
+
+    def get(self, request, *args, **kwargs):
+        response = super().get(request, *args, **kwargs)
+        if self.count_views:
+            record_view(self.object.pk)
+        return response
+
+    def get_template_names(self):
+        if self.object.record_type == FindingAid.EAD:
+            return ['core/findingaid_ead.html']
+        return super().get_template_names()
+
+    def get_context_data(self, *args, **kwargs):
+        context = super(FindingAidDetailView, self).get_context_data(*args, **kwargs)
+        context['fragment_timeout'] = fragment_timeout()
+        if self.object.record_type == FindingAid.EAD:
+            # Only the first page of the top level, the rest of the tree is fetched from
+            # ComponentAPIView as it is opened.  Both are only read if the fragments showing
+            # them aren't cached.
+            context['tree'] = SimpleLazyObject(lambda: dict(zip(('components', 'after'), self.object.get_level())))
+            context['control_terms'] = SimpleLazyObject(self.object.get_control_terms)
+        return context
+
+class ComponentAPIView(View):
+    # One page of the components below parent (the finding aid itself by default), as JSON
+
+    def get(self, request, *args, **kwargs):
+        try:
+            parent = int(request.GET.get('parent') or 0)
+            size = min(max(int(request.GET['size']), 1), 500) if request.GET.get('size') else None
+        except ValueError:
+            return JsonResponse({'error': 'parent and size must be numbers'}, status=400)
+        after = request.GET.get('after', '')
+        if after and not re.fullmatch(r'(\d+/)+', after):
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+        aid = FindingAid.objects.filter(pk=self.kwargs['pk'], repository__slug=self.kwargs['slug'], progenitorID=0).only('pk').first()
+        if aid is None:
+            return JsonResponse({'error': 'No such finding aid'}, status=404)
+
+        components, after = aid.get_level(parent, after, size)
+        return JsonResponse({'components': [dict({field: getattr(component, field) for field in FindingAid.TREE_FIELDS},
+                                                 id=component.pk, has_children=component.has_children)
+                                            for component in components],
+                             'after': after})
 
 class FindingAidListView(ListView):
     model = FindingAid
 
     def get_context_data(self, *args, **kwargs):
         context = super(FindingAidListView, self).get_context_data(*args, **kwargs)
-        context.update({'repository': Repository.objects.get(slug=self.kwargs['slug'])})
+        context.update({'repository': self.repository,
+                        'defaults': FindingAidDefaults.objects.filter(repository=self.repository).first()})
         return context
 
     def get_queryset(self):
-        return self.model._default_manager.filter(repository__slug=self.kwargs['slug'])
+        self.repository = Repository.objects.get(slug=self.kwargs['slug'])
+        # The finding aids only, not their components
+        return self.model._default_manager.filter(repository=self.repository, progenitorID=0).select_related('updated_by')
 
 class FindingAidCreateView(UserPassesTestMixin, CreateView):
     model = FindingAid
@@ -194,6 +450,8 @@ class FindingAidCreateView(UserPassesTestMixin, CreateView):
     def get_initial(self):
         initial = super().get_initial()
         initial.update({'repository': Repository.objects.get(slug=self.kwargs['slug'])})
+        if self.request.GET.get("record_type") == 'pdf':
+            initial.update({'record_type': FindingAid.PDF})
         return initial
     
     def get_form_class(self):
@@ -203,15 +461,21 @@ class FindingAidCreateView(UserPassesTestMixin, CreateView):
         else:  
             return super().get_form_class()
 
+    def form_valid(self, form):
+        # The contribution date and contributor aren't on the forms
+        form.instance.last_update = timezone.now()
+        form.instance.updated_by = self.request.user
+        return super().form_valid(form)
+
     def test_func(self):
-        return self.request.user.is_repo_admin(Repository.objects.get(slug=self.kwargs['slug']))
+        return self.request.user.is_repo_admin(self.kwargs['slug'])
 
 class FindingAidUpdateView(UserPassesTestMixin, UpdateView):
     model = FindingAid
     fields = '__all__'
 
     def test_func(self):
-        return self.request.user.is_repo_admin(self.get_object().repository)
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
 class FindingAidDeleteView(UserPassesTestMixin, DeleteView):
     model = FindingAid
@@ -220,7 +484,7 @@ class FindingAidDeleteView(UserPassesTestMixin, DeleteView):
         return reverse('detail-repository', kwargs={'slug' : self.object.repository.slug})
 
     def test_func(self):
-        return self.request.user.is_repo_admin(self.get_object().repository)
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
 #
 # Finding Aid Defaults
@@ -234,7 +498,7 @@ class FindingAidDefaultUpdateView(UserPassesTestMixin, UpdateView):
         return reverse('list-findingaids', kwargs={'slug' : self.object.repository.slug})
 
     def test_func(self):
-        return self.request.user.is_repo_admin(self.get_object().repository)
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
 class FindingAidDefaultCreateView(UserPassesTestMixin, CreateView):
     model = FindingAidDefaults
@@ -249,7 +513,7 @@ class FindingAidDefaultCreateView(UserPassesTestMixin, CreateView):
         return initial
 
     def test_func(self):
-        return self.request.user.is_repo_admin(Repository.objects.get(slug=self.kwargs['slug']))
+        return self.request.user.is_repo_admin(self.kwargs['slug'])
 
 class FindingAidDefaultDeleteView(UserPassesTestMixin, DeleteView):
     model = FindingAidDefaults
@@ -258,5 +522,5 @@ class FindingAidDefaultDeleteView(UserPassesTestMixin, DeleteView):
         return reverse('detail-repository', kwargs={'slug' : self.object.repository.slug})
 
     def test_func(self):
-        return self.request.user.is_repo_admin(self.get_object().repository)
+        return self.request.user.is_repo_admin(self.get_object().repository_id)
 
@@ -82,6 +82,38 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+#
+# 'search' holds public search results (core/search.py) for TIMEOUT seconds.  The local memory
+# cache drops the least recently used results past MAX_ENTRIES, per process.  To share one
+# cache between processes without running a cache server, use the file based cache instead:
+#   'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#   'LOCATION': '/var/tmp/nafan_search',
+#
+# 'fragments' holds the rendered parts of finding aid pages (core/fragments.py).  It is file based
+# so that every process shares it and warm_fragments can fill it after a deploy.  Fragments of an
+# older version of a finding aid are never read again, they expire after TIMEOUT seconds or are
+# culled past MAX_ENTRIES.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'search': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'search',
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/nafan_fragments',
+        'TIMEOUT': 7 * 24 * 3600,
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -125,3 +157,103 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Ingestion
+# Number of <cXX> components written per bulk insert when loading a finding aid
+
+INGEST_BATCH_SIZE = 1000
+
+# Bytes of EAD files ingest_ead lets its workers parse ahead of the writes, a bigger file is
+# parsed by the writing process as it goes.  Parsed records take around 50 times the space of
+# the file.
+INGEST_PREFETCH_SIZE = 16 * 1024 * 1024
+
+# Control access term ids an ingest process keeps in memory
+CONTROL_TERM_CACHE_SIZE = 100000
+
+# PDF finding aids: pages given to each extract_pdfs worker process at a time, and the characters
+# of extracted text kept as the scope and content (core/pdf.py)
+PDF_PAGES_PER_TASK = 20
+PDF_SUMMARY_LENGTH = 2000
+
+# Times extract_pdfs tries a file that fails before leaving it until a new file is uploaded
+PDF_EXTRACT_ATTEMPTS = 5
+
+# Harvesting
+# metadataPrefix asked for from OAI-PMH endpoints by the profile's default format, request
+# timeout and retries, and the records held between fetching and loading (core/harvest.py)
+
+OAI_METADATA_PREFIXES = {'E': 'ead', 'M': 'marc21'}
+OAI_TIMEOUT = 60
+OAI_MAX_RETRIES = 3
+HARVEST_QUEUE_SIZE = 50
+
+# Sitemap and Directory harvests: concurrent downloads in all and per host, the seconds between
+# requests to one host, how deep to follow directory listings and which files to fetch
+HARVEST_CONNECTIONS = 8
+HARVEST_HOST_CONNECTIONS = 2
+HARVEST_DELAY = 0.5
+HARVEST_MAX_DEPTH = 10
+HARVEST_EXTENSIONS = ('.xml', '.mrc', '.marc', '.pdf')
+HARVEST_USER_AGENT = 'NAFAN harvester'
+
+# Where harvested files are written while they are loaded, the system temporary directory if None
+HARVEST_DIR = None
+
+# Harvest jobs run by harvest_worker: how many run at once in all and per repository, seconds
+# between saving a job's progress, and seconds without a heartbeat before a job is given up on
+HARVEST_MAX_JOBS = 4
+HARVEST_REPOSITORY_JOBS = 1
+HARVEST_PROGRESS_INTERVAL = 5
+HARVEST_JOB_TIMEOUT = 600
+
+# Elasticsearch
+# Shared by all indexing and search, see core/search.py
+
+ELASTICSEARCH_HOSTS = [{'host': 'localhost', 'port': 9200}]
+
+# Seconds per request, and the retries made when a node times out or can't be reached
+ELASTICSEARCH_TIMEOUT = 10
+ELASTICSEARCH_MAX_RETRIES = 3
+
+# Kept-alive connections per node
+ELASTICSEARCH_MAXSIZE = 10
+
+# Index written and searched, an alias once the reindex command has been run
+ELASTICSEARCH_INDEX = 'nafan'
+
+# Replicas given to an index once reindex has finished loading it
+ELASTICSEARCH_REPLICAS = 1
+
+# Documents and bytes per _bulk request, and how often rejected documents are sent again
+ELASTICSEARCH_BULK_SIZE = 500
+ELASTICSEARCH_BULK_BYTES = 10 * 1024 * 1024
+ELASTICSEARCH_BULK_RETRIES = 3
+
+# Seconds before the last checkpoint that index_changes looks back, to catch rows written by
+# transactions that were still open when it last ran
+ELASTICSEARCH_DELTA_OVERLAP = 60
+
+# Results per page of the public search, at most 100
+SEARCH_PAGE_SIZE = 20
+
+# Rows per page of the repository and user lists
+LIST_PAGE_SIZE = 50
+
+# Components per level of a finding aid's tree rendered with the page or fetched at a time
+COMPONENT_PAGE_SIZE = 100
+
+# Seconds a process counts finding aid page views in memory before adding them to view_count,
+# which warm_fragments uses to pick the pages to render first
+FRAGMENT_VIEW_FLUSH = 60
+
+# Seconds a process goes before checking whether the index generation has been bumped
+SEARCH_GENERATION_TTL = 5
+
+# Seconds between merging changed control access terms into the typeahead suggestions, and
+# between full rebuilds that drop deleted terms (core/suggest.py)
+SUGGEST_REFRESH = 60
+SUGGEST_REBUILD = 3600
+
+# Outbox entries sent to Elasticsearch per batch by drain_search_outbox
+SEARCH_OUTBOX_BATCH_SIZE = 200